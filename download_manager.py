@@ -14,10 +14,16 @@ from tkinter import messagebox
 import queue
 
 from uc_driver import _safe_get_driver
-from kino_pub_downloader import download
+from kino_hls import set_driver_provider
+from kino_pub_downloader import download, prepare, split_clip
 
 _AUDIO_SELECT_LOCK = threading.Lock()
 
+LOOKAHEAD_DEPTH = 2  # сколько ожидающих задач разбираем наперёд
+LOOKAHEAD_PARALLEL = 1  # одновременных разборов наперёд (браузеров в пуле мало)
+LOOKAHEAD_MAX_TRIES = 3  # неудачных разборов одной задачи, после которых look-ahead её оставляет воркеру
+LOOKAHEAD_RETRY_DELAY = 20.0  # пауза перед повтором неудавшегося разбора (сек)
+
 
 class DownloadManager:
     def __init__(
@@ -30,6 +36,7 @@ class DownloadManager:
         notify_cb=None,
         history_cb=None,
         audio_select_cb=None,
+        audio_preselect_cb=None,
     ):
         self.root = root
         self.tree = tree
@@ -43,6 +50,7 @@ class DownloadManager:
         self.notify_cb = notify_cb
         self.history_cb = history_cb
         self.audio_select_cb = audio_select_cb or self._audio_select_dialog
+        self.audio_preselect_cb = audio_preselect_cb or self._audio_preselect_dialog
 
         self.sema = threading.Semaphore(self.MAX_PARALLEL)
         self.lock = threading.Lock()
@@ -61,6 +69,8 @@ class DownloadManager:
 
         # прогресс параллельных аудиодорожек: item_id -> idx -> {"line": str, "ts": float}
         self._audio_progress_by_item = {}
+        # статус видео, пока оно качается одновременно с аудио (иначе строки перетирают друг друга)
+        self._video_status_by_item = {}
 
         # чтобы не пересчитывать счётчик слишком часто (progress может спамить)
         self._counter_update_pending = False
@@ -74,6 +84,20 @@ class DownloadManager:
         self._dispatcher_thread = threading.Thread(target=self._dispatcher, daemon=True)
         self._dispatcher_thread.start()
 
+        # браузер для обновления протухших ссылок посреди загрузки берём из того же пула
+        if self.pool is not None:
+            set_driver_provider(lambda: self.pool.acquire(timeout=120), self.pool.release)
+
+        # look-ahead: разбор HLS ожидающих задач заранее, пока сетевые слоты заняты скачиванием
+        self._lookahead_done = {}  # item_id -> url, для которых разбор уже делали
+        self._lookahead_fails = {}  # item_id -> (url, неудач подряд, когда можно повторить)
+        self._lookahead_inflight = set()
+        self._lookahead_threads = []
+        for i in range(max(0, int(LOOKAHEAD_PARALLEL))):
+            t = threading.Thread(target=self._lookahead_loop, daemon=True, name=f"DLLookahead-{i}")
+            self._lookahead_threads.append(t)
+            t.start()
+
     def _ui_call_sync(self, func, *, timeout: float = 0.8, default=None):
         if threading.current_thread() is threading.main_thread():
             try:
@@ -471,6 +495,137 @@ class DownloadManager:
                 return None
             return choice
 
+    def _audio_preselect_dialog(
+        self,
+        *,
+        item_id=None,
+        audios: list[dict],
+        preselected: list[int] | None = None,
+        cancel_event=None,
+    ):
+        # Выбор дорожек ДО скачивания (политика аудио с ask=True). Вызывается из рабочего потока.
+        if not audios or len(audios) < 2:
+            return None
+        if not self.root:
+            return None
+
+        with _AUDIO_SELECT_LOCK:
+            result = {"choice": None}
+            done = threading.Event()
+            win_ref = {"win": None}
+
+            def _safe_close(choice):
+                result["choice"] = choice
+                done.set()
+                try:
+                    w = win_ref.get("win")
+                    if w is not None and w.winfo_exists():
+                        try:
+                            w.grab_release()
+                        except Exception:
+                            pass
+                        w.destroy()
+                except Exception:
+                    pass
+
+            def _open():
+                try:
+                    title_text = ""
+                    try:
+                        if item_id is not None and hasattr(self.tree, "exists") and self.tree.exists(item_id):
+                            title_text = str(self.tree.set(item_id, "title") or "")
+                    except Exception:
+                        title_text = ""
+
+                    w = tk.Toplevel(self.root)
+                    win_ref["win"] = w
+                    w.title("Аудиодорожки для загрузки")
+                    w.transient(self.root)
+                    w.grab_set()
+                    w.resizable(True, True)
+                    try:
+                        w.geometry("640x460")
+                        w.minsize(520, 360)
+                        w.update_idletasks()
+                        w.lift()
+                        w.focus_force()
+                    except Exception:
+                        pass
+
+                    frame = ttk.Frame(w, padding=12)
+                    frame.pack(fill="both", expand=True)
+
+                    ttk.Label(
+                        frame,
+                        text="Какие аудиодорожки скачать?",
+                        font=("Segoe UI Semibold", 12),
+                    ).pack(anchor="w")
+                    if title_text:
+                        ttk.Label(frame, text=title_text, font=("Segoe UI", 10)).pack(anchor="w", pady=(2, 10))
+
+                    lb_frame = ttk.Frame(frame)
+                    lb_frame.pack(fill="both", expand=True)
+                    lb_scroll = ttk.Scrollbar(lb_frame, orient="vertical")
+                    lb_scroll.pack(side="right", fill="y")
+                    lb = tk.Listbox(lb_frame, exportselection=False, height=14, selectmode="multiple")
+                    lb.pack(side="left", fill="both", expand=True)
+                    try:
+                        lb.configure(yscrollcommand=lb_scroll.set)
+                        lb_scroll.configure(command=lb.yview)
+                    except Exception:
+                        pass
+                    for i, a in enumerate(audios, start=1):
+                        n = (a.get("name") or f"Audio {i}").strip()
+                        l = (a.get("lang") or "und").strip()
+                        mark = " • default" if a.get("default") else ""
+                        lb.insert("end", f"{i}. {n} [{l}]{mark}")
+                    for i in (preselected or []):
+                        try:
+                            lb.selection_set(int(i))
+                        except Exception:
+                            pass
+
+                    def _selected():
+                        try:
+                            sel = [int(x) for x in lb.curselection()]
+                        except Exception:
+                            sel = []
+                        _safe_close(sel or None)
+
+                    btn_row = ttk.Frame(frame)
+                    btn_row.pack(fill="x", pady=(10, 0))
+                    ttk.Button(btn_row, text="Скачать выбранные", command=_selected).pack(side="right")
+                    ttk.Button(btn_row, text="Все", command=lambda: _safe_close(list(range(len(audios))))).pack(
+                        side="right", padx=(0, 8)
+                    )
+                    ttk.Button(btn_row, text="Отмена", command=lambda: _safe_close("cancel")).pack(
+                        side="right", padx=(0, 8)
+                    )
+                    try:
+                        w.bind("<Return>", lambda _e: _selected())
+                        w.bind("<Escape>", lambda _e: _safe_close("cancel"))
+                    except Exception:
+                        pass
+                    w.protocol("WM_DELETE_WINDOW", lambda: _safe_close("cancel"))
+                except Exception:
+                    _safe_close(None)
+
+            try:
+                self._ui(_open)
+            except Exception:
+                return None
+
+            while not done.is_set():
+                if cancel_event is not None and getattr(cancel_event, "is_set", lambda: False)():
+                    try:
+                        self._ui(_safe_close, "cancel")
+                    except Exception:
+                        _safe_close("cancel")
+                    break
+                done.wait(timeout=0.2)
+
+            return result.get("choice")
+
     # ---------- утилиты UI ----------
     def _dispatcher(self):
         logging.info("Dispatcher thread started")
@@ -594,6 +749,87 @@ class DownloadManager:
             except Exception:
                 logging.exception("Ошибка в dispatcher")
 
+    def _next_lookahead_item(self):
+        """Первая по порядку строк ожидающая задача (в пределах LOOKAHEAD_DEPTH), которую ещё не разбирали."""
+        if self.stop_flag:
+            return None, None
+        try:
+            with self.lock:
+                pending = set(self._pending_tasks)
+        except Exception:
+            pending = set()
+        if not pending:
+            return None, None
+
+        order = self._ui_call_sync(lambda: list(self.tree.get_children("")), default=[]) or []
+        seen = 0
+        for iid in order:
+            if iid not in pending:
+                continue
+            seen += 1
+            if seen > LOOKAHEAD_DEPTH:
+                break
+            url = str(self.url_by_item.get(iid) or "")
+            if not url.startswith("http"):
+                continue
+            with self.lock:
+                if iid in self._lookahead_inflight or self._lookahead_done.get(iid) == url:
+                    continue
+                fail = self._lookahead_fails.get(iid)
+                if fail and fail[0] == url and time.time() < fail[2]:
+                    continue
+            if not self.can_start(iid):
+                continue
+            with self.lock:
+                self._lookahead_inflight.add(iid)
+            return iid, url
+        return None, None
+
+    def _lookahead_loop(self):
+        """Отдельная стадия конвейера: браузерная работа (разбор HLS) наперёд, скачивание — в _worker."""
+        while not self._shutdown.is_set():
+            try:
+                item_id, url = self._next_lookahead_item()
+            except Exception:
+                item_id, url = None, None
+            if item_id is None:
+                self._shutdown.wait(1.0)
+                continue
+
+            ok = False
+            drv = None
+            try:
+                ev = self.cancel_events.get(item_id)
+                name_override = self.name_override_by_item.get(item_id)
+                # сначала без браузера; браузер — только свободный из пула, новых не создаём
+                item_url = split_clip(url)[0]
+                ok = prepare(item_url, driver=None, cancel_event=ev, display_name_override=name_override)
+                if not ok and self.pool is not None and hasattr(self.pool, "try_acquire"):
+                    drv = self.pool.try_acquire()
+                    if drv is not None:
+                        ok = prepare(item_url, driver=drv, cancel_event=ev, display_name_override=name_override)
+            except Exception:
+                logging.exception("Ошибка look-ahead разбора HLS")
+            finally:
+                if drv is not None:
+                    try:
+                        self.pool.release(drv)
+                    except Exception:
+                        pass
+                with self.lock:
+                    self._lookahead_inflight.discard(item_id)
+                    # временная неудача (CF, сеть, занятый пул) — повторим позже, но не бесконечно
+                    fail = self._lookahead_fails.pop(item_id, None)
+                    n = fail[1] + 1 if fail and fail[0] == url else 1
+                    if ok or n >= LOOKAHEAD_MAX_TRIES:
+                        self._lookahead_done[item_id] = url
+                    else:
+                        self._lookahead_fails[item_id] = (url, n, time.time() + LOOKAHEAD_RETRY_DELAY)
+                    still_pending = item_id in self._pending_tasks
+
+            if ok and still_pending and self._tree_get_status(item_id).startswith("🟡"):
+                self.set_status(item_id, "🟡 Ожидает... (HLS готов)")
+
     def _ui(self, func, *args, **kwargs):
         try:
             self.root.after(0, lambda: func(*args, **kwargs))
@@ -717,10 +953,33 @@ class DownloadManager:
         except Exception:
             pass
 
+    def _set_video_progress(self, item_id, status: str | None):
+        try:
+            with self.lock:
+                if status:
+                    self._video_status_by_item[item_id] = status
+                else:
+                    self._video_status_by_item.pop(item_id, None)
+        except Exception:
+            pass
+
+    def _combined_status(self, item_id) -> str | None:
+        """Видео и аудио одной строкой, если они качаются одновременно."""
+        try:
+            with self.lock:
+                video = self._video_status_by_item.get(item_id)
+        except Exception:
+            video = None
+        audio = self._audio_summary_status(item_id)
+        if video and audio:
+            return f"{video} • {audio.replace('🔵 ', '', 1)}"
+        return video or audio
+
     def _clear_audio_progress(self, item_id):
         try:
             with self.lock:
                 self._audio_progress_by_item.pop(item_id, None)
+                self._video_status_by_item.pop(item_id, None)
         except Exception:
             pass
 
@@ -1208,6 +1467,8 @@ class DownloadManager:
             return
 
         detected = {"name": None}
+        # «…#t=начало,конец» — качаем только отрезок; url (с суффиксом) остаётся для истории/очереди
+        item_url, clip = split_clip(url)
 
         def _slot_already_released() -> bool:
             try:
@@ -1251,22 +1512,41 @@ class DownloadManager:
                     self.set_status(item_id, f"♻️ Повтор {attempt}/{max_attempts} через {int(delay)}с…")
                     time.sleep(delay)
 
-                # ждём браузер из пула (может занять время) — это ещё не «качает»
-                self.set_status(item_id, "⏳ Ожидаю браузер…")
-
                 drv = None
                 driver_returned = False
                 last_err_text = ""
 
-                if self.pool:
-                    drv = self.pool.acquire()
-                else:
-                    drv = _safe_get_driver(
-                        status_cb=lambda m: print(m),
-                        headless=False,
-                        suppress=True,
-                        need_login_hint=False,
-                    )
+                # look-ahead как раз разбирает этот элемент — дождёмся его, а не разбираем второй раз
+                t_wait = time.time()
+                while item_id in self._lookahead_inflight and time.time() - t_wait < 45:
+                    if cancel_event and cancel_event.is_set():
+                        break
+                    time.sleep(0.2)
+
+                # HLS уже разобран (look-ahead/повтор) и ссылки живы — браузер не нужен, качаем сразу
+                # (проверка ссылок — сетевой запрос: результат передаём в download, второй раз не проверяем)
+                resolved = None
+                if str(item_url).startswith("http"):
+                    try:
+                        from kino_hls import _resolved_cache_get
+
+                        resolved = _resolved_cache_get(item_url, cancel_event=cancel_event)
+                    except Exception:
+                        resolved = None
+                prepared = bool(resolved)
+
+                if not prepared:
+                    # ждём браузер из пула (может занять время) — это ещё не «качает»
+                    self.set_status(item_id, "⏳ Ожидаю браузер…")
+                    if self.pool:
+                        drv = self.pool.acquire()
+                    else:
+                        drv = _safe_get_driver(
+                            status_cb=lambda m: print(m),
+                            headless=False,
+                            suppress=True,
+                            need_login_hint=False,
+                        )
 
                 # начинаем активную сетевую работу (как только получили браузер)
                 if not active_started:
@@ -1343,11 +1623,12 @@ class DownloadManager:
                                 # С этого момента идёт реальная загрузка сегментов — драйвер больше не нужен
                                 _return_driver_to_pool()
                                 if kind == "Видео":
-                                    self._clear_audio_progress(item_id)
+                                    # аудио может качаться одновременно — его строки не трогаем
                                     status = f"🔵 Видео {pct}%"
                                     if speed:
                                         status = f"{status} {speed}"
-                                    self.set_status(item_id, status)
+                                    self._set_video_progress(item_id, status if pct < 100 else None)
+                                    self.set_status(item_id, self._combined_status(item_id) or status)
                                 else:
                                     idx_int = None
                                     total_int = None
@@ -1397,7 +1678,7 @@ class DownloadManager:
                                             )
                                             self._set_audio_child_row(item_id, idx_int, child_title, child_status)
 
-                                        summary = self._audio_summary_status(item_id)
+                                        summary = self._combined_status(item_id)
                                         self.set_status(item_id, summary or "🔵 Аудио…")
                                     else:
                                         self.set_status(item_id, f"🔵 Аудио {pct}%")
@@ -1413,8 +1694,8 @@ class DownloadManager:
                                 a_i = m0.group(2)
                                 a_total = m0.group(3)
                                 if kind == "Видео":
-                                    self._clear_audio_progress(item_id)
-                                    self.set_status(item_id, "🔵 Видео…")
+                                    self._set_video_progress(item_id, "🔵 Видео…")
+                                    self.set_status(item_id, self._combined_status(item_id) or "🔵 Видео…")
                                 else:
                                     extra = (m0.group(4) or "").strip()
 
@@ -1459,7 +1740,7 @@ class DownloadManager:
                                             status=child_status,
                                         )
                                         self._set_audio_child_row(item_id, idx_int, child_title, child_status)
-                                        summary = self._audio_summary_status(item_id)
+                                        summary = self._combined_status(item_id)
                                         self.set_status(item_id, summary or "🔵 Аудио…")
                                     else:
                                         self.set_status(item_id, "🔵 Аудио…")
@@ -1549,6 +1830,12 @@ class DownloadManager:
                         return None
                     return cb(item_id=item_id, **kwargs)
 
+                def _audio_preselect_proxy(**kwargs):
+                    cb = getattr(self, "audio_preselect_cb", None)
+                    if not callable(cb):
+                        return None
+                    return cb(item_id=item_id, **kwargs)
+
                 try:
                     auto_convert = bool(getattr(self.root, "_kino_auto_convert_all_audio", False))
                 except Exception:
@@ -1569,7 +1856,7 @@ class DownloadManager:
                     audio_parallel_tracks = 1
 
                 ok = download(
-                    url,
+                    item_url,
                     out_dir,
                     status_cb=_status_proxy,
                     driver=drv,
@@ -1578,6 +1865,9 @@ class DownloadManager:
                     defer_mux=(not auto_convert),
                     display_name_override=name_override,
                     audio_parallel_tracks=audio_parallel_tracks,
+                    audio_preselect_cb=_audio_preselect_proxy,
+                    clip=clip,
+                    resolved=resolved,
                 )
 
                 # если драйвер ещё у нас — вернём/закроем
@@ -1796,6 +2086,8 @@ class DownloadManager:
         # сбрасываем возможный прошлый флаг
         with self.lock:
             self._slot_released.discard(item_id)
+            self._lookahead_done.pop(item_id, None)
+            self._lookahead_fails.pop(item_id, None)
 
         self._enqueue_task(item_id, url, out_dir)
         self.set_status(item_id, "🟡 Ожидает...")
@@ -0,0 +1,284 @@
+"""
+Разбор HLS-плейлистов (master и media) в компактные структуры.
+Один проход по строкам, атрибуты тегов — одной скомпилированной регуляркой.
+Результат кэшируется по (base_url, текст): один и тот же плейлист за время обработки тайтла
+разбирается один раз (sniff → выбор варианта → скачивание потоков).
+"""
+
+import collections
+import hashlib
+import re
+import threading
+import urllib.parse
+from typing import NamedTuple
+
+# KEY=VALUE, KEY="VALUE" (в кавычках могут быть запятые), KEY=0x...
+_ATTR_RE = re.compile(r'([A-Z0-9-]+)=("[^"]*"|[^",]*)')
+_RES_RE = re.compile(r"^(\d+)x(\d+)$")
+
+PARSE_CACHE_MAX = 64  # разобранных плейлистов в памяти
+
+
+class Variant(NamedTuple):
+    uri: str
+    bandwidth: int
+    avg_bandwidth: int
+    width: int
+    height: int
+    codecs: str
+    audio: str | None  # GROUP-ID аудио-рендишенов
+    frame_rate: float
+
+
+class Rendition(NamedTuple):
+    type: str  # AUDIO / SUBTITLES / VIDEO / CLOSED-CAPTIONS
+    group_id: str
+    name: str
+    lang: str
+    uri: str | None
+    default: bool
+    autoselect: bool
+    channels: str
+
+
+class Key(NamedTuple):
+    method: str  # NONE / AES-128 / SAMPLE-AES
+    uri: str | None
+    iv: str | None
+
+
+class ByteRange(NamedTuple):
+    offset: int
+    length: int
+
+
+class InitSection(NamedTuple):
+    uri: str
+    byterange: ByteRange | None
+
+
+class Segment(NamedTuple):
+    uri: str
+    duration: float
+    byterange: ByteRange | None
+    key: Key | None
+    init: InitSection | None  # EXT-X-MAP (fMP4)
+    discontinuity: bool
+    seq: int  # номер по EXT-X-MEDIA-SEQUENCE
+
+
+class MasterPlaylist(NamedTuple):
+    variants: list[Variant]
+    renditions: list[Rendition]
+
+    def audio_group(self, group_id: str | None) -> list[Rendition]:
+        return [r for r in self.renditions if r.type == "AUDIO" and r.uri and (group_id is None or r.group_id == group_id)]
+
+
+class MediaPlaylist(NamedTuple):
+    segments: list[Segment]
+    target_duration: float
+    media_sequence: int
+    endlist: bool
+
+    @property
+    def duration(self) -> float:
+        return sum(s.duration for s in self.segments)
+
+
+def parse_attributes(value: str) -> dict[str, str]:
+    """Список атрибутов тега → dict (кавычки сняты)."""
+    out = {}
+    for k, v in _ATTR_RE.findall(value or ""):
+        if len(v) >= 2 and v[0] == '"' and v[-1] == '"':
+            v = v[1:-1]
+        out[k] = v
+    return out
+
+
+def _int(v, default: int = 0) -> int:
+    try:
+        return int(v)
+    except Exception:
+        return default
+
+
+def _float(v, default: float = 0.0) -> float:
+    try:
+        return float(v)
+    except Exception:
+        return default
+
+
+def _byterange(value: str, prev_end: int) -> ByteRange | None:
+    """'<n>[@<o>]'; без @o — продолжение сразу за предыдущим диапазоном того же файла."""
+    try:
+        n, _, o = (value or "").strip().partition("@")
+        return ByteRange(int(o) if o else prev_end, int(n))
+    except Exception:
+        return None
+
+
+def is_master(text: str) -> bool:
+    return "#EXT-X-STREAM-INF" in (text or "")
+
+
+def _parse_master(text: str, base_url: str) -> MasterPlaylist:
+    variants: list[Variant] = []
+    renditions: list[Rendition] = []
+    pending = None
+    for raw in text.splitlines():
+        ln = raw.strip()
+        if not ln:
+            continue
+        if ln[0] != "#":
+            if pending is not None:
+                a = pending
+                w = h = 0
+                m = _RES_RE.match(a.get("RESOLUTION", ""))
+                if m:
+                    w, h = int(m.group(1)), int(m.group(2))
+                variants.append(Variant(
+                    urllib.parse.urljoin(base_url, ln),
+                    _int(a.get("BANDWIDTH")),
+                    _int(a.get("AVERAGE-BANDWIDTH")),
+                    w,
+                    h,
+                    a.get("CODECS", ""),
+                    a.get("AUDIO"),
+                    _float(a.get("FRAME-RATE")),
+                ))
+                pending = None
+            continue
+        tag, _, value = ln.partition(":")
+        if tag == "#EXT-X-STREAM-INF":
+            pending = parse_attributes(value)
+        elif tag == "#EXT-X-MEDIA":
+            a = parse_attributes(value)
+            uri = a.get("URI")
+            renditions.append(Rendition(
+                a.get("TYPE", ""),
+                a.get("GROUP-ID", ""),
+                a.get("NAME", ""),
+                a.get("LANGUAGE", ""),
+                urllib.parse.urljoin(base_url, uri) if uri else None,
+                a.get("DEFAULT") == "YES",
+                a.get("AUTOSELECT") == "YES",
+                a.get("CHANNELS", ""),
+            ))
+    return MasterPlaylist(variants, renditions)
+
+
+def _parse_media(text: str, base_url: str) -> MediaPlaylist:
+    segments: list[Segment] = []
+    target = 0.0
+    seq0 = 0
+    endlist = False
+    duration = 0.0
+    byterange_value = None
+    discontinuity = False
+    key: Key | None = None
+    init: InitSection | None = None
+    prev_end: dict[str, int] = {}  # uri → конец последнего диапазона (для BYTERANGE без @offset)
+    for raw in text.splitlines():
+        ln = raw.strip()
+        if not ln:
+            continue
+        if ln[0] != "#":
+            uri = urllib.parse.urljoin(base_url, ln)
+            br = None
+            if byterange_value is not None:
+                br = _byterange(byterange_value, prev_end.get(uri, 0))
+                if br is not None:
+                    prev_end[uri] = br.offset + br.length
+            segments.append(Segment(uri, duration, br, key, init, discontinuity, seq0 + len(segments)))
+            duration = 0.0
+            byterange_value = None
+            discontinuity = False
+            continue
+        tag, _, value = ln.partition(":")
+        if tag == "#EXTINF":
+            duration = _float(value.split(",", 1)[0])
+        elif tag == "#EXT-X-BYTERANGE":
+            byterange_value = value
+        elif tag == "#EXT-X-DISCONTINUITY":
+            discontinuity = True
+        elif tag == "#EXT-X-KEY":
+            a = parse_attributes(value)
+            method = a.get("METHOD", "NONE")
+            uri = a.get("URI")
+            key = None if method == "NONE" else Key(method, urllib.parse.urljoin(base_url, uri) if uri else None, a.get("IV"))
+        elif tag == "#EXT-X-MAP":
+            a = parse_attributes(value)
+            uri = a.get("URI")
+            if uri:
+                br = _byterange(a["BYTERANGE"], 0) if a.get("BYTERANGE") else None
+                init = InitSection(urllib.parse.urljoin(base_url, uri), br)
+        elif tag == "#EXT-X-TARGETDURATION":
+            target = _float(value)
+        elif tag == "#EXT-X-MEDIA-SEQUENCE":
+            seq0 = _int(value)
+        elif tag == "#EXT-X-ENDLIST":
+            endlist = True
+    return MediaPlaylist(segments, target, seq0, endlist)
+
+
+_CACHE: "collections.OrderedDict[tuple, MasterPlaylist | MediaPlaylist]" = collections.OrderedDict()
+_CACHE_LOCK = threading.Lock()
+
+
+def _cached(kind: str, text: str, base_url: str, fn):
+    key = (kind, base_url, hashlib.sha1((text or "").encode("utf-8", "ignore")).digest())
+    with _CACHE_LOCK:
+        hit = _CACHE.get(key)
+        if hit is not None:
+            _CACHE.move_to_end(key)
+            return hit
+    res = fn(text or "", base_url)
+    with _CACHE_LOCK:
+        _CACHE[key] = res
+        while len(_CACHE) > PARSE_CACHE_MAX:
+            _CACHE.popitem(last=False)
+    return res
+
+
+def parse_master(text: str, base_url: str = "") -> MasterPlaylist:
+    """Варианты (EXT-X-STREAM-INF) и рендишены (EXT-X-MEDIA) с абсолютными URI."""
+    return _cached("master", text, base_url, _parse_master)
+
+
+def parse_media(text: str, base_url: str = "") -> MediaPlaylist:
+    """Сегменты с длительностью, BYTERANGE, ключом, EXT-X-MAP и разрывами; URI абсолютные."""
+    return _cached("media", text, base_url, _parse_media)
+
+
+def segment_parts(media: MediaPlaylist, segments: list[Segment] | None = None) -> list[tuple[str, ByteRange | None]]:
+    """(URI, диапазон) к скачиванию по порядку: init-секция (EXT-X-MAP) перед первым своим сегментом, затем сегменты."""
+    out = []
+    last_init = None
+    for s in media.segments if segments is None else segments:
+        if s.init is not None and s.init != last_init:
+            out.append((s.init.uri, s.init.byterange))
+            last_init = s.init
+        out.append((s.uri, s.byterange))
+    return out
+
+
+def clip_segments(media: MediaPlaylist, start: float, end: float) -> tuple[list[Segment], float]:
+    """
+    Сегменты, покрывающие отрезок [start, end) по длительностям EXTINF, и сдвиг:
+    на сколько секунд начало первого из них раньше start (его отрезает ffmpeg).
+    """
+    out: list[Segment] = []
+    lead = 0.0
+    t = 0.0
+    for s in media.segments:
+        seg_end = t + s.duration
+        if seg_end > start and t < end:
+            if not out:
+                lead = max(0.0, start - t)
+            out.append(s)
+        elif t >= end:
+            break
+        t = seg_end
+    return out, lead
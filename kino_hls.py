@@ -1,8 +1,12 @@
+import collections
+import heapq
+import http.client
 import json
 import os
 import random
 import re
 import shlex
+import ssl
 import subprocess as sp
 import time
 import urllib.parse
@@ -10,6 +14,8 @@ import urllib.request
 import shutil
 import threading  # ← просто импорт, без глобального семафора
 
+import hls_playlist
+
 if os.name == "nt":
     CREATE_NO_WINDOW = 0x08000000
 else:
@@ -18,8 +24,9 @@ else:
 _FFMPEG_LOCK = threading.Lock()  # пока про запас, если захочешь синхронизировать только лог-файлы
 MUX_MAX_PARALLEL = 4  # максимум одновременных MUX (ffmpeg)
 _MUX_SEMA = threading.Semaphore(MUX_MAX_PARALLEL)
-HLS_SEGMENT_MAX_PARALLEL = 16  # общий лимит одновременных запросов сегментов (стабильность)
-_HLS_SEGMENT_SEMA = threading.Semaphore(HLS_SEGMENT_MAX_PARALLEL)
+HLS_INFLIGHT_PER_WORKER = 2  # окно отправки: сколько сегментов в полёте на одного воркера
+HLS_STREAM_BUFFER_MAX_BYTES = 64 * 1024 * 1024  # reorder-буфер одного потока (байт)
+HLS_TOTAL_BUFFER_MAX_BYTES = 256 * 1024 * 1024  # reorder-буферы всех потоков процесса (байт)
 _CF_SOLVE_LOCK = threading.Lock()  # показываем окно CF только одно за раз
 
 
@@ -72,6 +79,223 @@ def _augment_headers(headers: dict) -> tuple[str, dict]:
     return hdr_str, h
 
 
+# --- HTTP: общий пул keep-alive соединений (плейлисты + сегменты) ---
+HLS_POOL_MAX_PER_HOST = 16  # максимум одновременных сокетов на один CDN-хост
+HLS_POOL_IDLE_TTL = 30.0  # сколько держим простаивающее соединение (сек)
+_HTTP_REDIRECT_CODES = (301, 302, 303, 307, 308)
+_HTTP_STALE_ERRORS = (
+    http.client.RemoteDisconnected,
+    http.client.BadStatusLine,
+    http.client.CannotSendRequest,
+    ConnectionResetError,
+    ConnectionAbortedError,
+    BrokenPipeError,
+)
+
+
+def _make_ssl_context() -> ssl.SSLContext:
+    """Гибкий SSL (TLS1.2/1.3, игнор неожиданных EOF, ослабленный seclevel)."""
+    ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    ctx.check_hostname = False
+    ctx.verify_mode = ssl.CERT_NONE
+    try:
+        ctx.set_ciphers("DEFAULT:@SECLEVEL=1")
+    except Exception:
+        pass
+    if hasattr(ssl, "OP_IGNORE_UNEXPECTED_EOF"):
+        ctx.options |= ssl.OP_IGNORE_UNEXPECTED_EOF
+    return ctx
+
+
+# Один контекст на процесс: TLS-сессии переиспользуются, а не собираются на каждый сегмент.
+_SSL_CTX = _make_ssl_context()
+
+
+class HttpStatusError(RuntimeError):
+    """Не-2xx ответ сервера (совместим по полям code/headers с urllib.error.HTTPError)."""
+
+    def __init__(self, code: int, headers=None, url: str = ""):
+        super().__init__(f"HTTP {code}")
+        self.code = int(code or 0)
+        self.headers = headers
+        self.url = url
+
+
+def _close_quietly(conn) -> None:
+    try:
+        conn.close()
+    except Exception:
+        pass
+
+
+class _HostPool:
+    """Keep-alive соединения к одному хосту + ограничение числа сокетов на хост."""
+
+    def __init__(self, scheme: str, netloc: str, limit: int):
+        self.scheme = scheme
+        self.netloc = netloc
+        self.slots = threading.BoundedSemaphore(max(1, int(limit)))
+        self.idle: list[tuple[http.client.HTTPConnection, float]] = []
+        self.lock = threading.Lock()
+
+    def _new_conn(self, timeout: float) -> http.client.HTTPConnection:
+        if self.scheme == "https":
+            return http.client.HTTPSConnection(self.netloc, timeout=timeout, context=_SSL_CTX)
+        return http.client.HTTPConnection(self.netloc, timeout=timeout)
+
+    def take(self, timeout: float) -> tuple[http.client.HTTPConnection, bool]:
+        """Возвращает (conn, reused). Просроченные idle-соединения закрываем."""
+        now = time.time()
+        with self.lock:
+            while self.idle:
+                conn, ts = self.idle.pop()
+                if now - ts > HLS_POOL_IDLE_TTL or conn.sock is None:
+                    _close_quietly(conn)
+                    continue
+                try:
+                    conn.timeout = timeout
+                    conn.sock.settimeout(timeout)
+                except Exception:
+                    _close_quietly(conn)
+                    continue
+                return conn, True
+        return self._new_conn(timeout), False
+
+    def give_back(self, conn: http.client.HTTPConnection) -> None:
+        with self.lock:
+            self.idle.append((conn, time.time()))
+
+
+_HOST_POOLS: dict[tuple[str, str], _HostPool] = {}
+_HOST_POOLS_LOCK = threading.Lock()
+
+
+def _host_pool(scheme: str, netloc: str) -> _HostPool:
+    key = (scheme, netloc.lower())
+    with _HOST_POOLS_LOCK:
+        pool = _HOST_POOLS.get(key)
+        if pool is None:
+            pool = _HostPool(scheme, netloc, HLS_POOL_MAX_PER_HOST)
+            _HOST_POOLS[key] = pool
+        return pool
+
+
+HLS_PROXY_CHECK_TTL = 60.0  # как часто перечитывать системный прокси (на Windows это чтение реестра), сек
+_PROXY_STATE: dict[str, tuple[float, bool]] = {}  # scheme -> (когда проверяли, прокси задан)
+
+
+def _proxy_configured(scheme: str) -> bool:
+    # зовётся на каждый сегмент — держим ответ HLS_PROXY_CHECK_TTL, а не читаем окружение/реестр каждый раз
+    now = time.time()
+    hit = _PROXY_STATE.get(scheme)
+    if hit is not None and now - hit[0] < HLS_PROXY_CHECK_TTL:
+        return hit[1]
+    try:
+        on = bool(urllib.request.getproxies().get(scheme))
+    except Exception:
+        on = False
+    _PROXY_STATE[scheme] = (now, on)
+    return on
+
+
+def _http_request_urllib(url: str, headers: dict, *, method: str, timeout: float):
+    """Запасной путь через urllib (системный прокси), тот же SSL-контекст."""
+    import urllib.error
+
+    req = urllib.request.Request(url, headers=headers or {}, method=method)
+    try:
+        with urllib.request.urlopen(req, timeout=timeout, context=_SSL_CTX) as r:
+            code = int(getattr(r, "status", 200) or 0)
+            body = r.read()
+            if 200 <= code < 300:
+                return code, r.headers, body
+            raise HttpStatusError(code, r.headers, url)
+    except urllib.error.HTTPError as e:
+        raise HttpStatusError(int(getattr(e, "code", 0) or 0), getattr(e, "headers", None), url)
+
+
+def _http_request(
+    url: str,
+    headers: dict,
+    *,
+    method: str = "GET",
+    timeout: float = 15,
+    cancel_event=None,
+    max_redirects: int = 5,
+    size_cb=None,
+):
+    """
+    Один HTTP-запрос через пул keep-alive соединений.
+    Возвращает (status, headers, body) для 2xx, иначе поднимает HttpStatusError.
+    Редиректы проходим сами; «протухшее» keep-alive соединение пересоздаём один раз.
+    size_cb(n) — Content-Length 2xx-ответа, как только пришли заголовки (до чтения тела).
+    """
+    hdict = dict(headers or {})
+    for _ in range(max(0, int(max_redirects)) + 1):
+        _raise_if_cancelled(cancel_event)
+        u = urllib.parse.urlsplit(url)
+        scheme = (u.scheme or "").lower()
+        if scheme not in ("http", "https") or not u.netloc:
+            raise ValueError(f"Unsupported URL: {url}")
+
+        if _proxy_configured(scheme):
+            return _http_request_urllib(url, hdict, method=method, timeout=timeout)
+
+        path = (u.path or "/") + (f"?{u.query}" if u.query else "")
+        pool = _host_pool(scheme, u.netloc)
+
+        # слот на хост: ждём кооперативно, чтобы отмена не зависала
+        while not pool.slots.acquire(timeout=0.2):
+            _raise_if_cancelled(cancel_event)
+        try:
+            for fresh_try in (False, True):
+                conn, reused = pool.take(timeout)
+                if fresh_try and reused:
+                    _close_quietly(conn)
+                    conn, reused = pool._new_conn(timeout), False
+                try:
+                    conn.request(method, path, headers=hdict)
+                    resp = conn.getresponse()
+                    if size_cb is not None and 200 <= resp.status < 300:
+                        cl = resp.getheader("Content-Length") or ""
+                        if cl.isdigit():
+                            try:
+                                size_cb(int(cl))
+                            except Exception:
+                                pass
+                    body = resp.read()
+                except _HTTP_STALE_ERRORS:
+                    _close_quietly(conn)
+                    if reused and not fresh_try:
+                        continue
+                    raise
+                except BaseException:
+                    _close_quietly(conn)
+                    raise
+
+                if resp.will_close:
+                    _close_quietly(conn)
+                else:
+                    pool.give_back(conn)
+                break
+        finally:
+            pool.slots.release()
+
+        code = int(resp.status or 0)
+        if code in _HTTP_REDIRECT_CODES:
+            loc = resp.getheader("Location")
+            if loc:
+                url = urllib.parse.urljoin(url, loc)
+                if code == 303:
+                    method = "GET"
+                continue
+        if 200 <= code < 300:
+            return code, resp.headers, body
+        raise HttpStatusError(code, resp.headers, url)
+
+    raise HttpStatusError(310, None, url)
+
+
 def _running_inside_vscode() -> bool:
     # VS Code ставит эти переменные окружения
     return (
@@ -79,19 +303,23 @@ def _running_inside_vscode() -> bool:
         or os.environ.get("TERM_PROGRAM") == "vscode"
     )
 
+def _ffmpeg_path(ffmpeg_bin: str | None = None) -> str:
+    """Рабочий путь к ffmpeg: заданный, из PATH или рядом с программой."""
+    ffmpeg_bin = ffmpeg_bin or FFMPEG_BIN
+    if os.path.isfile(ffmpeg_bin):
+        return ffmpeg_bin
+    alt = shutil.which("ffmpeg")
+    if alt:
+        return alt
+    local_ff = os.path.join(os.path.dirname(__file__), "ffmpeg", "ffmpeg.exe")
+    if os.path.isfile(local_ff):
+        return local_ff
+    raise FileNotFoundError(f"⚠️ ffmpeg не найден: {ffmpeg_bin}")
+
+
 def _run_ffmpeg(cmd, cancel_event=None, status_cb=None) -> int:
     """Безопасный запуск ffmpeg — без окна, лог в уникальный файл, stdin отключён."""
-    ffmpeg_bin = cmd[0]
-    if not os.path.isfile(ffmpeg_bin):
-        alt = shutil.which("ffmpeg")
-        if alt:
-            cmd[0] = alt
-        else:
-            local_ff = os.path.join(os.path.dirname(__file__), "ffmpeg", "ffmpeg.exe")
-            if os.path.isfile(local_ff):
-                cmd[0] = local_ff
-            else:
-                raise FileNotFoundError(f"⚠️ ffmpeg не найден: {ffmpeg_bin}")
+    cmd[0] = _ffmpeg_path(cmd[0])
 
     def _fmt_hms(seconds: float) -> str:
         try:
@@ -405,6 +633,28 @@ def _ensure_shown(driver):
 
 
 
+_CHALLENGE_HTML_NEEDLES = (
+    "/cdn-cgi/challenge-platform/",
+    "cf-challenge",
+    "cf_chl_",
+    "cf-please-wait",
+    "cf-turnstile",
+    "challenges.cloudflare.com/turnstile/",
+    "g-recaptcha",
+    "hcaptcha",
+    "data-sitekey",
+    "just a moment",
+    "checking your browser",
+    "attention required",
+)
+
+
+def _html_has_challenge(html: str) -> bool:
+    """Признаки капчи/Cloudflare в HTML (для страниц, полученных без браузера)."""
+    html = (html or "").lower()
+    return any(n in html for n in _CHALLENGE_HTML_NEEDLES)
+
+
 def _has_challenge(driver) -> bool:
     """Есть ли капча/Cloudflare на странице."""
     try:
@@ -436,21 +686,7 @@ def _has_challenge(driver) -> bool:
     if any(n in title for n in title_needles):
         return True
 
-    html_needles = (
-        "/cdn-cgi/challenge-platform/",
-        "cf-challenge",
-        "cf_chl_",
-        "cf-please-wait",
-        "cf-turnstile",
-        "challenges.cloudflare.com/turnstile/",
-        "g-recaptcha",
-        "hcaptcha",
-        "data-sitekey",
-        "just a moment",
-        "checking your browser",
-        "attention required",
-    )
-    if any(n in html for n in html_needles):
+    if _html_has_challenge(html):
         return True
     try:
         return bool(
@@ -592,47 +828,360 @@ def set_reencode(enabled: bool):
     ENABLE_REENCODE = bool(enabled)
 
 
+# Раскладка итогового MP4:
+#   "faststart"  — moov в начале; ffmpeg после MUX переписывает весь файл ещё раз (нужно старым плеерам/ТВ);
+#   "fragmented" — фрагменты по ключевым кадрам и пустой moov сразу в начале: один проход записи.
+MP4_OUTPUT_MODES = ("faststart", "fragmented")
+MP4_OUTPUT_MODE = "faststart"
 
-def _inject_m3u8_sniffer_js(driver):
-    """Инъекция перехватчика fetch/XHR, сохраняет URL .m3u8 в window.__m3u8"""
-    js = r"""
-    (function(){
+_MP4_MOVFLAGS = {
+    "faststart": "+faststart",
+    "fragmented": "+frag_keyframe+empty_moov+default_base_moof",
+}
+
+
+def set_mp4_output_mode(mode: str):
+    """Глобальная настройка: раскладка итогового MP4 (faststart или fragmented)."""
+    global MP4_OUTPUT_MODE
+    mode = str(mode or "").strip().lower()
+    if mode in MP4_OUTPUT_MODES:
+        MP4_OUTPUT_MODE = mode
+
+
+# === Кодировщик видео при перекодировании ===
+# "auto" — один раз проверяем, какие кодировщики есть и реально работают на этой машине
+# (аппаратные, затем libx264), замеряем короткий тестовый энкод и берём самый быстрый;
+# если не работает ни один — MUX без перекодирования (copy). Результат — в settings.json.
+HLS_ENCODER = "auto"
+HLS_ENCODER_CANDIDATES = ("h264_nvenc", "h264_qsv", "h264_amf", "libx264")
+HLS_ENCODER_BENCH_SECONDS = 3  # длительность тестового ролика (lavfi testsrc2, 1080p)
+HLS_ENCODER_BENCH_TIMEOUT = 30  # сек на один кодировщик
+ENCODER_SETTINGS_KEY = "hls_encoder_probe"
+
+_ENCODER_LOCK = threading.Lock()
+_ENCODER_PROBE: dict | None = None  # {"ffmpeg", "mtime", "order": [быстрые → медленные], "bench": {enc: сек}}
+
+
+def set_hls_encoder(name: str):
+    """Глобальная настройка: "auto" (проверка и выбор) или конкретный кодировщик / "copy"."""
+    global HLS_ENCODER
+    name = str(name or "auto").strip()
+    if name == "auto" or name == "copy" or name in HLS_ENCODER_CANDIDATES:
+        HLS_ENCODER = name
+
+
+def _encoder_video_args(encoder: str, v_bitrate: str, v_bufsize: str) -> list[str]:
+    """Параметры видео для кодировщика с таргет-битрейтом."""
+    if encoder == "h264_nvenc":
+        return [
+            "-c:v", "h264_nvenc",
+            "-pix_fmt", "yuv420p",
+            "-preset", "p4",
+            "-profile:v", "high",
+            "-tune", "hq",
+            "-spatial_aq", "1",
+            "-temporal_aq", "1",
+            "-rc", "vbr_hq",
+            "-b:v", v_bitrate,
+            "-maxrate", v_bitrate,
+            "-bufsize", v_bufsize,
+        ]
+    if encoder == "h264_qsv":
+        return [
+            "-c:v", "h264_qsv",
+            "-pix_fmt", "nv12",
+            "-preset", "faster",
+            "-profile:v", "high",
+            "-b:v", v_bitrate,
+            "-maxrate", v_bitrate,
+            "-bufsize", v_bufsize,
+        ]
+    if encoder == "h264_amf":
+        return [
+            "-c:v", "h264_amf",
+            "-pix_fmt", "yuv420p",
+            "-quality", "speed",
+            "-profile:v", "high",
+            "-rc", "vbr_peak",
+            "-b:v", v_bitrate,
+            "-maxrate", v_bitrate,
+            "-bufsize", v_bufsize,
+        ]
+    # libx264: veryfast — лучший компромисс скорости и качества на CPU при фиксированном битрейте
+    return [
+        "-c:v", "libx264",
+        "-pix_fmt", "yuv420p",
+        "-preset", "veryfast",
+        "-profile:v", "high",
+        "-b:v", v_bitrate,
+        "-maxrate", v_bitrate,
+        "-bufsize", v_bufsize,
+    ]
+
+
+def _ffmpeg_run_quiet(args: list[str], timeout: float) -> tuple[int, str]:
+    try:
+        res = sp.run(
+            args,
+            stdout=sp.PIPE,
+            stderr=sp.STDOUT,
+            stdin=sp.DEVNULL,
+            text=True,
+            encoding="utf-8",
+            errors="replace",
+            timeout=timeout,
+            creationflags=CREATE_NO_WINDOW,
+        )
+        return res.returncode, res.stdout or ""
+    except Exception as e:
+        return -1, str(e)
+
+
+def _bench_encoder(ffmpeg_bin: str, encoder: str) -> float | None:
+    """Тестовый энкод (lavfi testsrc2 → null): секунды или None, если кодировщик не работает."""
+    cmd = [
+        ffmpeg_bin, "-hide_banner", "-loglevel", "error",
+        "-f", "lavfi", "-i", f"testsrc2=size=1920x1080:rate=25:duration={HLS_ENCODER_BENCH_SECONDS}",
+    ]
+    cmd += _encoder_video_args(encoder, "4000k", "8000k")
+    cmd += ["-f", "null", "-"]
+    t0 = time.time()
+    rc, out = _ffmpeg_run_quiet(cmd, timeout=HLS_ENCODER_BENCH_TIMEOUT)
+    if rc != 0:
+        tail = (out or "").strip().splitlines()[-1:]
+        print(f"🧪 Кодировщик {encoder} недоступен: {tail[0] if tail else rc}")
+        return None
+    sec = round(time.time() - t0, 3)
+    print(f"🧪 Кодировщик {encoder}: {sec:.2f} с на {HLS_ENCODER_BENCH_SECONDS} с 1080p")
+    return sec
+
+
+def _probe_encoders(ffmpeg_bin: str) -> dict:
+    """`ffmpeg -encoders` + короткий тестовый энкод каждого кандидата; order — рабочие, от быстрого к медленному."""
+    rc, out = _ffmpeg_run_quiet([ffmpeg_bin, "-hide_banner", "-encoders"], timeout=15)
+    listed = set(re.findall(r"^\s*V[.\w]{5}\s+(\S+)", out, re.M)) if rc == 0 else set()
+    bench: dict[str, float] = {}
+    for enc in HLS_ENCODER_CANDIDATES:
+        if enc in listed:
+            sec = _bench_encoder(ffmpeg_bin, enc)
+            if sec is not None:
+                bench[enc] = sec
+    order = sorted(bench, key=lambda e: (bench[e], HLS_ENCODER_CANDIDATES.index(e)))
+    return {"order": order, "bench": bench, "ts": int(time.time())}
+
+
+def _encoder_settings_file():
+    """(путь settings.json, общий lock настроек) — тот же lock держат load/save_settings в UI."""
+    try:
+        # импорт внутри, чтобы не ловить циклические импорты (uc_driver -> kino_hls)
+        from uc_driver import SETTINGS_FILE, SETTINGS_LOCK
+
+        return SETTINGS_FILE, SETTINGS_LOCK
+    except Exception:
+        return None, None
+
+
+def _load_encoder_probe(ffmpeg_bin: str, mtime: int) -> dict | None:
+    path, lock = _encoder_settings_file()
+    if not path:
+        return None
+    try:
+        with lock, open(path, encoding="utf-8") as f:
+            saved = (json.load(f) or {}).get(ENCODER_SETTINGS_KEY)
+        if isinstance(saved, dict) and saved.get("ffmpeg") == ffmpeg_bin and int(saved.get("mtime") or 0) == mtime:
+            if isinstance(saved.get("order"), list):
+                return saved
+    except Exception:
+        pass
+    return None
+
+
+def _save_encoder_probe(probe: dict) -> None:
+    """Дописывает только свой ключ: чтение-изменение-запись целиком под общим lock настроек."""
+    path, lock = _encoder_settings_file()
+    if not path:
+        return
+    try:
+        with lock:
+            data = {}
+            if os.path.isfile(path):
+                with open(path, encoding="utf-8") as f:
+                    data = json.load(f) or {}
+            data[ENCODER_SETTINGS_KEY] = probe
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False, indent=2)
+            os.replace(tmp, path)
+    except Exception:
+        pass
+
+
+def _encoder_probe() -> dict:
+    """Результат проверки кодировщиков: из памяти, из settings.json (тот же ffmpeg) или свежая проверка."""
+    global _ENCODER_PROBE
+    with _ENCODER_LOCK:
+        try:
+            ffmpeg_bin = _ffmpeg_path()
+            mtime = int(os.path.getmtime(ffmpeg_bin))
+        except Exception:
+            return {"order": [], "bench": {}}
+        probe = _ENCODER_PROBE
+        if probe and probe.get("ffmpeg") == ffmpeg_bin and probe.get("mtime") == mtime:
+            return probe
+        probe = _load_encoder_probe(ffmpeg_bin, mtime)
+        if probe is None:
+            print("🧪 Проверяю кодировщики ffmpeg (один раз)…")
+            probe = _probe_encoders(ffmpeg_bin)
+            probe.update(ffmpeg=ffmpeg_bin, mtime=mtime)
+            _save_encoder_probe(probe)
+        _ENCODER_PROBE = probe
+        return probe
+
+
+def warm_encoder_probe() -> None:
+    """Проверить кодировщики заранее в фоне (чтобы первый MUX не ждал тестовых энкодов)."""
+    if ENABLE_REENCODE and HLS_ENCODER == "auto":
+        threading.Thread(target=_encoder_probe, name="encoder-probe", daemon=True).start()
+
+
+def _pick_encoder() -> str:
+    """Кодировщик для MUX: заданный вручную или самый быстрый рабочий; "copy" — перекодировать нечем."""
+    if HLS_ENCODER != "auto":
+        return HLS_ENCODER
+    order = _encoder_probe().get("order") or []
+    return order[0] if order else "copy"
+
+
+def _encoder_failed(encoder: str) -> str | None:
+    """
+    MUX с этим кодировщиком упал. Если и тестовый энкод не проходит (драйвер/GPU пропал) —
+    исключаем кодировщик (и в settings.json) и возвращаем следующий; иначе дело не в нём — None.
+    """
+    global _ENCODER_PROBE
+    if HLS_ENCODER != "auto" or encoder == "copy":
+        return None
+    try:
+        if _bench_encoder(_ffmpeg_path(), encoder) is not None:
+            return None
+    except Exception:
+        pass
+    with _ENCODER_LOCK:
+        probe = dict(_ENCODER_PROBE or {})
+        order = [e for e in probe.get("order") or [] if e != encoder]
+        if probe:
+            probe["order"] = order
+            _ENCODER_PROBE = probe
+            _save_encoder_probe(probe)
+    nxt = order[0] if order else "copy"
+    print(f"⚠️ Кодировщик {encoder} не справился — дальше {nxt}")
+    return nxt
+
+
+# === Выбор варианта HLS ===
+# При перекодировании качаем самый лёгкий вариант, битрейт которого ещё не ниже целевого видео
+# (с запасом HLS_VARIANT_HEADROOM), а не самый тяжёлый — всё равно ужмём до TARGET_TOTAL_KBPS.
+HLS_VARIANT_BANDWIDTH_AWARE = True
+HLS_VARIANT_HEADROOM = 1.25  # источник должен быть хотя бы на 25% «жирнее» цели перекодирования
+HLS_VARIANT_MAX_HEIGHT = 0  # потолок высоты кадра (0 — без ограничения)
+HLS_SIZE_ESTIMATE = True  # печатать оценку объёма (BANDWIDTH × длительность) до начала скачивания
+
+
+def set_hls_variant_policy(
+    bandwidth_aware: bool | None = None,
+    max_height: int | None = None,
+    headroom: float | None = None,
+    estimate_size: bool | None = None,
+):
+    """Глобальная настройка выбора варианта: под целевой битрейт, потолок качества, оценка объёма."""
+    global HLS_VARIANT_BANDWIDTH_AWARE, HLS_VARIANT_MAX_HEIGHT, HLS_VARIANT_HEADROOM, HLS_SIZE_ESTIMATE
+    if bandwidth_aware is not None:
+        HLS_VARIANT_BANDWIDTH_AWARE = bool(bandwidth_aware)
+    if max_height is not None:
+        HLS_VARIANT_MAX_HEIGHT = max(0, int(max_height))
+    if headroom is not None:
+        HLS_VARIANT_HEADROOM = max(1.0, float(headroom))
+    if estimate_size is not None:
+        HLS_SIZE_ESTIMATE = bool(estimate_size)
+
+
+
+_M3U8_SNIFFER_JS = r"""
+(function(){
+  try {
+    if (window.__m3u8Hooked) return;
+    window.__m3u8Hooked = true;
+    window.__m3u8 = [];   // всё найденное (для _read_m3u8_from_sniffer)
+    window.__m3u8q = [];  // очередь новых URL, её вычерпывает сниффер
+    var isTop = (window.top === window);
+
+    function pushUrl(u){
       try {
-        if (window.__m3u8Hooked) return;
-        window.__m3u8Hooked = true;
-        window.__m3u8 = [];
-
-        function pushUrl(u){
-          try {
-            if (typeof u === 'string' && u.includes('.m3u8') && window.__m3u8.indexOf(u) === -1){
-              window.__m3u8.push(u);
-            }
-          } catch (e) {}
-        }
-
-        // fetch
-        if (window.fetch) {
-          const _fetch = window.fetch;
-          window.fetch = function(){
-            try { pushUrl(arguments[0]); } catch(e){}
-            return _fetch.apply(this, arguments).then(function(resp){
-              try { pushUrl(resp && resp.url); } catch(e){}
-              return resp;
-            });
-          };
-        }
-
-        // XHR
-        const _open = XMLHttpRequest.prototype.open;
-        XMLHttpRequest.prototype.open = function(method, url){
-          try { pushUrl(url); } catch(e){}
-          return _open.apply(this, arguments);
-        };
+        if (u && typeof u !== 'string') u = u.url || String(u);
+        if (typeof u !== 'string' || u.indexOf('.m3u8') === -1) return;
+        if (window.__m3u8.indexOf(u) !== -1) return;
+        window.__m3u8.push(u);
+        window.__m3u8q.push(u);
+        // плеер в iframe: пересылаем наверх, там его читает WebDriver
+        if (!isTop) { try { window.top.postMessage({__m3u8: u}, '*'); } catch(e){} }
       } catch (e) {}
-    })();
+    }
+
+    if (isTop) {
+      window.addEventListener('message', function(ev){
+        try { if (ev.data && ev.data.__m3u8) pushUrl(ev.data.__m3u8); } catch(e){}
+      });
+    }
+
+    // fetch
+    if (window.fetch) {
+      const _fetch = window.fetch;
+      window.fetch = function(){
+        try { pushUrl(arguments[0]); } catch(e){}
+        return _fetch.apply(this, arguments).then(function(resp){
+          try { pushUrl(resp && resp.url); } catch(e){}
+          return resp;
+        });
+      };
+    }
+
+    // XHR
+    const _open = XMLHttpRequest.prototype.open;
+    XMLHttpRequest.prototype.open = function(method, url){
+      try { pushUrl(url); } catch(e){}
+      return _open.apply(this, arguments);
+    };
+
+    // ресурсы, загруженные мимо fetch/XHR (<video src>, worker и т.п.)
+    try {
+      new PerformanceObserver(function(list){
+        list.getEntries().forEach(function(e){ pushUrl(e.name); });
+      }).observe({type: 'resource', buffered: true});
+    } catch (e) {
+      try { (performance.getEntries() || []).forEach(function(e){ pushUrl(e.name); }); } catch(e2){}
+    }
+  } catch (e) {}
+})();
+"""
+
+# дренаж очереди хука: одна поездка в WebDriver за тик вместо трёх
+_M3U8_DRAIN_JS = "var q = window.__m3u8q || []; window.__m3u8q = []; return q;"
+
+
+def _inject_m3u8_sniffer_js(driver):
+    """Инъекция перехватчика fetch/XHR/PerformanceObserver, сохраняет URL .m3u8 в window.__m3u8.
+
+    Скрипт ставится и в текущий документ, и через CDP на все будущие документы/iframe плеера
+    (один раз на драйвер).
     """
+    if not getattr(driver, "_m3u8_hook_installed", False):
+        try:
+            driver.execute_cdp_cmd("Page.addScriptToEvaluateOnNewDocument", {"source": _M3U8_SNIFFER_JS})
+            driver._m3u8_hook_installed = True
+        except Exception:
+            pass
     try:
-        driver.execute_script(js)
+        driver.execute_script(_M3U8_SNIFFER_JS)
     except Exception:
         pass
 
@@ -909,6 +1458,7 @@ def _sniff_hls_with_cdp(driver, timeout: int = 25, cancel_event=None) -> tuple[s
         pass
 
     ua = driver.execute_script("return navigator.userAgent;") or "Mozilla/5.0"
+    _remember_browser_ua(ua)
     cookies = "; ".join([f"{c['name']}={c['value']}" for c in driver.get_cookies()])
     referer = driver.current_url
 
@@ -916,9 +1466,32 @@ def _sniff_hls_with_cdp(driver, timeout: int = 25, cancel_event=None) -> tuple[s
         return {"User-Agent": ua, "Referer": referer, "Cookie": cookies}
 
     candidates = set()
-    perf_dump = []
+    perf_ring = collections.deque(maxlen=HLS_SNIFF_LOG_RING)  # только отфильтрованные сообщения, для отладки
     t0 = time.time()
 
+    # Ранний выход: как только кандидат подтверждён (реально отдаёт master с #EXT-X-STREAM-INF) или JS-хук увидел master —
+    # ждём ещё HLS_SNIFF_GRACE на «более старшие» варианты и заканчиваем, не досиживая timeout.
+    _, hdict = _augment_headers(_mk_headers())
+    stop_checks = threading.Event()
+    check_ev = _EitherEvent(cancel_event, stop_checks)
+    checker = concurrent.futures.ThreadPoolExecutor(max_workers=2, thread_name_prefix="hls-sniff")
+    checks: dict[str, concurrent.futures.Future] = {}
+    grace_until = None
+
+    def _check(u: str) -> bool:
+        # media-плейлист варианта тоже #EXTM3U — ранний выход только по настоящему master
+        text = _fetch_playlist_once(u, hdict, timeout=HLS_SNIFF_RANK_TIMEOUT, cancel_event=check_ev)
+        return "#EXTM3U" in text[:1024] and "#EXT-X-STREAM-INF" in text
+
+    def _confirmed() -> bool:
+        for f in checks.values():
+            try:
+                if f.done() and f.result():
+                    return True
+            except Exception:
+                continue
+        return False
+
     def consider(url: str):
         if not isinstance(url, str):
             return
@@ -938,44 +1511,71 @@ def _sniff_hls_with_cdp(driver, timeout: int = 25, cancel_event=None) -> tuple[s
             except Exception:
                 pass
 
+    # драйвер с enable_cdp_events — события Network приходят в обработчик (uc Reactor),
+    # перф-лог сами не опрашиваем; без них — по-старому, get_log("performance") на каждом такте
+    cdp_urls = collections.deque()
+    cdp_events = _cdp_listen(driver, cdp_urls, perf_ring)
+
     while time.time() - t0 < timeout:
         if _is_cancelled(cancel_event):
+            _cdp_unlisten(driver, cdp_events)
+            stop_checks.set()
+            checker.shutdown(wait=False, cancel_futures=True)
             return None, None
-        # perf log
-        try:
-            logs = driver.get_log("performance")
-        except Exception:
-            logs = []
+        while cdp_urls:
+            consider(cdp_urls.popleft())
+        # perf log: JSON разбираем только у сообщений, где вообще есть HLS
+        logs = []
+        if cdp_events is None:
+            try:
+                logs = driver.get_log("performance")
+            except Exception:
+                logs = []
         for entry in logs:
+            raw = entry.get("message", "")
+            if not any(m in raw for m in _HLS_LOG_MARKERS):
+                continue
             try:
-                perf_dump.append(entry.get("message", ""))
-                msg = json.loads(entry.get("message", "{}")).get("message", {})
+                msg = json.loads(raw).get("message", {})
+                if msg.get("method") not in _HLS_LOG_METHODS:
+                    continue
+                perf_ring.append(raw)
                 params = msg.get("params", {})
                 if "request" in params:
                     consider(params["request"].get("url", ""))
                 if "response" in params:
-                    r = params["response"]
-                    consider(r.get("url", ""))
-                    if (r.get("mimeType") or "").lower().find("mpegurl") >= 0:
-                        consider(r.get("url", ""))
+                    consider(params["response"].get("url", ""))
             except Exception:
                 continue
 
-        # performance.getEntries()
+        # очередь JS-хука (fetch/XHR/PerformanceObserver); плеер сам сообщил master — дальше ждать незачем
+        hook_master = False
         try:
-            urls = driver.execute_script("""
-                try {
-                    const es = performance.getEntries() || [];
-                    return es.map(e => e.name);
-                } catch(e){ return []; }
-            """) or []
-            for u in urls:
+            for u in driver.execute_script(_M3U8_DRAIN_JS) or []:
                 consider(u)
+                if isinstance(u, str) and "master.m3u8" in u:
+                    hook_master = True
         except Exception:
             pass
 
+        for u in sorted(candidates, key=_master_candidate_score, reverse=True):
+            if u not in checks and len(checks) < 5:
+                checks[u] = checker.submit(_check, u)
+
+        now = time.time()
+        if grace_until is None and (hook_master or _confirmed()):
+            grace_until = now + HLS_SNIFF_GRACE
+        if grace_until is not None and now >= grace_until:
+            break
+
         time.sleep(0.2)
 
+    _cdp_unlisten(driver, cdp_events)
+    while cdp_urls:
+        consider(cdp_urls.popleft())
+    stop_checks.set()
+    checker.shutdown(wait=False, cancel_futures=True)
+
     # JS-хук (если был)
     try:
         if driver.execute_script("return !!window.__m3u8Hooked;"):
@@ -1000,128 +1600,291 @@ def _sniff_hls_with_cdp(driver, timeout: int = 25, cancel_event=None) -> tuple[s
     except Exception:
         pass
 
-    # записать хвост перф-лога на всякий
-    if perf_dump:
+    if not candidates:
+        # перф-лог пишем только при неудаче — для разбора, что видел браузер
         try:
             with open("perf_log.txt", "w", encoding="utf-8") as f:
-                for ln in perf_dump[-2000:]:
+                for ln in perf_ring:
                     f.write(ln + "\n")
         except Exception:
             pass
-
-    if not candidates:
         return None, None
 
     # --- Выбираем лучший master ---
-    def score(u: str) -> int:
-        s = 0
-        if "/hls4/" in u: s += 100
-        if "/master.m3u8" in u: s += 10
-        if ".mp4/master.m3u8" in u: s -= 20
-        host = urllib.parse.urlsplit(u).netloc
-        if "ams-static" in host: s -= 5
-        if "cdn2" in host or "cdn" in host: s += 5
-        s += min(40, len(u)//50)  # длиннее путь — часто «старший» уровень
-        return s
-
     # проверим топ-5 по score и возьмём тот, у кого больше вариантов/выше RESOLUTION
-    ranked = sorted(candidates, key=score, reverse=True)[:5]
-    best_url, best_n, best_h = None, -1, 0
+    ranked = sorted(candidates, key=_master_candidate_score, reverse=True)[:5]
     headers = _mk_headers()
-    for u in ranked:
-        try:
-            if _is_cancelled(cancel_event):
-                return None, None
-            txt = _http_get_text(u, headers, driver=driver, cancel_event=cancel_event)
-            lines = txt.splitlines()
-            n = sum(1 for ln in lines if ln.startswith("#EXT-X-STREAM-INF"))
-            hmax = 0
-            for ln in lines:
-                m = re.search(r"RESOLUTION=\d+x(\d+)", ln)
-                if m:
-                    hmax = max(hmax, int(m.group(1)))
-            if (n > best_n) or (n == best_n and hmax > best_h):
-                best_url, best_n, best_h = u, n, hmax
-        except DownloadCancelled:
-            return None, None
-        except Exception:
-            continue
+    try:
+        best_url = _rank_master_candidates(ranked, headers, driver=driver, cancel_event=cancel_event)
+    except DownloadCancelled:
+        return None, None
 
     # последний шанс — просто лучший по рангу
     master = best_url or (ranked[0] if ranked else None)
     return (master, headers) if master else (None, None)
 
 
+HLS_SNIFF_LOG_RING = 200  # сколько HLS-сообщений перф-лога держать в памяти для perf_log.txt
+_HLS_LOG_MARKERS = ("m3u8", "mpegurl")  # дешёвый фильтр по подстроке до json.loads
+_HLS_LOG_METHODS = ("Network.requestWillBeSent", "Network.responseReceived")
+HLS_SNIFF_GRACE = 1.5  # после первого подтверждённого кандидата ждём ещё столько (сек)
+HLS_SNIFF_RANK_DEADLINE = 6.0  # общий дедлайн на проверку кандидатов-master (сек)
+HLS_SNIFF_RANK_TIMEOUT = 4.0  # таймаут одного запроса кандидата (сек)
 
-def _http_get_text(url: str, headers: dict, *, driver=None, cancel_event=None) -> str:
+
+def _cdp_listen(driver, urls: collections.deque, ring: collections.deque) -> list[str] | None:
     """
-    Надёжная загрузка текста плейлиста:
-      1) пробуем через JS fetch в браузере (если driver есть);
-      2) затем много попыток через urllib с гибким SSL-контекстом и ретраями до 200 OK;
-      3) если всё равно не удалось — ещё одна попытка браузером и осмысленная ошибка.
+    Подписка на Network-события через add_cdp_listener (undetected_chromedriver, enable_cdp_events=True):
+    URL запросов/ответов складываются в urls (обработчик зовётся из потока Reactor, deque потокобезопасен).
+    Reactor сам выбирает перф-лог раз в секунду в своём потоке — цикл сниффа get_log больше не зовёт.
+    None — у драйвера нет событий CDP, остаётся опрос перф-лога.
     """
-    _raise_if_cancelled(cancel_event)
-
-    # 0) Нормализуем заголовки один раз
-    _, hdict = _augment_headers(headers)
+    add = getattr(driver, "add_cdp_listener", None)
+    if not callable(add) or getattr(driver, "reactor", None) is None:
+        return None
 
-    # 1) сначала через браузер (если доступен)
-    if driver is not None:
-        _raise_if_cancelled(cancel_event)
-        t = _http_get_text_via_browser(driver, url, hdict)
-        if isinstance(t, str) and t:
-            return t
+    def _on_event(msg):
+        try:
+            params = (msg or {}).get("params") or {}
+            hit = False
+            for key in ("request", "response"):
+                obj = params.get(key) or {}
+                u = obj.get("url") or ""
+                if u:
+                    urls.append(u)
+                    hit = hit or any(m in u for m in _HLS_LOG_MARKERS)
+                hit = hit or "mpegurl" in str(obj.get("mimeType") or "").lower()
+            if hit:
+                ring.append(json.dumps(msg, ensure_ascii=False))
+        except Exception:
+            pass
 
-    # 2) urllib c устойчивым SSL-контекстом + ретраи
-    import ssl, urllib.error
+    try:
+        for ev in _HLS_LOG_METHODS:
+            if not add(ev, _on_event):
+                return None
+    except Exception:
+        return None
+    return list(_HLS_LOG_METHODS)
 
-    max_tries = 8          # фактически "до тех пор", но с предохранителем
-    last_err = None
 
-    # Гибкий SSL (TLS1.2/1.3, игнор неожиданных EOF, ослабленный seclevel)
-    ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
-    ctx.check_hostname = False
-    ctx.verify_mode = ssl.CERT_NONE
+def _cdp_unlisten(driver, events: list[str] | None) -> None:
+    """Снять свои обработчики: драйвер вернётся в пул и будет открывать другие страницы."""
+    if not events:
+        return
     try:
-        ctx.set_ciphers("DEFAULT:@SECLEVEL=1")
+        handlers = driver.reactor.handlers
+        for ev in events:
+            handlers.pop(ev.lower(), None)
     except Exception:
         pass
-    if hasattr(ssl, "OP_IGNORE_UNEXPECTED_EOF"):
-        ctx.options |= ssl.OP_IGNORE_UNEXPECTED_EOF
 
-    req = urllib.request.Request(url, headers=hdict or {})
 
-    for attempt in range(1, max_tries + 1):
-        _raise_if_cancelled(cancel_event)
-        try:
-            with urllib.request.urlopen(req, timeout=10, context=ctx) as r:
-                status = getattr(r, "status", 200)
-                body = r.read().decode("utf-8", "ignore")
-                if 200 <= status < 300:
-                    return body
-                # не 2xx — считаем ошибкой и ретраим
-                last_err = RuntimeError(f"HTTP {status}")
-        except urllib.error.HTTPError as e:
-            # 4xx/5xx — CDN может "передумать", продолжаем ретраи
-            last_err = e
-        except urllib.error.URLError as e:
-            last_err = e
-        except Exception as e:
-            last_err = e
+def _master_candidate_score(u: str) -> int:
+    """Эвристический ранг URL-кандидата в master (до сетевой проверки)."""
+    s = 0
+    if "/hls4/" in u: s += 100
+    if "/master.m3u8" in u: s += 10
+    if ".mp4/master.m3u8" in u: s -= 20
+    host = urllib.parse.urlsplit(u).netloc
+    if "ams-static" in host: s -= 5
+    if "cdn2" in host or "cdn" in host: s += 5
+    s += min(40, len(u)//50)  # длиннее путь — часто «старший» уровень
+    return s
 
-        # backoff, но с верхней границей, чтобы не уходить в космос
-        _raise_if_cancelled(cancel_event)
-        time.sleep(min(0.3 * attempt, 3.0))
 
-    # 3) финальный резерв — ещё одна попытка браузером
-    if driver is not None:
-        _raise_if_cancelled(cancel_event)
-        t = _http_get_text_via_browser(driver, url, hdict)
-        if isinstance(t, str) and t:
-            return t
+def _fetch_playlist_once(url: str, hdict: dict, timeout: float = 4.0, cancel_event=None) -> str:
+    """Одна попытка скачать плейлист по HTTP (без браузера и ретраев), через кэш плейлистов."""
+    cached = _playlist_cache_get(url, hdict)
+    if cached is not None:
+        return cached
+    _, _, body = _http_request(url, hdict, timeout=timeout, cancel_event=cancel_event)
+    text = body.decode("utf-8", "ignore")
+    _playlist_cache_put(url, hdict, text)
+    return text
 
-    # если сюда дошли — поднимем осмысленную ошибку (чтобы видеть первопричину)
-    raise RuntimeError(f"_http_get_text failed for {url}: {last_err}")
+
+def _master_quality(text: str) -> tuple[int, int]:
+    """(кол-во EXT-X-STREAM-INF, максимальная высота RESOLUTION)."""
+    variants = hls_playlist.parse_master(text or "").variants
+    return len(variants), max((v.height for v in variants), default=0)
+
+
+def _rank_master_candidates(ranked: list[str], headers: dict, driver=None, cancel_event=None) -> str | None:
+    """
+    Параллельно (только HTTP — driver не потокобезопасен) качает кандидатов и выбирает master
+    с большим числом вариантов / высшим RESOLUTION. По одной попытке на кандидата, общий дедлайн;
+    явно лучший (≥2 варианта и ≥1080p) возвращаем сразу, не дожидаясь остальных.
+    Если по HTTP не ответил никто — последовательно пробуем браузером.
+    """
+    if not ranked:
+        return None
+    _, hdict = _augment_headers(headers)
+    stop = threading.Event()
+    ev = _EitherEvent(cancel_event, stop)
+
+    def fetch(u: str) -> str:
+        return _fetch_playlist_once(u, hdict, timeout=HLS_SNIFF_RANK_TIMEOUT, cancel_event=ev)
+
+    best_url, best_n, best_h = None, -1, 0
+    deadline = time.time() + HLS_SNIFF_RANK_DEADLINE
+    ex = concurrent.futures.ThreadPoolExecutor(max_workers=len(ranked), thread_name_prefix="hls-rank")
+    try:
+        fut_map = {ex.submit(fetch, u): u for u in ranked}
+        pending = set(fut_map)
+        while pending and time.time() < deadline:
+            _raise_if_cancelled(cancel_event)
+            done, pending = concurrent.futures.wait(
+                pending,
+                timeout=min(0.2, max(0.01, deadline - time.time())),
+                return_when=concurrent.futures.FIRST_COMPLETED,
+            )
+            for fut in done:
+                u = fut_map[fut]
+                try:
+                    n, hmax = _master_quality(fut.result())
+                except DownloadCancelled:
+                    continue
+                except Exception:
+                    continue
+                # при равенстве — тот, что выше по рангу
+                better = (n > best_n) or (n == best_n and hmax > best_h) or (
+                    n == best_n and hmax == best_h and best_url and ranked.index(u) < ranked.index(best_url)
+                )
+                if better:
+                    best_url, best_n, best_h = u, n, hmax
+            if best_n >= 2 and best_h >= 1080:
+                break
+    finally:
+        stop.set()
+        ex.shutdown(wait=False, cancel_futures=True)
+
+    if best_url or driver is None:
+        return best_url
+
+    # HTTP не дал ничего — браузером (куки/CF), по одному, лучшие по рангу первыми
+    for u in ranked:
+        _raise_if_cancelled(cancel_event)
+        t = _http_get_text_via_browser(driver, u, hdict)
+        if isinstance(t, str) and t:
+            _playlist_cache_put(u, hdict, t)
+            n, hmax = _master_quality(t)
+            if (n > best_n) or (n == best_n and hmax > best_h):
+                best_url, best_n, best_h = u, n, hmax
+    return best_url
+
+
+
+# --- Кэш плейлистов: один и тот же m3u8 за время обработки тайтла качаем один раз ---
+# (sniff ранжирует кандидатов → выбор варианта → скачивание потоков)
+HLS_PLAYLIST_CACHE_TTL = 120.0  # сек; подписанные ссылки живут дольше, VOD-плейлисты не меняются
+HLS_PLAYLIST_CACHE_MAX = 256  # записей
+_PLAYLIST_CACHE: dict[tuple, tuple[float, str]] = {}
+_PLAYLIST_CACHE_LOCK = threading.Lock()
+
+
+def _playlist_cache_key(url: str, hdict: dict) -> tuple:
+    return str(url), tuple(sorted((str(k).lower(), str(v)) for k, v in (hdict or {}).items()))
+
+
+def _playlist_cache_get(url: str, hdict: dict) -> str | None:
+    key = _playlist_cache_key(url, hdict)
+    with _PLAYLIST_CACHE_LOCK:
+        hit = _PLAYLIST_CACHE.get(key)
+        if hit is None:
+            return None
+        if time.time() - hit[0] > HLS_PLAYLIST_CACHE_TTL:
+            _PLAYLIST_CACHE.pop(key, None)
+            return None
+        return hit[1]
+
+
+def _playlist_cache_put(url: str, hdict: dict, text: str) -> None:
+    if not text or "#EXTM3U" not in text[:1024]:
+        # ошибки/HTML-заглушки не кэшируем
+        return
+    key = _playlist_cache_key(url, hdict)
+    now = time.time()
+    with _PLAYLIST_CACHE_LOCK:
+        _PLAYLIST_CACHE[key] = (now, text)
+        if len(_PLAYLIST_CACHE) > HLS_PLAYLIST_CACHE_MAX:
+            # сначала протухшие, затем самые старые
+            for k in [k for k, (ts, _t) in _PLAYLIST_CACHE.items() if now - ts > HLS_PLAYLIST_CACHE_TTL]:
+                _PLAYLIST_CACHE.pop(k, None)
+            for k in sorted(_PLAYLIST_CACHE, key=lambda k: _PLAYLIST_CACHE[k][0]):
+                if len(_PLAYLIST_CACHE) <= HLS_PLAYLIST_CACHE_MAX:
+                    break
+                _PLAYLIST_CACHE.pop(k, None)
+
+
+def _playlist_cache_invalidate(urls) -> None:
+    """Выбросить из кэша все плейлисты с хостов этих URL (ссылки/куки протухли — нужен свежий текст)."""
+    hosts = {urllib.parse.urlsplit(u).netloc for u in urls if u}
+    if not hosts:
+        return
+    with _PLAYLIST_CACHE_LOCK:
+        for k in [k for k in _PLAYLIST_CACHE if urllib.parse.urlsplit(k[0]).netloc in hosts]:
+            _PLAYLIST_CACHE.pop(k, None)
+
+
+def _http_get_text(url: str, headers: dict, *, driver=None, cancel_event=None) -> str:
+    """
+    Надёжная загрузка текста плейлиста:
+      0) свежая копия из кэша плейлистов (ключ — URL + заголовки);
+      1) пробуем через JS fetch в браузере (если driver есть);
+      2) затем много попыток через urllib с гибким SSL-контекстом и ретраями до 200 OK;
+      3) если всё равно не удалось — ещё одна попытка браузером и осмысленная ошибка.
+    """
+    _raise_if_cancelled(cancel_event)
+
+    # 0) Нормализуем заголовки один раз
+    _, hdict = _augment_headers(headers)
+
+    cached = _playlist_cache_get(url, hdict)
+    if cached is not None:
+        return cached
+
+    # 1) сначала через браузер (если доступен)
+    if driver is not None:
+        _raise_if_cancelled(cancel_event)
+        t = _http_get_text_via_browser(driver, url, hdict)
+        if isinstance(t, str) and t:
+            _playlist_cache_put(url, hdict, t)
+            return t
+
+    # 2) общий keep-alive пул (устойчивый SSL-контекст) + ретраи
+    max_tries = 8          # фактически "до тех пор", но с предохранителем
+    last_err = None
+
+    for attempt in range(1, max_tries + 1):
+        _raise_if_cancelled(cancel_event)
+        try:
+            _, _, body = _http_request(url, hdict, timeout=10, cancel_event=cancel_event)
+            text = body.decode("utf-8", "ignore")
+            _playlist_cache_put(url, hdict, text)
+            return text
+        except DownloadCancelled:
+            raise
+        except HttpStatusError as e:
+            # 4xx/5xx — CDN может "передумать", продолжаем ретраи
+            last_err = e
+        except Exception as e:
+            last_err = e
+
+        # backoff, но с верхней границей, чтобы не уходить в космос
+        _raise_if_cancelled(cancel_event)
+        time.sleep(min(0.3 * attempt, 3.0))
+
+    # 3) финальный резерв — ещё одна попытка браузером
+    if driver is not None:
+        _raise_if_cancelled(cancel_event)
+        t = _http_get_text_via_browser(driver, url, hdict)
+        if isinstance(t, str) and t:
+            _playlist_cache_put(url, hdict, t)
+            return t
+
+    # если сюда дошли — поднимем осмысленную ошибку (чтобы видеть первопричину)
+    raise RuntimeError(f"_http_get_text failed for {url}: {last_err}")
 
 
 
@@ -1176,6 +1939,47 @@ def _normalize_to_master(m3u8_url: str) -> str:
     return urllib.parse.urlunsplit((parts.scheme, parts.netloc, path, parts.query, parts.fragment))
 
 
+def _variant_kbps(v: hls_playlist.Variant) -> float:
+    """Битрейт варианта: AVERAGE-BANDWIDTH ближе к реальному объёму, BANDWIDTH — пиковый."""
+    return (v.avg_bandwidth or v.bandwidth) / 1000.0
+
+
+def _pick_variant(variants: list[hls_playlist.Variant]) -> hls_playlist.Variant | None:
+    """
+    Вариант к скачиванию с учётом потолка высоты и (при перекодировании) целевого битрейта:
+    самый лёгкий из тех, что не хуже цели; если таких нет — самый тяжёлый.
+    Без перекодирования — как раньше, самый большой по w*h (или BANDWIDTH).
+    """
+    if not variants:
+        return None
+    pool = variants
+    if HLS_VARIANT_MAX_HEIGHT > 0:
+        pool = [v for v in variants if 0 < v.height <= HLS_VARIANT_MAX_HEIGHT] or variants
+    best = max(pool, key=lambda v: ((v.width * v.height) or v.bandwidth, v.bandwidth))
+    if not (ENABLE_REENCODE and HLS_VARIANT_BANDWIDTH_AWARE):
+        return best
+    target = max(MIN_VIDEO_BITRATE_KBPS, TARGET_TOTAL_KBPS - AUDIO_BITRATE_KBPS) * HLS_VARIANT_HEADROOM
+    enough = [v for v in pool if v.bandwidth and _variant_kbps(v) >= target]
+    if not enough:
+        return max(pool, key=lambda v: (v.bandwidth, v.width * v.height))
+    return min(enough, key=lambda v: (_variant_kbps(v), -(v.width * v.height)))
+
+
+def _estimate_variant_size(driver, variant: hls_playlist.Variant, headers: dict, cancel_event=None) -> None:
+    """Печатает оценку объёма видео по BANDWIDTH × длительность (media-плейлист всё равно понадобится — он кэшируется)."""
+    try:
+        text = _http_get_text(variant.uri, headers, driver=driver, cancel_event=cancel_event)
+        seconds = hls_playlist.parse_media(text, variant.uri).duration
+        if seconds <= 0:
+            return
+        size = _variant_kbps(variant) * 1000.0 / 8.0 * seconds
+        print(f"📦 Оценка объёма видео: ~{size / (1024 ** 3):.2f} ГБ ({seconds / 60:.0f} мин, {_variant_kbps(variant):.0f} kbps)")
+    except DownloadCancelled:
+        raise
+    except Exception:
+        pass
+
+
 def _select_video_and_audios(driver, master_url: str, headers: dict, cancel_event=None):
     """
     Возвращает: (video_m3u8, [ {uri,name,lang,default}, ... ])
@@ -1188,62 +1992,30 @@ def _select_video_and_audios(driver, master_url: str, headers: dict, cancel_even
         print("❌ Не удалось загрузить master.m3u8")
         return master_url, headers, []
 
-    lines = [ln.strip() for ln in text.splitlines() if ln.strip()]
+    master = hls_playlist.parse_master(text, master_url)
 
     # --- Аудио-группы ---
     audio_groups = {}
-    for ln in lines:
-        if ln.startswith("#EXT-X-MEDIA") and "TYPE=AUDIO" in ln:
-            def _get(rx, default=None):
-                m = re.search(rx, ln)
-                return m.group(1) if m else default
-            gid  = _get(r'GROUP-ID="([^"]+)"')
-            uri  = _get(r'URI="([^"]+)"')
-            name = _get(r'NAME="([^"]+)"', "")
-            lang = _get(r'LANGUAGE="([^"]+)"', "")
-            dflt = _get(r"DEFAULT=(YES|NO)", "NO") == "YES"
-            if gid and uri:
-                abs_uri = urllib.parse.urljoin(master_url, uri)
-                audio_groups.setdefault(gid, []).append({
-                    "uri": abs_uri,
-                    "name": name or "Audio",
-                    "lang": lang or "und",
-                    "default": dflt,
-                })
+    for r in master.audio_group(None):
+        if r.group_id:
+            audio_groups.setdefault(r.group_id, []).append({
+                "uri": r.uri,
+                "name": r.name or "Audio",
+                "lang": r.lang or "und",
+                "default": r.default,
+            })
 
     # --- Варианты видео ---
     variants = []
-    best_url, best_score, chosen_gid = None, -1, None
-    i = 0
-    while i < len(lines):
-        ln = lines[i]
-        if ln.startswith("#EXT-X-STREAM-INF"):
-            info = ln
-            url_line = lines[i + 1] if i + 1 < len(lines) else None
-            i += 2
-            if not url_line:
-                continue
-            w = h = 0
-            m = re.search(r"RESOLUTION=(\d+)x(\d+)", info)
-            if m:
-                w, h = int(m.group(1)), int(m.group(2))
-            bw = 0
-            m = re.search(r"BANDWIDTH=(\d+)", info)
-            if m:
-                bw = int(m.group(1))
-            m = re.search(r'AUDIO="([^"]+)"', info)
-            gid = m.group(1) if m else None
-            url_abs = urllib.parse.urljoin(master_url, url_line)
-            score = (w * h) or bw
-            variants.append((url_abs, w, h, bw, gid))
-            if score > best_score:
-                best_score, best_url, chosen_gid = score, url_abs, gid
-        else:
-            i += 1
+    for v in master.variants:
+        variants.append((v.uri, v.width, v.height, v.bandwidth, v.audio))
+    picked = _pick_variant(master.variants)
+    best_url, chosen_gid = (picked.uri, picked.audio) if picked else (None, None)
 
     print("🔎 Найдены варианты:")
     for url_abs, w, h, bw, gid in variants:
-        print(f"   {w}x{h} | {bw/1000:.0f} kbps | AUDIO={gid or '-'}")
+        mark = " ←" if url_abs == best_url else ""
+        print(f"   {w}x{h} | {bw/1000:.0f} kbps | AUDIO={gid or '-'}{mark}")
 
     # --- Итоговые аудио ---
     audios = []
@@ -1268,8 +2040,9 @@ def _select_video_and_audios(driver, master_url: str, headers: dict, cancel_even
         return p
     audios.sort(key=_prio)
 
-    # --- Если нет ~1080p, пробуем «верхний» master в /hls/ ---
-    if all(h < 1000 for _, _, h, _, _ in variants) and "/hls/" in master_url:
+    # --- Если нет ~1080p (и потолок качества его допускает), пробуем «верхний» master в /hls/ ---
+    want_1080 = HLS_VARIANT_MAX_HEIGHT <= 0 or HLS_VARIANT_MAX_HEIGHT >= 1000
+    if want_1080 and all(h < 1000 for _, _, h, _, _ in variants) and "/hls/" in master_url:
         alt = re.sub(r"/\d+/[^/]+\.m3u8.*$", "/master.m3u8", master_url)
         if alt != master_url:
             print(f"🔁 Попробуем верхний master: {alt}")
@@ -1280,9 +2053,104 @@ def _select_video_and_audios(driver, master_url: str, headers: dict, cancel_even
             except Exception:
                 pass
 
+    if picked is not None and HLS_SIZE_ESTIMATE:
+        _estimate_variant_size(driver, picked, headers, cancel_event=cancel_event)
+
     return best_url or master_url, headers, audios
 
 
+# --- Отбор аудиодорожек ДО скачивания ---
+# Пустая политика — качаем все дорожки, как раньше. Ключи:
+#   langs        — языки, которые оставляем (["ru", "en"]; сравнение по первым двум буквам, "rus" == "ru");
+#   keep_default — DEFAULT=YES дорожку оставляем всегда;
+#   name_regex   — дорожки, чьё имя подходит под регулярку (без учёта регистра), тоже оставляем;
+#   max_tracks   — не больше N дорожек (в порядке приоритета: RU/default первыми), 0 — без лимита;
+#   ask          — перед загрузкой показать выбор пользователю (если есть audio_preselect_cb).
+AUDIO_POLICY: dict = {}
+
+_LANG_ALIASES = {
+    "rus": "ru", "russian": "ru", "рус": "ru", "русский": "ru", "eng": "en", "english": "en", "англ": "en",
+    "английский": "en", "ukr": "uk", "ua": "uk", "укр": "uk", "украинский": "uk", "jpn": "ja", "jap": "ja", "ger": "de", "deu": "de",
+    "fre": "fr", "fra": "fr", "spa": "es", "ita": "it", "kor": "ko", "chi": "zh", "zho": "zh",
+}
+
+
+def set_audio_policy(policy: dict | None):
+    """Глобальная настройка: политика отбора аудиодорожек до скачивания (см. AUDIO_POLICY)."""
+    global AUDIO_POLICY
+    AUDIO_POLICY = dict(policy or {})
+
+
+def _norm_lang(v: str) -> str:
+    v = (v or "").strip().lower()
+    if not v:
+        return ""
+    v = _LANG_ALIASES.get(v, v)
+    return _LANG_ALIASES.get(v[:3], v[:2])
+
+
+def _audio_policy_active(policy: dict | None = None) -> bool:
+    p = AUDIO_POLICY if policy is None else (policy or {})
+    return bool(p.get("langs") or p.get("name_regex") or int(p.get("max_tracks") or 0) > 0)
+
+
+def _apply_audio_policy(audios: list, policy: dict | None = None) -> list:
+    """
+    Возвращает подмножество audios (в исходном порядке), которое стоит качать.
+    Никогда не возвращает пустой список, если на входе дорожки были: тогда оставляем первую.
+    """
+    p = AUDIO_POLICY if policy is None else (policy or {})
+    audios = list(audios or [])
+    if not audios or not _audio_policy_active(p):
+        return audios
+
+    langs = {_norm_lang(x) for x in (p.get("langs") or []) if _norm_lang(x)}
+    rx = None
+    try:
+        if p.get("name_regex"):
+            rx = re.compile(str(p["name_regex"]), re.I)
+    except re.error:
+        print(f"⚠️ Неверная регулярка аудио: {p.get('name_regex')!r} — игнорирую")
+        rx = None
+
+    def _lang_of(a) -> str:
+        lang = _norm_lang(a.get("lang") or "")
+        if lang in ("", "un"):
+            # у kino.pub язык часто только в названии («Рус. Дубляж»)
+            n = (a.get("name") or "").lower()
+            # с начала слова (ловит «Русская», «English»), длинные алиасы первыми;
+            # середину слова не трогаем: «ua» не должен ловиться в «dual», «ita» — в «original»
+            for k in sorted(_LANG_ALIASES, key=len, reverse=True):
+                if re.search(rf"\b{re.escape(k)}", n):
+                    return _LANG_ALIASES[k]
+        return lang
+
+    if langs or rx is not None:
+        keep = []
+        for a in audios:
+            ok = (langs and _lang_of(a) in langs) or (rx is not None and rx.search(a.get("name") or ""))
+            if ok or (p.get("keep_default") and a.get("default")):
+                keep.append(a)
+    else:
+        keep = list(audios)
+
+    try:
+        limit = int(p.get("max_tracks") or 0)
+    except Exception:
+        limit = 0
+    if limit > 0 and len(keep) > limit:
+        # default-дорожку не выкидываем лимитом
+        if p.get("keep_default"):
+            keep.sort(key=lambda a: not a.get("default"))
+        keep = keep[:limit]
+        keep.sort(key=audios.index)
+
+    if not keep:
+        print("⚠️ Политика аудио не оставила ни одной дорожки — беру первую")
+        keep = audios[:1]
+    return keep
+
+
 # ---------- поиски и скачивание ----------
 def _split_title_variants(orig: str) -> list[str]:
     """
@@ -1501,40 +2369,66 @@ def download_by_item_url(
     audio_select_cb=None,
     defer_mux: bool = False,
     audio_parallel_tracks: int | None = None,
+    audio_preselect_cb=None,
+    clip=None,
+    resolved=None,
+    display_name: str | None = None,
 ) -> bool:
     """
     Основная функция скачивания: использует существующий driver, не создавая новое окно Chrome.
+    audio_preselect_cb(audios=, preselected=, cancel_event=) — выбор дорожек ДО скачивания
+    (список 0-based индексов в audios, None — оставить по политике, "cancel" — отмена).
+    clip=(start, end) — скачать только отрезок тайтла (сек).
+    resolved — (video_m3u8, headers, audios), уже проверенные вызывающим через _resolved_cache_get.
+    display_name — название тайтла для кэша разобранных ссылок (не имя файла: без суффикса отрезка).
     """
     drv_created = False
     drv = driver
 
-    # если драйвер не передан — создаём новый (редкий случай)
-    if drv is None:
-        from kino_parser import find_portable_browser, make_visible_driver
-        portable, ver_main = find_portable_browser()
-        drv = make_visible_driver(portable_path=portable, ver_main=ver_main, for_login=False)
-        drv_created = True
-        print("🚀 Создан новый экземпляр браузера (UC).")
-    else:
-        print("🔁 Используется уже запущенный driver (из downloader).")
-
     try:
         _raise_if_cancelled(cancel_event)
-        # только если мы сами создали — можно показывать окно
-        if drv_created:
-            _ensure_shown(drv)
 
-        # --- ЕДИНСТВЕННЫЙ вызов, без двойной нагрузки ---
-        video_m3u8, hdrs2, audios = get_hls_info(
-            url,
-            driver=drv,
-            cancel_event=cancel_event,
-            status_cb=status_cb,
-        )
+        # --- уже разобранный ранее тайтл (повтор/перезапуск), затем без браузера, браузер — при CF/неудаче ---
+        info = resolved or _resolved_cache_get(url, cancel_event=cancel_event)
+        from_cache = bool(info)
+        if from_cache:
+            print("♻️ HLS из кэша разобранных ссылок")
+        else:
+            info = _resolve_hls_http(url, cancel_event=cancel_event, status_cb=status_cb)
+        if info:
+            video_m3u8, hdrs2, audios = info
+        elif drv is None and _DRIVER_PROVIDER is not None:
+            # драйвер не передан (кэш протух между проверкой и стартом) — браузер из пула, а не новое окно
+            info = _hls_info_from_provider(url, cancel_event=cancel_event, status_cb=status_cb)
+            if not info:
+                print("❌ Нет браузера из пула для разбора HLS.")
+                return False
+            video_m3u8, hdrs2, audios = info
+        else:
+            # если драйвер не передан — создаём новый (редкий случай)
+            if drv is None:
+                from kino_parser import find_portable_browser, make_visible_driver
+                portable, ver_main = find_portable_browser()
+                drv = make_visible_driver(portable_path=portable, ver_main=ver_main, for_login=False)
+                drv_created = True
+                print("🚀 Создан новый экземпляр браузера (UC).")
+                # только если мы сами создали — можно показывать окно
+                _ensure_shown(drv)
+            else:
+                print("🔁 Используется уже запущенный driver (из downloader).")
+
+            video_m3u8, hdrs2, audios = get_hls_info(
+                url,
+                driver=drv,
+                cancel_event=cancel_event,
+                status_cb=status_cb,
+            )
 
         if not video_m3u8:
             print("❌ Не удалось получить HLS.")
             return False
+        if not from_cache:
+            _resolved_cache_put(url, video_m3u8, hdrs2, audios, display_name=display_name)
 
         print(f"🎞  Video: {video_m3u8}")
         if audios:
@@ -1544,6 +2438,47 @@ def download_by_item_url(
         else:
             print("🎧 Отдельные аудио не найдены (возможно звук в видеопотоке).")
 
+        # --- отбор дорожек ДО скачивания: не качаем то, что всё равно выкинем при MUX ---
+        if audios and len(audios) > 1:
+            picked = _apply_audio_policy(audios)
+            if AUDIO_POLICY.get("ask") and callable(audio_preselect_cb):
+                try:
+                    choice = audio_preselect_cb(
+                        audios=list(audios),
+                        preselected=[audios.index(a) for a in picked],
+                        cancel_event=cancel_event,
+                    )
+                except Exception:
+                    choice = None
+                _raise_if_cancelled(cancel_event)
+                if choice == "cancel" or choice is False:
+                    return False
+                if isinstance(choice, (list, tuple, set)):
+                    idxs = sorted({int(i) for i in choice if 0 <= int(i) < len(audios)})
+                    if idxs:
+                        picked = [audios[i] for i in idxs]
+            if len(picked) < len(audios):
+                names = ", ".join((a.get("name") or a.get("lang") or "?") for a in picked)
+                print(f"🎧 Качаю {len(picked)} из {len(audios)} дорожек: {names}")
+            audios = picked
+
+        def _refresh():
+            """Заново разобрать HLS тайтла, когда ссылки/куки протухли посреди загрузки."""
+            _resolved_cache_drop(url)
+            with _ITEM_PAGE_LOCK:
+                _ITEM_PAGE_CACHE.pop(url, None)
+            _playlist_cache_invalidate([video_m3u8] + [a.get("uri") or a.get("url") for a in audios or []])
+            info = _resolve_hls_http(url, cancel_event=cancel_event)
+            if not info:
+                if _DRIVER_PROVIDER is not None:
+                    info = _hls_info_from_provider(url, cancel_event=cancel_event)
+                elif drv_created:
+                    info = get_hls_info(url, driver=drv, cancel_event=cancel_event)
+            if not info or not info[0]:
+                return None
+            _resolved_cache_put(url, info[0], info[1], info[2], display_name=display_name)
+            return info
+
         ok = start_hls_download(
             video_m3u8,
             audios,
@@ -1554,7 +2489,12 @@ def download_by_item_url(
             audio_select_cb=audio_select_cb,
             defer_mux=defer_mux,
             audio_parallel_tracks=audio_parallel_tracks,
+            refresh_cb=_refresh,
+            clip=clip,
         )
+        # неудача на ссылках из кэша — в следующий раз разбираем заново
+        if not ok and from_cache and not _is_cancelled(cancel_event):
+            _resolved_cache_drop(url)
         return bool(ok)
 
     except DownloadCancelled:
@@ -1574,10 +2514,25 @@ def get_hls_info(
     """
     Возвращает (video_m3u8, headers, audios) для данного item_url.
     Не запускает ffmpeg, просто извлекает ссылки.
+    На время поиска на драйвере блокируются картинки/шрифты/сегменты/счётчики (uc_driver.SNIFF_BLOCKED_URLS).
     """
     if driver is None:
         raise RuntimeError("get_hls_info() требует активный driver (UC).")
 
+    try:
+        from uc_driver import apply_sniff_blocking, clear_sniff_blocking
+    except Exception:
+        apply_sniff_blocking = clear_sniff_blocking = None
+
+    blocked = bool(apply_sniff_blocking and apply_sniff_blocking(driver))
+    try:
+        return _get_hls_info_on(url, driver, cancel_event, status_cb, sniff_timeout, blocked)
+    finally:
+        if blocked:
+            clear_sniff_blocking(driver)
+
+
+def _get_hls_info_on(url, driver, cancel_event, status_cb, sniff_timeout, blocked) -> tuple[str | None, dict | None, list]:
     def _log_local(msg: str):
         try:
             print(msg)
@@ -1596,6 +2551,15 @@ def get_hls_info(
 
         _log_local("🧩 Обнаружена защита (Cloudflare) — решите в открытом браузере…")
 
+        # капче нужны картинки/шрифты — на время решения снимаем блокировку
+        if blocked:
+            try:
+                from uc_driver import clear_sniff_blocking
+
+                clear_sniff_blocking(driver)
+            except Exception:
+                pass
+
         # 1) если драйвер умеет показываться — ждём прямо в нём
         if not _driver_is_suppressed(driver):
             _wait_challenge_solved(driver, timeout=90)
@@ -1677,11 +2641,7 @@ def get_hls_info(
 
         _inject_m3u8_sniffer_js(driver)
         _start_playback(driver)
-        # даём плееру время дернуть master.m3u8
-        for _ in range(12):
-            _raise_if_cancelled(cancel_event)
-            time.sleep(0.2)
-
+        # фиксированной паузы нет: сниффер сам опрашивает и выходит, как только master подтверждён
         master, hdrs = _sniff_hls_with_cdp(
             driver, timeout=max(8, int(sniff_timeout)), cancel_event=cancel_event
         )
@@ -1692,6 +2652,8 @@ def get_hls_info(
         master = _normalize_to_master(master)
         master = master.replace(".mp4master.m3u8", ".mp4/master.m3u8")
         print(f"🛠️ Нормализовано: {master}")
+        _remember_browser_ua((hdrs or {}).get("User-Agent"))
+        _RESOLVED_MASTERS[url] = master
     else:
         _log_local("❌ Не найден master.m3u8")
         return None, None, []
@@ -1699,105 +2661,483 @@ def get_hls_info(
     video_m3u8, hdrs2, audios = _select_video_and_audios(driver, master, hdrs, cancel_event=cancel_event)
     return video_m3u8, hdrs2, audios
 
-def _type_and_pick(driver, query: str, wanted_title: str, wanted_year: str | None):
-    # поле поиска
-    search = WebDriverWait(driver, 15).until(
-        EC.element_to_be_clickable(
-            (By.CSS_SELECTOR, "input[name='query'], input[type='search'], input[name='q']")
-        )
-    )
-    driver.execute_script("arguments[0].value=''; arguments[0].focus();", search)
-    search.send_keys(query)
 
-    # короткие/цифровые — пробел, чтобы гарантировать автокомплит
-    core = re.sub(r"[^\w]+", "", query)
-    if core.isdigit() and len(core) <= 2:
-        search.send_keys(Keys.SPACE)
+# --- Быстрый путь без браузера: страница фильма по сохранённым cookies ---
+# Ссылка на плейлист обычно уже есть в HTML/инлайн-конфиге плеера. Cookies берём из файла
+# kino_parser (save_cookies_cdp), User-Agent — тот, с которым браузер получал cf_clearance.
+# При Cloudflare/логине/любой неудаче возвращаем None — вызывающий идёт через get_hls_info().
+HLS_HTTP_RESOLVE = True
+HLS_ITEM_PAGE_TTL = 60.0  # сек; страницу фильма берём один раз на имя файла + разбор HLS
+_ITEM_PAGE_CACHE: dict[str, tuple[float, str]] = {}
+_ITEM_PAGE_LOCK = threading.Lock()
+_BROWSER_UA: str | None = None
+_DEFAULT_UA = (
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) "
+    "Chrome/124.0.0.0 Safari/537.36"
+)
 
-    # 1) пробуем подсказки
-    try:
-        box = WebDriverWait(driver, 6).until(
-            EC.visibility_of_element_located(
-                (
-                    By.CSS_SELECTOR,
-                    "div.search-suggest, ul[role='listbox'], .autocomplete, .typeahead, .ui-autocomplete, .dropdown-menu",
-                )
-            )
-        )
-        # ищем кликабельные элементы
-        items = []
-        for css in ("a[href*='/item/view/']", "li a[href]", "a[href]"):
-            items = box.find_elements(By.CSS_SELECTOR, css)
-            if items:
-                break
 
-        if items:
-            idx = _best_match_index(items, wanted_title, wanted_year)
-            if idx is None:
-                idx = 0
+def set_hls_http_resolve(enabled: bool):
+    global HLS_HTTP_RESOLVE
+    HLS_HTTP_RESOLVE = bool(enabled)
 
-            # сначала пытаемся JS-клик
-            try:
-                driver.execute_script("arguments[0].scrollIntoView({block:'center'});", items[idx])
-                driver.execute_script("arguments[0].click()", items[idx])
-                WebDriverWait(driver, 8).until(lambda d: "/item/view/" in d.current_url)
-                return True
-            except Exception:
-                # если кликом не ушли — берём href и переходим напрямую
-                href = items[idx].get_attribute("href")
-                if href:
-                    driver.get(href)
-                    WebDriverWait(driver, 10).until(lambda d: "/item/view/" in d.current_url)
-                    return True
-    except Exception:
-        pass
 
-    # 2) fallback: страница поиска и первая карточка
+def _ua_file() -> str | None:
     try:
-        driver.get(f"{BASE_URL}/item/search?query=" + quote_plus(query))
-        WebDriverWait(driver, 12).until(
-            lambda d: d.find_elements(By.XPATH, "//a[contains(@href,'/item/view/')]")
-            or "Нет результатов" in d.page_source
-        )
-        links = driver.find_elements(By.XPATH, "//a[contains(@href,'/item/view/')]")
-        if links:
-            href = links[0].get_attribute("href")
-            if href:
-                driver.get(href)
-                WebDriverWait(driver, 10).until(lambda d: "/item/view/" in d.current_url)
-                return True
-    except Exception:
-        pass
+        from kino_parser import PERSIST_DIR
 
-    # 3) последний резерв: Enter по полю поиска
-    try:
-        search.send_keys(Keys.ENTER)
-        WebDriverWait(driver, 10).until(
-            lambda d: "/item/search" in d.current_url or "/item/view/" in d.current_url
-        )
-        if "/item/search" in driver.current_url:
-            links = driver.find_elements(By.XPATH, "//a[contains(@href,'/item/view/')]")
-            if links:
-                href = links[0].get_attribute("href")
-                if href:
-                    driver.get(href)
-                    WebDriverWait(driver, 10).until(lambda d: "/item/view/" in d.current_url)
-                    return True
-        return "/item/view/" in driver.current_url
+        return os.path.join(PERSIST_DIR, "kino_ua.txt")
     except Exception:
-        return False
+        return None
 
-def _best_match_index(elements, wanted_title: str, wanted_year: str | None):
-    base = _strip_year(wanted_title)[0]
-    base_n = _norm(base)
-    best_i, best_s = None, 0
 
-    for i, el in enumerate(elements):
+def _remember_browser_ua(ua: str | None):
+    """Запоминаем UA браузера (cf_clearance привязан к нему) — в памяти и на диске."""
+    global _BROWSER_UA
+    ua = (ua or "").strip()
+    if not ua or ua == "Mozilla/5.0" or ua == _BROWSER_UA:
+        return
+    _BROWSER_UA = ua
+    path = _ua_file()
+    if path:
         try:
-            txt = el.text.strip()
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(ua)
         except Exception:
-            continue
-        # Вытащим год из строки
+            pass
+
+
+def _browser_ua() -> str:
+    global _BROWSER_UA
+    if _BROWSER_UA:
+        return _BROWSER_UA
+    path = _ua_file()
+    if path:
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                ua = f.read().strip()
+            if ua:
+                _BROWSER_UA = ua
+                return ua
+        except Exception:
+            pass
+    return _DEFAULT_UA
+
+
+def _saved_cookie_header(url: str) -> str:
+    """Строка Cookie для хоста url из сохранённого файла cookies (только живые)."""
+    try:
+        from kino_parser import COOKIE_FILE, COOKIE_FILE_LEGACY
+    except Exception:
+        return ""
+    host = (urllib.parse.urlsplit(url).hostname or "").lower()
+    path = COOKIE_FILE if os.path.exists(COOKIE_FILE) else COOKIE_FILE_LEGACY
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+    except Exception:
+        return ""
+    items = data if isinstance(data, list) else (data.get("cookies") or [])
+    now = time.time()
+    pairs = {}
+    for c in items:
+        try:
+            dom = (c.get("domain") or c.get("host") or "").lstrip(".").lower()
+            if not dom or not (host == dom or host.endswith("." + dom)):
+                continue
+            exp = c.get("expires") or c.get("expiry") or c.get("expirationDate")
+            if isinstance(exp, (int, float)) and exp > 0 and exp < now:
+                continue
+            pairs[c["name"]] = c.get("value", "")
+        except Exception:
+            continue
+    return "; ".join(f"{k}={v}" for k, v in pairs.items())
+
+
+def _page_needs_login(html: str) -> bool:
+    low = (html or "").lower()
+    return ('action="/user/login"' in low or "action='/user/login'" in low) and "/user/logout" not in low
+
+
+def _fetch_item_page_http(url: str, cancel_event=None) -> str | None:
+    """HTML страницы фильма без браузера. None — CF/логин/ошибка (нужен браузер)."""
+    if not HLS_HTTP_RESOLVE:
+        return None
+    now = time.time()
+    with _ITEM_PAGE_LOCK:
+        hit = _ITEM_PAGE_CACHE.get(url)
+        if hit and now - hit[0] < HLS_ITEM_PAGE_TTL:
+            return hit[1]
+
+    cookie = _saved_cookie_header(url)
+    if not cookie:
+        return None
+    hdict = {
+        "User-Agent": _browser_ua(),
+        "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+        "Accept-Language": "ru-RU,ru;q=0.9,en;q=0.8",
+        "Referer": BASE_URL + "/",
+        "Cookie": cookie,
+    }
+    try:
+        _, _, body = _http_request(url, hdict, timeout=15, cancel_event=cancel_event)
+    except DownloadCancelled:
+        raise
+    except Exception:
+        return None
+    html = body.decode("utf-8", "ignore")
+    if _html_has_challenge(html) or _page_needs_login(html):
+        return None
+
+    with _ITEM_PAGE_LOCK:
+        for k in [k for k, (t, _) in _ITEM_PAGE_CACHE.items() if now - t >= HLS_ITEM_PAGE_TTL]:
+            _ITEM_PAGE_CACHE.pop(k, None)
+        _ITEM_PAGE_CACHE[url] = (now, html)
+    return html
+
+
+def _m3u8_urls_in_text(text: str) -> list[str]:
+    """Все ссылки на .m3u8 из HTML/JS/JSON (включая экранированные и ?mu=<m3u8>), в порядке появления."""
+    t = (text or "").replace("\\/", "/").replace("\\u0026", "&").replace("&amp;", "&")
+    out = []
+
+    def add(u: str):
+        u = u.strip()
+        if u and u not in out:
+            out.append(u)
+
+    for m in re.finditer(r'https?://[^\s"\'<>\\]+?\.m3u8[^\s"\'<>\\]*', t, re.I):
+        add(m.group(0))
+    for m in re.finditer(r'[?&]mu=([^&"\'\s<>]+)', t, re.I):
+        try:
+            decoded = urllib.parse.unquote(m.group(1))
+        except Exception:
+            continue
+        if ".m3u8" in decoded and decoded.startswith("http"):
+            add(decoded)
+    return out
+
+
+def _resolve_hls_http(url: str, cancel_event=None, status_cb=None) -> tuple[str, dict, list] | None:
+    """
+    (video_m3u8, headers, audios) без браузера или None, если нужен браузер.
+    master проверяем по-настоящему (плейлист должен скачаться и быть HLS).
+    """
+    if not HLS_HTTP_RESOLVE:
+        return None
+    html = _fetch_item_page_http(url, cancel_event=cancel_event)
+    if not html:
+        return None
+    cands = _m3u8_urls_in_text(html)
+    if not cands:
+        return None
+
+    headers = {"User-Agent": _browser_ua(), "Referer": url, "Cookie": _saved_cookie_header(url)}
+    ranked = sorted(cands, key=_master_candidate_score, reverse=True)[:5]
+    try:
+        best = _rank_master_candidates(ranked, headers, driver=None, cancel_event=cancel_event)
+    except DownloadCancelled:
+        raise
+    except Exception:
+        best = None
+    if not best:
+        return None
+
+    master = _normalize_to_master(best).replace(".mp4master.m3u8", ".mp4/master.m3u8")
+    _, hdict = _augment_headers(headers)
+    try:
+        text = _fetch_playlist_once(master, hdict, timeout=HLS_SNIFF_RANK_TIMEOUT, cancel_event=cancel_event)
+    except DownloadCancelled:
+        raise
+    except Exception:
+        text = ""
+    if "#EXTM3U" not in text[:1024]:
+        return None
+
+    try:
+        if status_cb:
+            status_cb("⚡ HLS найден без браузера")
+    except Exception:
+        pass
+    print(f"⚡ HLS без браузера: {master}")
+    _RESOLVED_MASTERS[url] = master
+    video_m3u8, hdrs2, audios = _select_video_and_audios(None, master, headers, cancel_event=cancel_event)
+    return video_m3u8, hdrs2, audios
+
+
+# --- Постоянный кэш разобранных HLS: item_url → master/вариант/аудио/заголовки ---
+# Повтор, «Повторить» из UI и восстановленная очередь не гоняют браузер заново, пока подписанная
+# ссылка жива: срок берём из query (expires/exp/e/...), иначе — проверочный запрос плейлиста.
+HLS_RESOLVED_CACHE = True
+HLS_RESOLVED_CACHE_MAX = 500  # записей в файле
+HLS_RESOLVED_MAX_AGE = 24 * 3600  # без срока в ссылке старше этого не берём вовсе (сек)
+HLS_RESOLVED_EXPIRY_MARGIN = 15 * 60  # ссылку, которой жить меньше этого, считаем протухшей (сек)
+_RESOLVED_CACHE_LOCK = threading.Lock()
+_RESOLVED_MASTERS: dict[str, str] = {}  # item_url → master последнего разбора (для записи в кэш)
+_EXPIRY_QUERY_KEYS = ("expires", "expire", "expiry", "exp", "e", "valid_till", "validto", "deadline", "till")
+
+
+def set_hls_resolved_cache(enabled: bool):
+    global HLS_RESOLVED_CACHE
+    HLS_RESOLVED_CACHE = bool(enabled)
+
+
+def _resolved_cache_file() -> str | None:
+    try:
+        from kino_parser import PERSIST_DIR
+
+        return os.path.join(PERSIST_DIR, "hls_resolved.json")
+    except Exception:
+        return None
+
+
+def _load_resolved_cache() -> dict:
+    path = _resolved_cache_file()
+    if not path:
+        return {}
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            data = json.load(f)
+        return data if isinstance(data, dict) else {}
+    except Exception:
+        return {}
+
+
+def _save_resolved_cache(data: dict):
+    path = _resolved_cache_file()
+    if not path:
+        return
+    if len(data) > HLS_RESOLVED_CACHE_MAX:
+        keep = sorted(data.items(), key=lambda kv: float(kv[1].get("resolved_at") or 0), reverse=True)
+        data = dict(keep[:HLS_RESOLVED_CACHE_MAX])
+    # куки сессии на диск открытым текстом не пишем (и вычищаем из старых записей):
+    # _resolved_cache_get подставляет свежие из сохранённых cookies
+    for entry in data.values():
+        h = entry.get("headers") or {}
+        if any(str(k).lower() == "cookie" for k in h):
+            entry["headers"] = {k: v for k, v in h.items() if str(k).lower() != "cookie"}
+            entry["cookie"] = True
+    try:
+        with open(path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        os.replace(path + ".tmp", path)
+    except Exception:
+        pass
+
+
+def _url_expiry(url: str) -> float | None:
+    """Срок жизни подписанной ссылки (unix-время) из query, если он там есть."""
+    try:
+        q = urllib.parse.parse_qs(urllib.parse.urlsplit(url).query)
+    except Exception:
+        return None
+    for k in _EXPIRY_QUERY_KEYS:
+        for v in q.get(k, []):
+            if v.isdigit() and len(v) in (10, 13):
+                ts = int(v)
+                return ts / 1000.0 if len(v) == 13 else float(ts)
+    return None
+
+
+def _resolved_entry_expiry(entry: dict) -> float | None:
+    urls = [entry.get("video"), entry.get("master")] + [a.get("uri") for a in entry.get("audios") or []]
+    exps = [e for e in (_url_expiry(u) for u in urls if u) if e]
+    return min(exps) if exps else None
+
+
+def _resolved_cache_peek(item_url: str) -> dict | None:
+    """Запись как есть, без проверки ссылок (например, чтобы взять display_name)."""
+    if not HLS_RESOLVED_CACHE:
+        return None
+    with _RESOLVED_CACHE_LOCK:
+        entry = _load_resolved_cache().get(item_url)
+    return dict(entry) if isinstance(entry, dict) else None
+
+
+def _resolved_cache_drop(item_url: str):
+    with _RESOLVED_CACHE_LOCK:
+        data = _load_resolved_cache()
+        if data.pop(item_url, None) is not None:
+            _save_resolved_cache(data)
+
+
+def _resolved_cache_put(item_url: str, video: str, headers: dict, audios: list, display_name: str | None = None):
+    if not HLS_RESOLVED_CACHE or not video:
+        return
+    entry = {
+        "master": _RESOLVED_MASTERS.pop(item_url, None),
+        "video": video,
+        "audios": [dict(a) for a in (audios or [])],
+        "headers": dict(headers or {}),
+        "resolved_at": time.time(),
+    }
+    if display_name:
+        entry["display_name"] = display_name
+    with _RESOLVED_CACHE_LOCK:
+        data = _load_resolved_cache()
+        old = data.get(item_url) or {}
+        if not display_name and old.get("display_name"):
+            entry["display_name"] = old["display_name"]
+        data[item_url] = entry
+        _save_resolved_cache(data)
+
+
+def _resolved_cache_get(item_url: str, cancel_event=None) -> tuple[str, dict, list] | None:
+    """(video_m3u8, headers, audios) из кэша, если ссылки ещё живы; протухшую запись удаляем."""
+    entry = _resolved_cache_peek(item_url)
+    if not entry or not entry.get("video"):
+        return None
+
+    now = time.time()
+    exp = _resolved_entry_expiry(entry)
+    if exp is not None:
+        fresh = exp - now > HLS_RESOLVED_EXPIRY_MARGIN
+    else:
+        fresh = now - float(entry.get("resolved_at") or 0) < HLS_RESOLVED_MAX_AGE
+    headers = dict(entry.get("headers") or {})
+    if entry.get("cookie"):
+        cookie = _saved_cookie_header(item_url)
+        if cookie:
+            headers["Cookie"] = cookie
+    if fresh:
+        # срок в ссылке — не гарантия (cookies/сессия), проверяем дёшево: один запрос плейлиста
+        # мимо кэша плейлистов — иначе умершая ссылка ещё HLS_PLAYLIST_CACHE_TTL сойдёт за живую
+        _, hdict = _augment_headers(headers)
+        try:
+            _, _, body = _http_request(entry["video"], hdict, timeout=HLS_SNIFF_RANK_TIMEOUT, cancel_event=cancel_event)
+            text = body.decode("utf-8", "ignore")
+            fresh = "#EXTM3U" in text[:1024]
+            if fresh:
+                _playlist_cache_put(entry["video"], hdict, text)
+        except DownloadCancelled:
+            raise
+        except Exception:
+            fresh = False
+    if not fresh:
+        _resolved_cache_drop(item_url)
+        return None
+    return entry["video"], headers, list(entry.get("audios") or [])
+
+
+def prepare_hls_info(item_url: str, driver=None, cancel_event=None, status_cb=None, display_name: str | None = None) -> bool:
+    """
+    Разбор HLS заранее (look-ahead очереди): кладёт готовый манифест в кэш разобранных ссылок,
+    чтобы download_by_item_url сразу начал качать сегменты. driver=None — только без браузера.
+    """
+    try:
+        if _resolved_cache_get(item_url, cancel_event=cancel_event):
+            return True
+        info = _resolve_hls_http(item_url, cancel_event=cancel_event, status_cb=status_cb)
+        if not info and driver is not None:
+            info = get_hls_info(item_url, driver=driver, cancel_event=cancel_event, status_cb=status_cb)
+        if not info or not info[0]:
+            return False
+        video_m3u8, hdrs2, audios = info
+        _resolved_cache_put(item_url, video_m3u8, hdrs2, audios, display_name=display_name)
+        return True
+    except DownloadCancelled:
+        return False
+
+
+def _type_and_pick(driver, query: str, wanted_title: str, wanted_year: str | None):
+    # поле поиска
+    search = WebDriverWait(driver, 15).until(
+        EC.element_to_be_clickable(
+            (By.CSS_SELECTOR, "input[name='query'], input[type='search'], input[name='q']")
+        )
+    )
+    driver.execute_script("arguments[0].value=''; arguments[0].focus();", search)
+    search.send_keys(query)
+
+    # короткие/цифровые — пробел, чтобы гарантировать автокомплит
+    core = re.sub(r"[^\w]+", "", query)
+    if core.isdigit() and len(core) <= 2:
+        search.send_keys(Keys.SPACE)
+
+    # 1) пробуем подсказки
+    try:
+        box = WebDriverWait(driver, 6).until(
+            EC.visibility_of_element_located(
+                (
+                    By.CSS_SELECTOR,
+                    "div.search-suggest, ul[role='listbox'], .autocomplete, .typeahead, .ui-autocomplete, .dropdown-menu",
+                )
+            )
+        )
+        # ищем кликабельные элементы
+        items = []
+        for css in ("a[href*='/item/view/']", "li a[href]", "a[href]"):
+            items = box.find_elements(By.CSS_SELECTOR, css)
+            if items:
+                break
+
+        if items:
+            idx = _best_match_index(items, wanted_title, wanted_year)
+            if idx is None:
+                idx = 0
+
+            # сначала пытаемся JS-клик
+            try:
+                driver.execute_script("arguments[0].scrollIntoView({block:'center'});", items[idx])
+                driver.execute_script("arguments[0].click()", items[idx])
+                WebDriverWait(driver, 8).until(lambda d: "/item/view/" in d.current_url)
+                return True
+            except Exception:
+                # если кликом не ушли — берём href и переходим напрямую
+                href = items[idx].get_attribute("href")
+                if href:
+                    driver.get(href)
+                    WebDriverWait(driver, 10).until(lambda d: "/item/view/" in d.current_url)
+                    return True
+    except Exception:
+        pass
+
+    # 2) fallback: страница поиска и первая карточка
+    try:
+        driver.get(f"{BASE_URL}/item/search?query=" + quote_plus(query))
+        WebDriverWait(driver, 12).until(
+            lambda d: d.find_elements(By.XPATH, "//a[contains(@href,'/item/view/')]")
+            or "Нет результатов" in d.page_source
+        )
+        links = driver.find_elements(By.XPATH, "//a[contains(@href,'/item/view/')]")
+        if links:
+            href = links[0].get_attribute("href")
+            if href:
+                driver.get(href)
+                WebDriverWait(driver, 10).until(lambda d: "/item/view/" in d.current_url)
+                return True
+    except Exception:
+        pass
+
+    # 3) последний резерв: Enter по полю поиска
+    try:
+        search.send_keys(Keys.ENTER)
+        WebDriverWait(driver, 10).until(
+            lambda d: "/item/search" in d.current_url or "/item/view/" in d.current_url
+        )
+        if "/item/search" in driver.current_url:
+            links = driver.find_elements(By.XPATH, "//a[contains(@href,'/item/view/')]")
+            if links:
+                href = links[0].get_attribute("href")
+                if href:
+                    driver.get(href)
+                    WebDriverWait(driver, 10).until(lambda d: "/item/view/" in d.current_url)
+                    return True
+        return "/item/view/" in driver.current_url
+    except Exception:
+        return False
+
+def _best_match_index(elements, wanted_title: str, wanted_year: str | None):
+    base = _strip_year(wanted_title)[0]
+    base_n = _norm(base)
+    best_i, best_s = None, 0
+
+    for i, el in enumerate(elements):
+        try:
+            txt = el.text.strip()
+        except Exception:
+            continue
+        # Вытащим год из строки
         m = re.search(r"(19|20)\d{2}", txt)
         year = m.group(0) if m else None
         name = _strip_year(txt)[0]
@@ -1852,7 +3192,6 @@ def search_and_download(title: str, out_path: str) -> bool:
 
         _inject_m3u8_sniffer_js(drv)
         _start_playback(drv)
-        time.sleep(2)
 
         # 3) master.m3u8 + заголовки
         master, hdrs = _sniff_hls_with_cdp(drv, timeout=10)
@@ -1909,7 +3248,6 @@ def search_and_download_with_driver(
         )
         _inject_m3u8_sniffer_js(drv)
         _start_playback(drv)
-        time.sleep(2.0)
 
         # 3) master.m3u8 + заголовки
         master, hdrs = _sniff_hls_with_cdp(drv, timeout=sniff_timeout)
@@ -2006,76 +3344,1326 @@ import shutil
 # -------------------------------------------------------------------------
 import concurrent.futures
 
-def _http_download(url: str, headers: dict, attempt=1, max_tries=50, cancel_event=None):
-    """Скачивание сегмента с жесткими ретраями до 200 OK."""
-    _raise_if_cancelled(cancel_event)
-    _, hdict = _augment_headers(headers)
-    import ssl, urllib.error
-
-    ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
-    ctx.check_hostname = False
-    ctx.verify_mode = ssl.CERT_NONE
-    try: ctx.set_ciphers("DEFAULT:@SECLEVEL=1")
-    except: pass
-    if hasattr(ssl, "OP_IGNORE_UNEXPECTED_EOF"):
-        ctx.options |= ssl.OP_IGNORE_UNEXPECTED_EOF
+# --- Адаптивный лимит параллельных запросов сегментов на CDN-хост (AIMD) ---
+HLS_HOST_MIN_PARALLEL = 2  # ниже не опускаемся даже при сплошных 429
+HLS_HOST_START_PARALLEL = 8  # стартовый лимит для нового хоста
+# потолок (и число тредов на поток по умолчанию) = числу сокетов пула: сверх него треды только ждут слот
+HLS_HOST_MAX_PARALLEL = HLS_POOL_MAX_PER_HOST
+HLS_HOST_RETRY_AFTER_MAX = 60.0  # дольше Retry-After не ждём (сек)
 
-    req = urllib.request.Request(url, headers=hdict)
-    last_err = None
-    last_code = None
-    forbidden_streak = 0
 
-    for i in range(1, max_tries + 1):
-        _raise_if_cancelled(cancel_event)
-        try:
-            with _HLS_SEGMENT_SEMA:
-                with urllib.request.urlopen(req, timeout=15, context=ctx) as r:
-                    code = int(getattr(r, "status", 200) or 0)
-                    if 200 <= code < 300:
-                        return r.read()
-                    last_code = code
-                    last_err = RuntimeError(f"HTTP {code}")
-        except urllib.error.HTTPError as e:
-            last_code = int(getattr(e, "code", 0) or 0)
-            last_err = e
-        except Exception as e:
-            last_code = None
-            last_err = e
+class _HostLimiter:
+    """
+    Лимит одновременных запросов к одному хосту, общий для всех потоков/загрузок.
+    Растёт на +1 за эпоху, пока пропускная способность растёт, а задержка не растёт;
+    режется вдвое на 429/5xx/таймаутах, Retry-After ставит хост на паузу.
+    """
 
-        _raise_if_cancelled(cancel_event)
+    def __init__(self, host: str):
+        self.host = host
+        self.limit = float(HLS_HOST_START_PARALLEL)
+        self.inflight = 0
+        self.reason = ""
+        self._reason_ts = 0.0
+        self._paused_until = 0.0
+        self._last_cut = 0.0
+        self._base_lat = None
+        self._prev_tput = None
+        self._fail_limit = None  # лимит, на котором хост в последний раз начал отказывать
+        self._good_epochs = 0
+        self._cond = threading.Condition()
+        self._reset_epoch(time.time())
+
+    def _reset_epoch(self, now: float) -> None:
+        self._ep_start = now
+        self._ep_bytes = 0
+        self._ep_lats: list[float] = []
+        self._ep_err = False
+
+    def _set_reason(self, reason: str, now: float) -> None:
+        self.reason = reason
+        self._reason_ts = now
+
+    def acquire(self, cancel_event=None) -> None:
+        with self._cond:
+            while True:
+                _raise_if_cancelled(cancel_event)
+                now = time.time()
+                if now >= self._paused_until and self.inflight < min(int(self.limit), HLS_HOST_MAX_PARALLEL):
+                    self.inflight += 1
+                    return
+                wait = 0.2
+                if now < self._paused_until:
+                    wait = min(wait, self._paused_until - now)
+                self._cond.wait(max(0.01, wait))
+
+    def release(self) -> None:
+        with self._cond:
+            self.inflight = max(0, self.inflight - 1)
+            self._cond.notify_all()
+
+    def on_success(self, elapsed: float, nbytes: int) -> None:
+        with self._cond:
+            now = time.time()
+            self._ep_bytes += int(nbytes or 0)
+            self._ep_lats.append(max(0.001, float(elapsed)))
+            if len(self._ep_lats) < max(4, int(self.limit)):
+                return
 
-        # если постоянно 401/403 — токен/куки могли протухнуть, бессмысленно ждать 50 попыток
-        if last_code in (401, 403):
-            forbidden_streak += 1
+            lats = sorted(self._ep_lats)
+            lat = lats[len(lats) // 2]
+            tput = self._ep_bytes / max(0.05, now - self._ep_start)
+            if self._base_lat is None:
+                self._base_lat = lat
+            else:
+                # базовая задержка медленно «дрейфует» вверх, чтобы не застрять на случайном минимуме
+                self._base_lat = min(lat, self._base_lat * 1.05)
+
+            if not self._ep_err:
+                self._good_epochs += 1
+                # у точки последнего отказа пробуем расти реже
+                near_fail = self._fail_limit is not None and self.limit + 1.0 >= self._fail_limit
+                if self._prev_tput is None or (tput >= self._prev_tput * 1.05 and lat <= self._base_lat * 1.5):
+                    if self.limit < HLS_HOST_MAX_PARALLEL and (not near_fail or self._good_epochs >= 8):
+                        self.limit = min(float(HLS_HOST_MAX_PARALLEL), self.limit + 1.0)
+                        self._good_epochs = 0
+                        self._cond.notify_all()
+                elif lat > self._base_lat * 2.0 and tput < self._prev_tput * 1.02:
+                    # параллельность больше не даёт скорости, только очередь на сервере
+                    self.limit = max(float(HLS_HOST_MIN_PARALLEL), self.limit - 1.0)
+                    self._set_reason("lat", now)
+            self._prev_tput = tput
+            self._reset_epoch(now)
+
+    def on_error(self, code: int | None = None, timeout: bool = False, retry_after: float | None = None) -> None:
+        if code == 429:
+            reason = "429"
+        elif isinstance(code, int) and code >= 500:
+            reason = str(code)
+        elif timeout:
+            reason = "timeout"
         else:
-            forbidden_streak = 0
+            return
+        with self._cond:
+            now = time.time()
+            self._ep_err = True
+            self._set_reason(reason, now)
+            if retry_after:
+                ra = max(0.0, min(float(retry_after), HLS_HOST_RETRY_AFTER_MAX))
+                self._paused_until = max(self._paused_until, now + ra)
+            # одна пачка ошибок от уже летящих запросов = одно снижение
+            if now - self._last_cut >= max(0.5, self._base_lat or 0.5):
+                self._last_cut = now
+                self._fail_limit = self.limit
+                self._good_epochs = 0
+                self.limit = max(float(HLS_HOST_MIN_PARALLEL), self.limit * 0.5)
+                self._prev_tput = None
+                self._reset_epoch(now)
+
+    def describe(self) -> str:
+        """Короткая строка для статуса: «×8» или «×4 429»."""
+        now = time.time()
+        txt = f"×{int(self.limit)}"
+        if now < self._paused_until:
+            txt += f" пауза {int(self._paused_until - now + 0.99)}с"
+        elif self.reason and now - self._reason_ts < 15.0:
+            txt += f" {self.reason}"
+        return txt
+
+
+_HOST_LIMITERS: dict[str, _HostLimiter] = {}
+_HOST_LIMITERS_LOCK = threading.Lock()
+
+
+def _host_limiter(url: str) -> _HostLimiter:
+    try:
+        host = (urllib.parse.urlsplit(url).hostname or "").lower()
+    except Exception:
+        host = ""
+    with _HOST_LIMITERS_LOCK:
+        lim = _HOST_LIMITERS.get(host)
+        if lim is None:
+            lim = _HOST_LIMITERS[host] = _HostLimiter(host)
+        return lim
 
-        if forbidden_streak >= 8:
-            break
 
-        # backoff + jitter (429/5xx дольше)
-        base_sleep = 0.25 * i
-        if last_code == 429:
-            base_sleep = 0.8 * i
+def _is_timeout_error(e: Exception) -> bool:
+    if isinstance(e, TimeoutError):
+        return True
+    reason = getattr(e, "reason", None)
+    return isinstance(reason, TimeoutError) or "timed out" in str(e).lower()
+
+
+def _retry_after_seconds(headers) -> float | None:
+    try:
+        ra = headers.get("Retry-After") if headers else None
+        if not ra:
+            return None
+        ra = str(ra).strip()
+        if ra.isdigit():
+            return float(ra)
+        # HTTP-date
+        import email.utils
+        dt = email.utils.parsedate_to_datetime(ra)
+        return max(0.0, dt.timestamp() - time.time())
+    except Exception:
+        return None
+
+
+def set_hls_host_parallel(start: int | None = None, max_parallel: int | None = None):
+    """
+    Глобальная настройка: стартовый и максимальный лимит параллельных запросов на CDN-хост.
+    Максимум — это и число сокетов пула на хост: пулы пересоздаются с новым лимитом.
+    """
+    global HLS_HOST_START_PARALLEL, HLS_HOST_MAX_PARALLEL, HLS_POOL_MAX_PER_HOST
+    if max_parallel is not None:
+        HLS_HOST_MAX_PARALLEL = HLS_POOL_MAX_PER_HOST = max(HLS_HOST_MIN_PARALLEL, int(max_parallel))
+        with _HOST_POOLS_LOCK:
+            old = list(_HOST_POOLS.values())
+            _HOST_POOLS.clear()
+        # занятые соединения старых пулов доработают и закроются вместе с ними
+        for pool in old:
+            with pool.lock:
+                idle, pool.idle = pool.idle, []
+            for conn, _ts in idle:
+                _close_quietly(conn)
+    if start is not None:
+        HLS_HOST_START_PARALLEL = max(HLS_HOST_MIN_PARALLEL, min(int(start), HLS_HOST_MAX_PARALLEL))
+
+
+HLS_SEGMENT_MAX_TRIES = 50  # попыток на один сегмент
+HLS_FORBIDDEN_STREAK_MAX = 8  # столько 401/403 подряд — токен/куки протухли, дальше не пробуем
+
+
+HLS_RANGE_CHUNK_BYTES = 8 * 1024 * 1024  # соседние EXT-X-BYTERANGE одного файла склеиваем в Range до такого размера
+
+
+def _range_body(status: int, body: bytes, byterange: tuple[int, int]) -> bytes:
+    """Тело ответа на Range-запрос ровно нужной длины (200 без поддержки Range — вырезаем сами)."""
+    o, n = byterange
+    if status == 206:
+        if len(body) != n:
+            raise ValueError(f"Range: получено {len(body)} байт вместо {n}")
+        return body
+    if len(body) >= o + n:
+        return body[o:o + n]
+    raise ValueError(f"Range проигнорирован, а файл короче ({len(body)} < {o + n})")
+
+
+def _http_fetch_segment(
+    url: str, hdict: dict, cancel_event=None, byterange: tuple[int, int] | None = None, size_cb=None
+) -> bytes:
+    """Одна попытка скачать сегмент через лимитер хоста (ошибки — наверх, без ретраев).
+    byterange=(offset, length) — только этот кусок файла (Range).
+    size_cb(n) — размер сегмента из заголовков, до тела (для Range не зовём: 200 вместо 206 — весь файл)."""
+    if byterange is not None:
+        hdict = dict(hdict, Range=f"bytes={byterange[0]}-{byterange[0] + byterange[1] - 1}")
+    lim = _host_limiter(url)
+    lim.acquire(cancel_event)
+    t0 = time.time()
+    try:
+        status, _, body = _http_request(
+            url, hdict, timeout=15, cancel_event=cancel_event, size_cb=size_cb if byterange is None else None
+        )
+        if byterange is not None:
+            body = _range_body(status, body, byterange)
+        lim.on_success(time.time() - t0, len(body))
+        return body
+    except DownloadCancelled:
+        raise
+    except HttpStatusError as e:
+        lim.on_error(e.code, retry_after=_retry_after_seconds(e.headers))
+        raise
+    except Exception as e:
+        lim.on_error(timeout=_is_timeout_error(e))
+        raise
+    finally:
+        lim.release()
+
+
+def _retry_delay(n: int, code: int | None) -> float:
+    """backoff + jitter для n-й подряд неудачи (429/5xx дольше)."""
+    base_sleep = 0.25 * n
+    if code == 429:
+        # Retry-After выдерживает лимитер хоста (пауза для всех запросов к нему)
+        base_sleep = 0.8 * n
+    elif isinstance(code, int) and code >= 500:
+        base_sleep = 0.6 * n
+    return min(base_sleep, 6.0) + random.uniform(0.0, 0.35)
+
+
+def _http_download(url: str, headers: dict, attempt=1, max_tries=HLS_SEGMENT_MAX_TRIES, cancel_event=None):
+    """Скачивание сегмента с жесткими ретраями до 200 OK."""
+    _raise_if_cancelled(cancel_event)
+    _, hdict = _augment_headers(headers)
+
+    last_err = None
+    last_code = None
+    forbidden_streak = 0
+
+    for i in range(1, max_tries + 1):
+        _raise_if_cancelled(cancel_event)
+        try:
+            return _http_fetch_segment(url, hdict, cancel_event=cancel_event)
+        except DownloadCancelled:
+            raise
+        except HttpStatusError as e:
+            last_code = e.code
+            last_err = e
+        except Exception as e:
+            last_code = None
+            last_err = e
+
+        _raise_if_cancelled(cancel_event)
+
+        # если постоянно 401/403 — токен/куки могли протухнуть, бессмысленно ждать 50 попыток
+        if last_code in (401, 403):
+            forbidden_streak += 1
+        else:
+            forbidden_streak = 0
+
+        if forbidden_streak >= HLS_FORBIDDEN_STREAK_MAX:
+            break
+
+        time.sleep(_retry_delay(i, last_code))
+
+    raise RuntimeError(f"SEGMENT FAIL ({last_code or last_err}): {url}")
+
+
+class _StreamRetries:
+    """
+    Отложенные повторы упавших сегментов одного потока.
+    Воркер делает одну попытку; упавший сегмент ждёт тут своей очереди, пока здоровые качаются дальше.
+    Задержка общая на поток: растёт с серией неудач подряд и спадает на успехах.
+    """
+
+    def __init__(self, max_tries: int | None = None):
+        self.max_tries = int(max_tries or HLS_SEGMENT_MAX_TRIES)
+        self.attempts: dict[int, int] = {}
+        self.streak = 0
+        self.forbidden_streak = 0
+        self._heap: list[tuple[float, int]] = []
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def failed(self, idx: int, url: str, err: Exception) -> None:
+        code = getattr(err, "code", None) if isinstance(err, HttpStatusError) else None
+        n = self.attempts[idx] = self.attempts.get(idx, 0) + 1
+        # если постоянно 401/403 — токен/куки могли протухнуть, бессмысленно ждать 50 попыток
+        if code in (401, 403):
+            self.forbidden_streak += 1
+        else:
+            self.forbidden_streak = 0
+        if n >= self.max_tries or self.forbidden_streak >= HLS_FORBIDDEN_STREAK_MAX:
+            raise RuntimeError(f"SEGMENT FAIL ({code or err}): {url}")
+        self.streak += 1
+        heapq.heappush(self._heap, (time.time() + _retry_delay(max(n, self.streak), code), int(idx)))
+
+    def succeeded(self) -> None:
+        self.streak //= 2
+        self.forbidden_streak = 0
+
+    def due(self) -> list[int]:
+        now = time.time()
+        out = []
+        while self._heap and self._heap[0][0] <= now:
+            out.append(heapq.heappop(self._heap)[1])
+        return out
+
+    def wait_time(self) -> float:
+        return max(0.0, self._heap[0][0] - time.time()) if self._heap else 0.0
+
+
+class _ByteBudget:
+    """
+    Общий на процесс счётчик байт reorder-буферов: готовые сегменты в очереди на запись
+    плюс резерв под сегменты в полёте (оценка размера, при получении заменяется фактом).
+    """
+
+    def __init__(self, limit: int):
+        self.limit = int(limit)
+        self.used = 0
+        self._lock = threading.Lock()
+
+    def add(self, n: int) -> None:
+        with self._lock:
+            self.used += int(n)
+
+    def sub(self, n: int) -> None:
+        with self._lock:
+            self.used = max(0, self.used - int(n))
+
+    def try_add(self, n: int) -> bool:
+        """Занять n байт, только если они влезают в лимит (проверка и резерв — атомарно)."""
+        with self._lock:
+            if self.used + int(n) >= self.limit:
+                return False
+            self.used += int(n)
+            return True
+
+    def settle(self, reserved: int, actual: int) -> None:
+        """Резерв под сегмент заменяется его фактическим размером."""
+        with self._lock:
+            self.used = max(0, self.used - int(reserved) + int(actual))
+
+
+_REORDER_BUDGET = _ByteBudget(HLS_TOTAL_BUFFER_MAX_BYTES)
+
+
+def set_hls_buffer_limits(per_stream_mb: int | None = None, total_mb: int | None = None):
+    """
+    Глобальная настройка: лимиты памяти под reorder-буферы (МБ на поток / МБ на процесс).
+    Лимит мягкий ровно на один сегмент: следующий к записи сегмент отправляется всегда,
+    а фактический размер может превысить оценку, под которую он резервировался.
+    """
+    global HLS_STREAM_BUFFER_MAX_BYTES
+    if per_stream_mb is not None:
+        HLS_STREAM_BUFFER_MAX_BYTES = max(4, int(per_stream_mb)) * 1024 * 1024
+    if total_mb is not None:
+        _REORDER_BUDGET.limit = max(16, int(total_mb)) * 1024 * 1024
+
+
+def _stream_units(media, segments=None) -> tuple[list[str], list[tuple[int, int] | None]]:
+    """
+    Единицы скачивания потока: URL и диапазон (offset, length) или None.
+    Соседние EXT-X-BYTERANGE одного файла склеиваются в один Range до HLS_RANGE_CHUNK_BYTES,
+    чтобы single-file HLS качался десятками больших запросов, а не тысячами мелких.
+    """
+    urls: list[str] = []
+    ranges: list[tuple[int, int] | None] = []
+    for uri, br in hls_playlist.segment_parts(media, segments):
+        if br is not None and urls and urls[-1] == uri and ranges[-1] is not None:
+            o, n = ranges[-1]
+            if o + n == br.offset and n + br.length <= HLS_RANGE_CHUNK_BYTES:
+                ranges[-1] = (o, n + br.length)
+                continue
+        urls.append(uri)
+        ranges.append((br.offset, br.length) if br is not None else None)
+    return urls, ranges
+
+
+def _normalize_clip(clip) -> tuple[float, float] | None:
+    """(start, end) в секундах от начала тайтла; None — весь тайтл."""
+    if clip is None:
+        return None
+    start, end = float(clip[0]), float(clip[1])
+    if start < 0 or end <= start:
+        raise ValueError(f"Неверный интервал клипа: {clip}")
+    return start, end
+
+
+def _media_units(text: str, m3u8_url: str, clip: tuple[float, float] | None = None):
+    """_stream_units плейлиста; с clip — только сегменты, покрывающие отрезок."""
+    media = hls_playlist.parse_media(text, m3u8_url)
+    if clip is None:
+        return _stream_units(media)
+    return _stream_units(media, hls_playlist.clip_segments(media, *clip)[0])
+
+
+def _clip_lead(m3u8_url: str, headers: dict, clip: tuple[float, float], cancel_event=None) -> float:
+    """Сколько секунд в начале скачанного куска лежит до clip[0] (плейлист берётся из кэша)."""
+    text = _http_get_text(m3u8_url, headers, cancel_event=cancel_event)
+    return hls_playlist.clip_segments(hls_playlist.parse_media(text, m3u8_url), *clip)[1]
+
+
+def _clip_input_args(lead: float | None) -> list[str]:
+    """-ss перед -i: отрезать начало первого сегмента до точки старта клипа."""
+    return ["-ss", f"{lead:.3f}"] if lead and lead > 0.001 else []
+
+
+def _clip_output_args(clip) -> list[str]:
+    return ["-t", f"{float(clip[1]) - float(clip[0]):.3f}"] if clip else []
+
+
+def _stream_signature(m3u8_url: str, segments: list[str], ranges: list | None = None) -> str:
+    """
+    Подпись потока для журнала докачки: пути плейлиста и сегментов БЕЗ query
+    (подписанные токены в query меняются при каждом новом анализе HLS) и диапазоны BYTERANGE.
+    """
+    import hashlib
+
+    h = hashlib.sha1()
+    try:
+        h.update(urllib.parse.urlsplit(m3u8_url).path.encode("utf-8", "ignore"))
+    except Exception:
+        pass
+    for seg in segments:
+        try:
+            h.update(b"\n" + urllib.parse.urlsplit(seg).path.encode("utf-8", "ignore"))
+        except Exception:
+            h.update(b"\n")
+    for r in ranges or ():
+        h.update(f"@{r[0]}+{r[1]}".encode() if r else b"@")
+    return f"{len(segments)}:{h.hexdigest()}"
+
+
+class _SegmentJournal:
+    """
+    Журнал докачки рядом с `.part`: JSON lines.
+    1-я строка — заголовок {"sig": ..., "total": N, "meta": {...}}, далее {"i": idx, "off": offset, "len": size}
+    для каждого сегмента, уже записанного на диск.
+    """
+
+    def __init__(self, path: str, sig: str, total: int):
+        self.path = path
+        self.sig = sig
+        self.total = int(total)
+        self.meta: dict = {}
+        self._fh = None
+        self._lock = threading.Lock()
+
+    def load(self) -> dict[int, tuple[int, int]]:
+        """Возвращает {idx: (offset, size)} или {}, если журнала нет или он от другого потока."""
+        done: dict[int, tuple[int, int]] = {}
+        self.meta = {}
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                head = json.loads(f.readline() or "{}")
+                if head.get("sig") != self.sig:
+                    return {}
+                self.meta = dict(head.get("meta") or {})
+                for ln in f:
+                    try:
+                        rec = json.loads(ln)
+                        i, off, n = int(rec["i"]), int(rec["off"]), int(rec["len"])
+                    except Exception:
+                        # недописанная строка (краш посреди записи) — просто пропускаем
+                        continue
+                    if 0 <= i < self.total and off >= 0 and n >= 0:
+                        done[i] = (off, n)
+        except Exception:
+            return {}
+        return done
+
+    def open(self, fresh: bool, meta: dict | None = None) -> None:
+        with self._lock:
+            if fresh:
+                self.meta = dict(meta or {})
+                self._fh = open(self.path, "w", encoding="utf-8")
+                self._fh.write(json.dumps({"sig": self.sig, "total": self.total, "meta": self.meta}) + "\n")
+                self._fh.flush()
+            else:
+                self._fh = open(self.path, "a", encoding="utf-8")
+
+    def record(self, idx: int, off: int, size: int) -> None:
+        with self._lock:
+            if self._fh is None:
+                return
+            self._fh.write(json.dumps({"i": int(idx), "off": int(off), "len": int(size)}) + "\n")
+            self._fh.flush()
+
+    def close(self) -> None:
+        with self._lock:
+            if self._fh is not None:
+                try:
+                    self._fh.close()
+                except Exception:
+                    pass
+                self._fh = None
+
+    def remove(self) -> None:
+        self.close()
+        try:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+        except Exception:
+            pass
+
+
+def _journal_resume_prefix(done: dict[int, tuple[int, int]], file_size: int) -> tuple[int, int]:
+    """
+    Для последовательной записи: сколько сегментов подряд с начала файла реально лежат на диске.
+    Возвращает (кол-во сегментов, длина валидного префикса в байтах).
+    """
+    k = 0
+    end = 0
+    while k in done:
+        off, n = done[k]
+        if off != end or off + n > file_size:
+            break
+        end = off + n
+        k += 1
+    return k, end
+
+
+# --- Запись сегментов на диск ---
+# "auto"    — позиционная запись в заранее размеченный файл, когда размеры сегментов известны без запросов
+#             (EXT-X-BYTERANGE или журнал прошлой попытки), иначе "grow" — первый байт сразу, без HEAD;
+# "grow"    — размеры узнаём из Content-Length по ходу, сегмент пишется на своё место в растущий файл;
+# "spill"   — каждый сегмент отдельным файлом сразу по приходу, склейка по порядку в конце
+#             (запасной путь, если размер сегмента разошёлся с Content-Length);
+# "ordered" — строго по порядку через reorder-буфер в памяти (последовательный поток байт).
+HLS_WRITE_MODE = "auto"
+
+
+class _SegmentSizeMismatch(RuntimeError):
+    pass
+
+
+def _pwrite_all(fd: int, data: bytes, off: int) -> None:
+    view = memoryview(data)
+    while view:
+        if hasattr(os, "pwrite"):
+            n = os.pwrite(fd, view, off)
+        else:
+            # Windows: os.pwrite нет — lseek+write (вызывающий держит lock)
+            os.lseek(fd, off, os.SEEK_SET)
+            n = os.write(fd, view)
+        view = view[n:]
+        off += n
+
+
+class _OrderedWriter:
+    """Запись строго по порядку сегментов; пока нет предыдущих — держим готовые в памяти."""
+
+    mode = "ordered"
+
+    def __init__(self, tmp: str, journal: _SegmentJournal):
+        self.tmp = tmp
+        self.journal = journal
+        self.next_write = 0
+        self.buffered = 0
+        self.reserved = 0  # резерв под сегменты в полёте (оценка размера)
+        self._reserved: dict[int, int] = {}
+        self._pending: dict[int, bytes] = {}
+        self._f = None
+        self._closed = False
+        self._lock = threading.Lock()
+
+    def prepare(self, done: dict[int, tuple[int, int]], resumable: bool) -> set[int]:
+        resume_cnt, resume_bytes = 0, 0
+        if resumable and os.path.isfile(self.tmp):
+            resume_cnt, resume_bytes = _journal_resume_prefix(done, os.path.getsize(self.tmp))
+        if resume_cnt > 0:
+            self._f = open(self.tmp, "r+b")
+            self._f.truncate(resume_bytes)
+            self._f.seek(resume_bytes)
+            self.journal.open(fresh=False)
+        else:
+            self._f = open(self.tmp, "wb")
+            self.journal.open(fresh=True, meta={"mode": self.mode})
+        self.next_write = resume_cnt
+        return set(range(resume_cnt))
+
+    def put(self, idx: int, chunk: bytes) -> None:
+        n = len(chunk)
+        with self._lock:
+            if self._closed:
+                return
+            self._pending[int(idx)] = chunk
+            self.buffered += n
+            r = self._reserved.pop(int(idx), 0)
+            self.reserved -= r
+        _REORDER_BUDGET.settle(r, n)
+
+    def drain(self, cancel_event=None) -> None:
+        while True:
+            with self._lock:
+                chunk = self._pending.pop(self.next_write, None)
+            if chunk is None:
+                return
+            _raise_if_cancelled(cancel_event)
+            off = self._f.tell()
+            self._f.write(chunk)
+            self._f.flush()
+            # в журнал — только после того, как данные ушли в файл
+            self.journal.record(self.next_write, off, len(chunk))
+            with self._lock:
+                self.buffered -= len(chunk)
+            _REORDER_BUDGET.sub(len(chunk))
+            self.next_write += 1
+
+    def can_submit(self, idx: int, reserve: int) -> bool:
+        """Резервирует reserve байт под сегмент idx до его получения; False — буферы заняты, ждём записи."""
+        idx, reserve = int(idx), max(0, int(reserve))
+        with self._lock:
+            if self._closed or idx in self._reserved:
+                return True
+            if idx <= self.next_write:
+                # сегмент next_write пропускаем всегда — иначе запись может встать навсегда
+                _REORDER_BUDGET.add(reserve)
+            elif self.buffered + self.reserved + reserve >= HLS_STREAM_BUFFER_MAX_BYTES:
+                return False
+            elif not _REORDER_BUDGET.try_add(reserve):
+                return False
+            self._reserved[idx] = reserve
+            self.reserved += reserve
+        return True
+
+    def close(self) -> None:
+        with self._lock:
+            self._closed = True
+            n = self.buffered + self.reserved
+            self.buffered = self.reserved = 0
+            self._pending.clear()
+            self._reserved.clear()
+        if n > 0:
+            _REORDER_BUDGET.sub(n)
+        if self._f is not None:
             try:
-                ra = getattr(last_err, "headers", None)
-                ra = ra.get("Retry-After") if ra else None
-                if ra:
-                    base_sleep = max(base_sleep, float(ra))
+                self._f.close()
             except Exception:
                 pass
-        elif isinstance(last_code, int) and last_code >= 500:
-            base_sleep = 0.6 * i
+            self._f = None
 
-        time.sleep(min(base_sleep, 6.0) + random.uniform(0.0, 0.35))
+    def finalize(self, out_path: str) -> None:
+        self.close()
+        os.replace(self.tmp, out_path)
+
+    def discard(self) -> None:
+        self.close()
+        self.journal.remove()
+        try:
+            if os.path.exists(self.tmp):
+                os.remove(self.tmp)
+        except Exception:
+            pass
 
-    raise RuntimeError(f"SEGMENT FAIL ({last_code or last_err}): {url}")
+
+# --- Потоковый MUX: сегменты сразу в ffmpeg через именованные каналы ---
+HLS_STREAM_MUX = False  # opt-in: без video.ts/audio_N.aac в .parts; при любой ошибке — обычный путь
+HLS_PIPE_BUFFER_BYTES = 1024 * 1024  # буфер канала (Windows)
+
+
+def set_hls_stream_mux(enabled: bool):
+    """Глобальная настройка: отдавать сегменты в ffmpeg по мере скачивания (без промежуточных файлов)."""
+    global HLS_STREAM_MUX
+    HLS_STREAM_MUX = bool(enabled)
+
+
+def _pipes_supported() -> bool:
+    if os.name == "nt":
+        try:
+            import win32pipe  # noqa: F401
+            import win32file  # noqa: F401
+            return True
+        except Exception:
+            return False
+    return hasattr(os, "mkfifo")
+
+
+class _PipeSink:
+    """
+    Именованный канал одной дорожки: ffmpeg открывает path как обычный вход, мы пишем сегменты по порядку.
+    *nix — FIFO в .parts, Windows — именованный канал pywin32.
+    """
+
+    def __init__(self, tmp_dir: str, name: str):
+        import uuid
+
+        self._dead = threading.Event()  # ffmpeg завершился/отмена — ждать читателя больше незачем
+        self._fd = None
+        self._h = None
+        self._connected = False
+        if os.name == "nt":
+            import win32pipe
+
+            self.path = rf"\\.\pipe\kino_{uuid.uuid4().hex}_{name}"
+            self._h = win32pipe.CreateNamedPipe(
+                self.path,
+                win32pipe.PIPE_ACCESS_OUTBOUND,
+                win32pipe.PIPE_TYPE_BYTE | win32pipe.PIPE_WAIT,
+                1,
+                HLS_PIPE_BUFFER_BYTES,
+                HLS_PIPE_BUFFER_BYTES,
+                0,
+                None,
+            )
+        else:
+            self.path = os.path.join(tmp_dir, f"{name}.fifo")
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            os.mkfifo(self.path)
+
+    def _connect(self, cancel_event=None) -> None:
+        """Ждём, пока ffmpeg откроет канал на чтение (он открывает входы по очереди)."""
+        if self._connected:
+            return
+        if os.name == "nt":
+            import win32pipe
+
+            win32pipe.ConnectNamedPipe(self._h, None)  # abort() разбудит, подключившись сам
+            if self._dead.is_set():
+                raise BrokenPipeError("ffmpeg завершился, не открыв канал")
+        else:
+            import errno
+
+            while True:
+                _raise_if_cancelled(cancel_event)
+                if self._dead.is_set():
+                    raise BrokenPipeError("ffmpeg завершился, не открыв канал")
+                try:
+                    self._fd = os.open(self.path, os.O_WRONLY | os.O_NONBLOCK)
+                    break
+                except OSError as e:
+                    if e.errno != errno.ENXIO:  # ENXIO — читателя ещё нет
+                        raise
+                time.sleep(0.05)
+            os.set_blocking(self._fd, True)
+        self._connected = True
+
+    def write(self, data: bytes, cancel_event=None) -> None:
+        """Блокирующая запись: ffmpeg читает медленнее — тормозим и скачивание (backpressure)."""
+        self._connect(cancel_event)
+        view = memoryview(data)
+        if os.name == "nt":
+            import win32file
+
+            while view:
+                _, n = win32file.WriteFile(self._h, view[:HLS_PIPE_BUFFER_BYTES])
+                view = view[n:]
+        else:
+            while view:
+                n = os.write(self._fd, view)
+                view = view[n:]
+
+    def finish(self) -> None:
+        """Конец потока: ffmpeg видит EOF этой дорожки (пустую дорожку тоже нужно «открыть»)."""
+        try:
+            self._connect()
+            if os.name == "nt":
+                import win32file
+
+                win32file.FlushFileBuffers(self._h)  # иначе CloseHandle выбросит непрочитанный хвост
+        finally:
+            self.close()
+
+    def abort(self) -> None:
+        """Разбудить ожидание ffmpeg и закрыть канал без гарантий доставки."""
+        self._dead.set()
+        if os.name == "nt" and self._h is not None and not self._connected:
+            try:
+                import win32file
+
+                h = win32file.CreateFile(self.path, win32file.GENERIC_READ, 0, None, win32file.OPEN_EXISTING, 0, None)
+                win32file.CloseHandle(h)
+                self._connected = True
+            except Exception:
+                pass
+        self.close()
+
+    def close(self) -> None:
+        if self._fd is not None:
+            try:
+                os.close(self._fd)
+            except Exception:
+                pass
+            self._fd = None
+        if self._h is not None and self._connected:
+            # дескриптор закрываем только после подключения: иначе ConnectNamedPipe в другом потоке повиснет
+            try:
+                import win32file
+
+                win32file.CloseHandle(self._h)
+            except Exception:
+                pass
+            self._h = None
+        if os.name != "nt":
+            try:
+                os.remove(self.path)
+            except Exception:
+                pass
+
+
+class _PipeWriter(_OrderedWriter):
+    """Запись по порядку сегментов в канал ffmpeg: без файла и журнала (докачки у этого режима нет)."""
+
+    mode = "pipe"
+
+    def __init__(self, sink: _PipeSink):
+        super().__init__("", None)
+        self.sink = sink
+
+    def prepare(self, done: dict[int, tuple[int, int]], resumable: bool) -> set[int]:
+        self.next_write = 0
+        return set()
+
+    def drain(self, cancel_event=None) -> None:
+        while True:
+            with self._lock:
+                chunk = self._pending.pop(self.next_write, None)
+            if chunk is None:
+                return
+            _raise_if_cancelled(cancel_event)
+            self.sink.write(chunk, cancel_event)
+            with self._lock:
+                self.buffered -= len(chunk)
+            _REORDER_BUDGET.sub(len(chunk))
+            self.next_write += 1
+
+    def finalize(self, out_path: str) -> None:
+        self.close()
+        self.sink.finish()
+
+    def discard(self) -> None:
+        self.close()
+        self.sink.abort()
+
+
+class _OffsetWriter:
+    """Файл заранее размечен по размерам сегментов; каждый сегмент сразу пишется на своё место."""
+
+    mode = "offset"
+
+    def __init__(self, tmp: str, journal: _SegmentJournal, sizes: list[int]):
+        self.tmp = tmp
+        self.journal = journal
+        self.sizes = [int(x) for x in sizes]
+        self.offsets = []
+        pos = 0
+        for n in self.sizes:
+            self.offsets.append(pos)
+            pos += n
+        self.total_size = pos
+        self._fd = None
+        self._lock = threading.Lock()
+
+    def prepare(self, done: dict[int, tuple[int, int]], resumable: bool) -> set[int]:
+        ok: set[int] = set()
+        try:
+            if resumable and os.path.isfile(self.tmp) and os.path.getsize(self.tmp) == self.total_size:
+                for i, (off, n) in done.items():
+                    if off == self.offsets[i] and n == self.sizes[i]:
+                        ok.add(i)
+        except Exception:
+            ok = set()
+
+        flags = os.O_RDWR | os.O_CREAT | getattr(os, "O_BINARY", 0)
+        if ok:
+            self._fd = os.open(self.tmp, flags)
+            self.journal.open(fresh=False)
+        else:
+            self._fd = os.open(self.tmp, flags | os.O_TRUNC)
+            os.ftruncate(self._fd, self.total_size)
+            self.journal.open(fresh=True, meta={"mode": self.mode, "sizes": self.sizes})
+        return ok
+
+    def put(self, idx: int, chunk: bytes) -> None:
+        if len(chunk) != self.sizes[idx]:
+            raise _SegmentSizeMismatch(f"segment {idx}: {len(chunk)} != {self.sizes[idx]}")
+        with self._lock:
+            if self._fd is None:
+                return
+            _pwrite_all(self._fd, chunk, self.offsets[idx])
+        self.journal.record(idx, self.offsets[idx], len(chunk))
+
+    def drain(self, cancel_event=None) -> None:
+        return
+
+    def can_submit(self, idx: int, reserve: int) -> bool:
+        return True
+
+    def close(self) -> None:
+        with self._lock:
+            if self._fd is not None:
+                try:
+                    os.close(self._fd)
+                except Exception:
+                    pass
+                self._fd = None
+
+    def finalize(self, out_path: str) -> None:
+        self.close()
+        os.replace(self.tmp, out_path)
+
+    def discard(self) -> None:
+        self.close()
+        self.journal.remove()
+        try:
+            if os.path.exists(self.tmp):
+                os.remove(self.tmp)
+        except Exception:
+            pass
+
+
+class _GrowWriter:
+    """
+    Размеры заранее неизвестны: узнаём их по ходу (Content-Length ответа, иначе длина тела) и пишем
+    каждый сегмент сразу на его место в растущем файле, как только известны размеры всех предыдущих.
+    Сегмент, пришедший раньше, чем известно его смещение, ждёт в `<.part>.seg/` и дописывается,
+    как только смещение станет известно — без склейки всего файла в конце.
+    """
+
+    mode = "grow"
+
+    def __init__(self, tmp: str, journal: _SegmentJournal, total: int):
+        self.tmp = tmp
+        self.journal = journal
+        self.total = int(total)
+        self.dir = tmp + ".seg"
+        self._sizes: dict[int, int] = {}
+        self._offs = [0]  # _offs[k] — смещение сегмента k, известно для k <= front
+        self._held: set[int] = set()
+        self._fd = None
+        self._lock = threading.Lock()
+        self._wlock = threading.Lock()
+
+    def _seg_path(self, idx: int) -> str:
+        return os.path.join(self.dir, f"{int(idx):06d}.ts")
+
+    def prepare(self, done: dict[int, tuple[int, int]], resumable: bool) -> set[int]:
+        resume_cnt, resume_bytes = 0, 0
+        if resumable and os.path.isfile(self.tmp):
+            resume_cnt, resume_bytes = _journal_resume_prefix(done, os.path.getsize(self.tmp))
+        shutil.rmtree(self.dir, ignore_errors=True)
+        os.makedirs(self.dir, exist_ok=True)
+        flags = os.O_RDWR | os.O_CREAT | getattr(os, "O_BINARY", 0)
+        if resume_cnt > 0:
+            self._fd = os.open(self.tmp, flags)
+            os.ftruncate(self._fd, resume_bytes)
+            self.journal.open(fresh=False)
+            for i in range(resume_cnt):
+                self._sizes[i] = done[i][1]
+                self._offs.append(self._offs[-1] + done[i][1])
+        else:
+            self._fd = os.open(self.tmp, flags | os.O_TRUNC)
+            self.journal.open(fresh=True, meta={"mode": self.mode})
+        return set(range(resume_cnt))
+
+    def learn(self, idx: int, size: int) -> None:
+        """Размер сегмента из заголовков ответа (до тела): сдвигает границу известных смещений."""
+        self._place(self._learn(int(idx), int(size)))
+
+    def _learn(self, idx: int, size: int) -> list[int]:
+        # под self._lock: запоминаем размер, двигаем границу; возвращаем ждущие сегменты, ставшие «на место»
+        with self._lock:
+            if self._fd is None or idx in self._sizes:
+                return []
+            self._sizes[idx] = size
+            while len(self._offs) - 1 in self._sizes:
+                k = len(self._offs) - 1
+                self._offs.append(self._offs[-1] + self._sizes[k])
+            front = len(self._offs) - 1
+            ready = sorted(i for i in self._held if i < front)
+            self._held.difference_update(ready)
+            return ready
+
+    def _write(self, idx: int, chunk: bytes) -> None:
+        with self._wlock:
+            if self._fd is None:
+                return
+            _pwrite_all(self._fd, chunk, self._offs[idx])
+        self.journal.record(idx, self._offs[idx], len(chunk))
+
+    def _place(self, ready: list[int]) -> None:
+        for i in ready:
+            p = self._seg_path(i)
+            with open(p, "rb") as f:
+                self._write(i, f.read())
+            try:
+                os.remove(p)
+            except Exception:
+                pass
+
+    def put(self, idx: int, chunk: bytes) -> None:
+        idx = int(idx)
+        with self._lock:
+            known = self._sizes.get(idx)
+        if known is not None and known != len(chunk):
+            raise _SegmentSizeMismatch(f"segment {idx}: {len(chunk)} != {known} (Content-Length)")
+        ready = self._learn(idx, len(chunk))
+        with self._lock:
+            placeable = idx < len(self._offs) - 1
+            if not placeable:
+                # смещение ещё неизвестно: кладём рядом, _learn() отдаст его, когда граница дойдёт
+                p = self._seg_path(idx)
+                with open(p + ".tmp", "wb") as f:
+                    f.write(chunk)
+                os.replace(p + ".tmp", p)
+                self._held.add(idx)
+        if placeable:
+            self._write(idx, chunk)
+        self._place(ready)
+
+    def drain(self, cancel_event=None) -> None:
+        return
+
+    def can_submit(self, idx: int, reserve: int) -> bool:
+        return True
+
+    def close(self) -> None:
+        with self._wlock:
+            if self._fd is not None:
+                try:
+                    os.close(self._fd)
+                except Exception:
+                    pass
+                self._fd = None
+
+    def finalize(self, out_path: str) -> None:
+        if self._held or len(self._offs) - 1 < self.total:
+            raise RuntimeError(f"grow: на месте {len(self._offs) - 1}/{self.total} сегментов")
+        self.close()
+        os.replace(self.tmp, out_path)
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def discard(self) -> None:
+        self.close()
+        self.journal.remove()
+        shutil.rmtree(self.dir, ignore_errors=True)
+        try:
+            if os.path.exists(self.tmp):
+                os.remove(self.tmp)
+        except Exception:
+            pass
+
+
+class _SpillWriter:
+    """Размеры заранее неизвестны: каждый сегмент — отдельный файл в `<.part>.seg/`, склейка в конце."""
+
+    mode = "spill"
+
+    def __init__(self, tmp: str, journal: _SegmentJournal, total: int):
+        self.tmp = tmp
+        self.journal = journal
+        self.total = int(total)
+        self.dir = tmp + ".seg"
+        self._closed = False
+
+    def _seg_path(self, idx: int) -> str:
+        return os.path.join(self.dir, f"{int(idx):06d}.ts")
+
+    def prepare(self, done: dict[int, tuple[int, int]], resumable: bool) -> set[int]:
+        ok: set[int] = set()
+        if resumable:
+            for i, (_off, n) in done.items():
+                try:
+                    if os.path.getsize(self._seg_path(i)) == n:
+                        ok.add(i)
+                except Exception:
+                    continue
+        if ok:
+            self.journal.open(fresh=False)
+        else:
+            shutil.rmtree(self.dir, ignore_errors=True)
+            self.journal.open(fresh=True, meta={"mode": self.mode})
+        os.makedirs(self.dir, exist_ok=True)
+        return ok
+
+    def put(self, idx: int, chunk: bytes) -> None:
+        if self._closed:
+            return
+        p = self._seg_path(idx)
+        with open(p + ".tmp", "wb") as f:
+            f.write(chunk)
+        os.replace(p + ".tmp", p)
+        self.journal.record(idx, 0, len(chunk))
+
+    def drain(self, cancel_event=None) -> None:
+        return
+
+    def can_submit(self, idx: int, reserve: int) -> bool:
+        return True
+
+    def close(self) -> None:
+        self._closed = True
+
+    def finalize(self, out_path: str) -> None:
+        self.close()
+        with open(self.tmp, "wb") as out:
+            for i in range(self.total):
+                with open(self._seg_path(i), "rb") as f:
+                    shutil.copyfileobj(f, out, 1024 * 1024)
+        os.replace(self.tmp, out_path)
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def discard(self) -> None:
+        self.close()
+        self.journal.remove()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+def _choose_stream_writer(tmp: str, journal: _SegmentJournal, segments: list[str],
+                          known_sizes: list[int] | None = None):
+    """known_sizes — размеры из BYTERANGE; без них и без журнала offset-режима — grow."""
+    mode = (HLS_WRITE_MODE or "auto").lower()
+    if mode == "ordered":
+        return _OrderedWriter(tmp, journal)
+    if mode == "grow":
+        return _GrowWriter(tmp, journal, len(segments))
+
+    prev = journal.meta.get("mode")
+    if mode == "auto" and prev == "spill":
+        # продолжаем тем же способом, каким начинали
+        return _SpillWriter(tmp, journal, len(segments))
+    if mode == "auto":
+        sizes = known_sizes or (journal.meta.get("sizes") if prev == "offset" else None)
+        if isinstance(sizes, list) and len(sizes) == len(segments):
+            return _OffsetWriter(tmp, journal, sizes)
+        return _GrowWriter(tmp, journal, len(segments))
+    return _SpillWriter(tmp, journal, len(segments))
+
+
+# --- Хеджирование «застрявших» сегментов ---
+HLS_HEDGE_ENABLED = True
+HLS_HEDGE_FACTOR = 3.0  # дубль, если сегмент в полёте дольше FACTOR × p95 недавних сегментов
+HLS_HEDGE_MIN_DELAY = 2.0  # но не раньше, чем через столько секунд (сек)
+HLS_HEDGE_MIN_SAMPLES = 8  # p95 считаем только когда есть хотя бы столько замеров
+HLS_HEDGE_MAX_INFLIGHT = 2  # одновременных дублей на поток
+HLS_HEDGE_MAX_FRACTION = 0.10  # лишний трафик от дублей — не больше этой доли скачанного
+
+
+def set_hls_hedging(enabled: bool | None = None, factor: float | None = None, max_fraction: float | None = None):
+    """Глобальная настройка: дублирующие запросы для медленных сегментов и лимит лишнего трафика."""
+    global HLS_HEDGE_ENABLED, HLS_HEDGE_FACTOR, HLS_HEDGE_MAX_FRACTION
+    if enabled is not None:
+        HLS_HEDGE_ENABLED = bool(enabled)
+    if factor is not None:
+        HLS_HEDGE_FACTOR = max(1.5, float(factor))
+    if max_fraction is not None:
+        HLS_HEDGE_MAX_FRACTION = max(0.0, min(1.0, float(max_fraction)))
+
+
+# --- Видео и аудио одновременно ---
+HLS_CONCURRENT_STREAMS = True  # False — по-старому: сначала видео, потом аудио
+HLS_GROUP_DEFAULT_SEGMENT_BYTES = 1024 * 1024  # оценка размера сегмента, пока не скачан ни один
+
+
+def set_hls_concurrent_streams(enabled: bool):
+    """Глобальная настройка: качать видео и аудиодорожки одновременно (общий бюджет)."""
+    global HLS_CONCURRENT_STREAMS
+    HLS_CONCURRENT_STREAMS = bool(enabled)
+
+
+# --- Обновление подписанных ссылок посреди длинной загрузки ---
+# Срок из query сегментов/плейлиста подходит к концу или пошла серия 401/403 — заново разбираем HLS
+# тайтла (без браузера, затем браузер из провайдера) и продолжаем тот же поток: недостающие сегменты
+# берутся из нового плейлиста по индексу, скачанное остаётся.
+HLS_REFRESH_MAX = 3  # обновлений на один поток
+HLS_REFRESH_AHEAD = 5 * 60  # обновляем заранее, если ссылке осталось жить меньше (сек)
+HLS_REFRESH_FORBIDDEN_STREAK = 4  # столько 401/403 подряд — обновляем (до HLS_FORBIDDEN_STREAK_MAX)
+HLS_REFRESH_REUSE = 60.0  # другие потоки тайтла берут свежий результат, а не разбирают заново (сек)
+_DRIVER_PROVIDER: tuple | None = None  # (acquire() -> driver | None, release(driver))
+
+
+def set_driver_provider(acquire, release=None):
+    """Откуда брать браузер для обновления ссылок во время загрузки (например, DriverPool менеджера)."""
+    global _DRIVER_PROVIDER
+    _DRIVER_PROVIDER = (acquire, release) if callable(acquire) else None
+
+
+def _hls_info_from_provider(url: str, cancel_event=None, status_cb=None):
+    """get_hls_info на браузере из провайдера; None — провайдера нет или браузер не выдали."""
+    if _DRIVER_PROVIDER is None:
+        return None
+    acquire, release = _DRIVER_PROVIDER
+    try:
+        d = acquire()
+    except Exception:
+        # пул занят (queue.Empty по таймауту) или браузер не поднялся — как «не выдали»
+        return None
+    if d is None:
+        return None
+    try:
+        return get_hls_info(url, driver=d, cancel_event=cancel_event, status_cb=status_cb)
+    finally:
+        if callable(release):
+            release(d)
+
+
+_STALE_LINK = object()  # результат load(): запрос был по ссылке, которую уже обновили
+
+
+class _SharedRefresh:
+    """Одно обновление ссылок тайтла на все его потоки (видео + аудио упираются в него почти одновременно)."""
+
+    def __init__(self, fn):
+        self.fn = fn
+        self._lock = threading.Lock()
+        self._res = None
+        self._at = 0.0
+
+    def __call__(self):
+        with self._lock:
+            if self._res is not None and time.time() - self._at < HLS_REFRESH_REUSE:
+                return self._res
+            res = self.fn()
+            self._res, self._at = res, time.time()
+            return res
+
+
+class _StreamGroup:
+    """
+    Общий бюджет для всех HLS-потоков одного тайтла: один пул тредов на сегменты,
+    а слоты окна делятся пропорционально оставшемуся объёму каждого потока —
+    так видео и все аудиодорожки заканчиваются примерно одновременно.
+    """
+
+    def __init__(self, max_workers: int | None = None):
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(1, int(max_workers or HLS_HOST_MAX_PARALLEL)),
+            thread_name_prefix="hls-seg",
+        )
+        self._lock = threading.Lock()
+        self._streams: dict[int, list] = {}  # token -> [remaining_fn, inflight]
+        self._next_token = 0
+
+    def register(self, remaining_fn) -> int:
+        with self._lock:
+            self._next_token += 1
+            self._streams[self._next_token] = [remaining_fn, 0]
+            return self._next_token
+
+    def unregister(self, token: int) -> None:
+        with self._lock:
+            self._streams.pop(token, None)
+
+    def track(self, token: int, fut: concurrent.futures.Future) -> None:
+        with self._lock:
+            st = self._streams.get(token)
+            if st is None:
+                return
+            st[1] += 1
+
+        def _done(_f):
+            with self._lock:
+                st[1] = max(0, st[1] - 1)
+
+        fut.add_done_callback(_done)
+
+    def may_submit(self, token: int, budget: int) -> bool:
+        """Можно ли потоку отправить ещё сегмент при общем бюджете budget сегментов в полёте."""
+        with self._lock:
+            st = self._streams.get(token)
+            if st is None:
+                return True
+            if sum(x[1] for x in self._streams.values()) >= budget:
+                return False
+            rem = {}
+            for t, (fn, _n) in self._streams.items():
+                try:
+                    rem[t] = max(0.0, float(fn()))
+                except Exception:
+                    rem[t] = 0.0
+            share = rem[token] / (sum(rem.values()) or 1.0)
+            # хотя бы один слот каждому, иначе маленькие дорожки стоят до конца видео
+            return st[1] < max(1, int(budget * share + 0.999))
+
+    def close(self) -> None:
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class _EitherEvent:
+    """is_set() = хоть одно из событий взведено (отмена загрузки ИЛИ сегмент уже получен дублем)."""
+
+    def __init__(self, *events):
+        self.events = [e for e in events if e is not None]
+
+    def is_set(self) -> bool:
+        return any(_is_cancelled(e) for e in self.events)
 
 
 def _download_hls_stream(m3u8_url: str, headers: dict, out_path: str,
-                          status_cb=None, label="Видео", workers=8, cancel_event=None):
+                          status_cb=None, label="Видео", workers=None, cancel_event=None, group=None,
+                          refresh_cb=None, clip=None, sink=None):
     """
     Скачивает HLS-видео/аудио в mp4, БЕЗ ffmpeg.
+    Реальная параллельность задаётся лимитером CDN-хоста; workers — лишь потолок тредов потока.
+    group (_StreamGroup) — общий пул и бюджет с другими дорожками того же тайтла.
+    refresh_cb() -> (m3u8_url, headers) | None — свежие ссылки этого потока, когда старые протухают.
+    clip=(start, end) — только сегменты, покрывающие этот отрезок (сек).
+    sink (_PipeSink) — писать не в out_path, а по порядку в канал ffmpeg (потоковый MUX).
     """
     print(f"⬇️ {label}")
     if status_cb:
@@ -2087,28 +4675,20 @@ def _download_hls_stream(m3u8_url: str, headers: dict, out_path: str,
         text = _http_get_text(m3u8_url, headers, cancel_event=cancel_event)
     except DownloadCancelled:
         return False
-    base = m3u8_url.rsplit("/", 1)[0]
 
-    segments = []
-    for ln in text.splitlines():
-        if _is_cancelled(cancel_event):
-            return False
-        ln = ln.strip()
-        if ln and not ln.startswith("#"):
-            segments.append(urllib.parse.urljoin(m3u8_url, ln))
+    segments, ranges = _media_units(text, m3u8_url, clip)
 
     if not segments:
         print("❌ Нет сегментов!")
         return False
 
-    # скачиваем параллельно (с кооперативной отменой), но пишем на диск ПО МЕРЕ готовности,
+    workers = max(1, int(workers or HLS_HOST_MAX_PARALLEL))
+    lim = _host_limiter(segments[0])
+
+    # скачиваем параллельно (с кооперативной отменой), пишем на диск ПО МЕРЕ готовности,
     # чтобы не держать весь файл в RAM (важно для стабильности при параллельных загрузках).
     total = len(segments)
-    done_cnt = 0
-    last_pct = -1
-    last_ts = 0.0
-    start_ts = time.time()
-    bytes_done = 0
+    tmp = out_path + ".part"
 
     def _fmt_speed(bps: float) -> str:
         try:
@@ -2137,50 +4717,274 @@ def _download_hls_stream(m3u8_url: str, headers: dict, out_path: str,
             return f"{h}:{m:02d}:{s:02d}"
         return f"{m:02d}:{s:02d}"
 
-    def load(i, url):
-        chunk = _http_download(url, headers, cancel_event=cancel_event)
-        return i, chunk
-
-    ex = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
-    pending = set()
-    shutdown_wait = True
-    tmp = out_path + ".part"
-    try:
-        for i, seg_url in enumerate(segments):
-            _raise_if_cancelled(cancel_event)
-            pending.add(ex.submit(load, i, seg_url))
-
-        pending_chunks = {}
-        next_write = 0
+    def _transfer(writer, done_map: dict[int, tuple[int, int]]) -> bool:
+        # журнал ведётся в том же режиме записи, что и сейчас (старые журналы — "ordered")
+        resumable = (journal.meta.get("mode") or "ordered") == writer.mode
+        already = writer.prepare(done_map, resumable)
+        resume_cnt = len(already)
+        if resume_cnt > 0:
+            print(f"♻️ {label}: докачка, уже на диске {resume_cnt}/{total} сегментов")
+
+        done_cnt = resume_cnt
+        fetched_cnt = 0
+        bytes_done = 0
+        last_pct = -1
+        last_ts = 0.0
+        start_ts = time.time()
 
-        with open(tmp, "wb") as f_out:
-            while pending:
-                done, pending = concurrent.futures.wait(
-                    pending,
-                    timeout=0.2,
-                    return_when=concurrent.futures.FIRST_COMPLETED,
+        # Хеджирование: для сегмента, который в полёте намного дольше p95, запускаем дубль;
+        # кто первым скачал — тот и пишет, второй отменяется (или его байты идут в wasted).
+        seg_lock = threading.Lock()
+        seg_done: dict[int, threading.Event] = {}
+        started: dict[int, float] = {}
+        durations = collections.deque(maxlen=64)
+        hedged: dict[int, concurrent.futures.Future] = {}
+        copies: dict[int, int] = {}  # сколько запросов сегмента сейчас в работе
+        retries = _StreamRetries()
+        _, hdict = _augment_headers(headers)
+        primary: dict[int, concurrent.futures.Future] = {}
+        refresh_state = {"n": 0, "exp": _url_expiry(segments[0]) or _url_expiry(m3u8_url)}
+
+        def _refresh_links(reason: str) -> bool:
+            # новые ссылки подставляем на месте: segments/hdict читаются при каждой отправке
+            if refresh_cb is None or refresh_state["n"] >= HLS_REFRESH_MAX:
+                refresh_state["exp"] = None
+                return False
+            refresh_state["n"] += 1
+            print(f"🔄 {label}: обновляю ссылки ({reason}), попытка {refresh_state['n']}/{HLS_REFRESH_MAX}")
+            try:
+                res = refresh_cb()
+                if not res or not res[0]:
+                    raise RuntimeError("HLS не разобран")
+                new_url, new_headers = res
+                new_text = _http_get_text(new_url, new_headers, cancel_event=cancel_event)
+            except DownloadCancelled:
+                raise
+            except Exception as e:
+                print(f"⚠️ {label}: обновить ссылки не удалось: {e}")
+                refresh_state["exp"] = None
+                return False
+            fresh, fresh_ranges = _media_units(new_text, new_url, clip)
+            if len(fresh) != total or fresh_ranges != ranges:
+                print(f"⚠️ {label}: новый плейлист не совпадает по сегментам ({len(fresh)} вместо {total}) — не подставляю")
+                refresh_state["exp"] = None
+                return False
+            # тот же счёт сегментов ещё не значит тот же вариант: сверяем пути сегментов без query,
+            # иначе другое качество/дорожка склеится с уже скачанным по индексам
+            if _stream_signature("", fresh, fresh_ranges) != _stream_signature("", segments, ranges):
+                print(f"⚠️ {label}: новый плейлист — другой вариант потока (пути сегментов не совпали) — не подставляю")
+                refresh_state["exp"] = None
+                return False
+            with seg_lock:
+                segments[:] = fresh
+                hdict.clear()
+                hdict.update(_augment_headers(new_headers)[1])
+            retries.forbidden_streak = 0
+            # срок не продлился (ссылки те же/короткоживущие) — заранее больше не дёргаем, только по 403
+            exp = _url_expiry(fresh[0]) or _url_expiry(new_url)
+            refresh_state["exp"] = exp if exp and exp - time.time() >= HLS_REFRESH_AHEAD else None
+            print(f"✅ {label}: ссылки обновлены, продолжаю с того же места")
+            return True
+        hedge_stats = {"sent": 0, "won": 0, "wasted": 0}
+
+        learn_size = getattr(writer, "learn", None)  # grow: размер сегмента из заголовков ответа
+
+        def load(i, url, hedge=False):
+            with seg_lock:
+                ev = seg_done.setdefault(i, threading.Event())
+                if ev.is_set():
+                    return None
+                t0 = time.time()
+                if not hedge:
+                    started[i] = t0
+                copies[i] = copies.get(i, 0) + 1
+            chunk = None
+            err = None
+            try:
+                chunk = _http_fetch_segment(
+                    url,
+                    hdict,
+                    cancel_event=_EitherEvent(cancel_event, ev),
+                    byterange=ranges[i],
+                    size_cb=(lambda n: learn_size(i, n)) if learn_size else None,
                 )
+            except DownloadCancelled:
+                if _is_cancelled(cancel_event):
+                    raise
+            except Exception as e:
+                err = e
+            with seg_lock:
+                copies[i] -= 1
+                if ev.is_set():
+                    if chunk is not None:
+                        hedge_stats["wasted"] += len(chunk)
+                    return None
+                if chunk is None:
+                    # упавший запрос не страшен, пока второй запрос пары ещё в работе;
+                    # иначе сегмент уходит в очередь повторов (решает главный поток)
+                    if copies[i] > 0 or err is None:
+                        return None
+                    started.pop(i, None)
+                    if url != segments[i]:
+                        # запрос ушёл со старой ссылкой до обновления — его ошибка ничего не говорит
+                        return i, _STALE_LINK
+                    return i, err
+                ev.set()
+                started.pop(i, None)
+                durations.append(time.time() - t0)
+                if hedge:
+                    hedge_stats["won"] += 1
+            writer.put(i, chunk)
+            return i, len(chunk)
+
+        hedge_ex = None
+
+        def _drop_request(idx, fut) -> bool:
+            """Убрать завершившийся запрос сегмента; True — других запросов этого сегмента в работе нет."""
+            for reqs in (primary, hedged):
+                if reqs.get(idx) is fut:
+                    reqs.pop(idx)
+            return not any(f is not None and not f.done() for f in (primary.get(idx), hedged.get(idx)))
+
+        def _maybe_hedge():
+            nonlocal hedge_ex
+            # завершившиеся дубли не держим: бюджет считает только активные, а сегмент с упавшим дублем
+            # можно хеджировать снова
+            for i in [i for i, f in hedged.items() if f.done()]:
+                hedged.pop(i)
+            if not HLS_HEDGE_ENABLED or len(durations) < HLS_HEDGE_MIN_SAMPLES:
+                return
+            with seg_lock:
+                lat = sorted(durations)
+                p95 = lat[min(len(lat) - 1, int(len(lat) * 0.95))]
+                avg = (bytes_done / fetched_cnt) if fetched_cnt else 0
+                # бюджет лишнего трафика: каждый дубль в худшем случае стоит один сегмент
+                if hedge_stats["wasted"] + avg * (len(hedged) + 1) > HLS_HEDGE_MAX_FRACTION * bytes_done:
+                    return
+                limit = max(HLS_HEDGE_MIN_DELAY, HLS_HEDGE_FACTOR * p95)
+                now = time.time()
+                slow = sorted(i for i, t0 in started.items() if i not in hedged and now - t0 > limit)
+            for i in slow[: max(0, HLS_HEDGE_MAX_INFLIGHT - len(hedged))]:
+                if hedge_ex is None:
+                    hedge_ex = concurrent.futures.ThreadPoolExecutor(max_workers=HLS_HEDGE_MAX_INFLIGHT)
+                f = hedge_ex.submit(load, i, segments[i], True)
+                hedged[i] = f
+                pending.add(f)
+                hedge_stats["sent"] += 1
+
+        # Скользящее окно: в полёте не больше текущий лимит хоста × HLS_INFLIGHT_PER_WORKER сегментов;
+        # writer может придержать отправку (reorder-буфер переполнен), но сегмент next_write всегда уже отправлен.
+        todo = [i for i in range(total) if i not in already]
+        todo_pos = 0
+
+        sizes = getattr(writer, "sizes", None)
+        left = {"bytes": sum(n for i, n in enumerate(sizes) if i not in already) if sizes else 0}
+
+        def _remaining_bytes() -> float:
+            if sizes:
+                return float(left["bytes"])
+            avg = (bytes_done / fetched_cnt) if fetched_cnt else HLS_GROUP_DEFAULT_SEGMENT_BYTES
+            return (total - done_cnt) * avg
+
+        if group is not None:
+            ex = group.executor
+            token = group.register(_remaining_bytes)
+        else:
+            ex = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+            token = None
+        submitted: list[concurrent.futures.Future] = []
+        pending = set()
+        shutdown_wait = True
+
+        def _stop_workers(wait: bool):
+            # общий пул группы не гасим — только свои сегменты
+            if group is None:
+                ex.shutdown(wait=wait, cancel_futures=True)
+                return
+            for f in submitted:
+                f.cancel()
+            if wait:
+                concurrent.futures.wait(submitted)
+
+        def _submit(idx):
+            # срок подписанных ссылок на исходе — обновляем до отправки, а не после серии 403
+            exp = refresh_state["exp"]
+            if exp is not None and exp - time.time() < HLS_REFRESH_AHEAD:
+                _refresh_links("истекает срок ссылок")
+            f = ex.submit(load, idx, segments[idx])
+            primary[idx] = f
+            pending.add(f)
+            submitted.append(f)
+            if group is not None:
+                group.track(token, f)
+
+        def _fill_window():
+            nonlocal todo_pos
+            window = max(1, min(workers, int(lim.limit)) * max(1, int(HLS_INFLIGHT_PER_WORKER)))
+            # созревшие повторы — вперёд (обычно это самые ранние сегменты, их ждёт запись)
+            for idx in retries.due():
+                _raise_if_cancelled(cancel_event)
+                _submit(idx)
+            while todo_pos < len(todo) and len(pending) < window:
+                idx = todo[todo_pos]
+                avg = (bytes_done / fetched_cnt) if fetched_cnt else HLS_GROUP_DEFAULT_SEGMENT_BYTES
+                if not writer.can_submit(idx, int(avg)):
+                    break
+                if group is not None and not group.may_submit(token, window):
+                    break
+                _raise_if_cancelled(cancel_event)
+                _submit(idx)
+                todo_pos += 1
+
+        try:
+            _fill_window()
+            while pending or len(retries) or todo_pos < len(todo):
+                if not pending:
+                    # в полёте пусто — ждём ближайший повтор или свободный слот в бюджете группы
+                    _raise_if_cancelled(cancel_event)
+                    time.sleep(0.05 if todo_pos < len(todo) else min(0.2, retries.wait_time()))
+                    done = set()
+                else:
+                    done, pending = concurrent.futures.wait(
+                        pending,
+                        timeout=0.2,
+                        return_when=concurrent.futures.FIRST_COMPLETED,
+                    )
 
                 for fut in done:
-                    try:
-                        idx, chunk = fut.result()
-                    except Exception:
-                        # если исключение в сегменте — пробросится ниже
-                        fut.result()
+                    # отмена и ошибки writer'а пробрасываются отсюда
+                    res = fut.result()
+                    if res is None:
                         continue
-                    pending_chunks[int(idx)] = chunk
-                    try:
-                        bytes_done += int(len(chunk) if chunk is not None else 0)
-                    except Exception:
-                        pass
-
-                done_cnt += len(done)
-
-                # пишем на диск строго по порядку сегментов
-                while next_write in pending_chunks:
-                    _raise_if_cancelled(cancel_event)
-                    f_out.write(pending_chunks.pop(next_write))
-                    next_write += 1
+                    idx, n = res
+                    # упал один запрос пары — повтор, только если второй уже не в работе (иначе он и решит)
+                    if n is _STALE_LINK:
+                        if _drop_request(idx, fut):
+                            _submit(idx)
+                        continue
+                    if isinstance(n, Exception):
+                        if not _drop_request(idx, fut):
+                            continue
+                        code = getattr(n, "code", None) if isinstance(n, HttpStatusError) else None
+                        if code in (401, 403) and retries.forbidden_streak + 1 >= HLS_REFRESH_FORBIDDEN_STREAK:
+                            _refresh_links(f"серия {code}")
+                        retries.failed(idx, segments[idx], n)
+                        continue
+                    retries.succeeded()
+                    if sizes:
+                        left["bytes"] -= sizes[idx]
+                    bytes_done += int(n or 0)
+                    fetched_cnt += 1
+                    done_cnt += 1
+                    # проигравший запрос пары не ждём: он сам отменится/досчитается в фоне
+                    for other in (primary.pop(idx, None), hedged.pop(idx, None)):
+                        if other is not None and other is not fut:
+                            pending.discard(other)
+                            other.cancel()
+
+                writer.drain(cancel_event)
+                _maybe_hedge()
+                _fill_window()
 
                 if status_cb and total > 0:
                     try:
@@ -2195,89 +4999,281 @@ def _download_hls_stream(m3u8_url: str, headers: dict, out_path: str,
                             try:
                                 elapsed = max(0.25, now - start_ts)
                                 speed = _fmt_speed(bytes_done / elapsed) if bytes_done > 0 else ""
-                                if 0 < done_cnt < total:
-                                    eta_txt = _fmt_eta((total - done_cnt) * (elapsed / max(1, done_cnt)))
+                                if 0 < done_cnt < total and done_cnt > resume_cnt:
+                                    eta_txt = _fmt_eta(
+                                        (total - done_cnt) * (elapsed / max(1, done_cnt - resume_cnt))
+                                    )
                             except Exception:
                                 speed = ""
                                 eta_txt = ""
                             if speed:
                                 if eta_txt:
-                                    status_cb(f"⬇️ {label} {pct}% ({speed}, ETA {eta_txt})")
+                                    status_cb(f"⬇️ {label} {pct}% ({speed}, ETA {eta_txt}, {lim.describe()})")
                                 else:
-                                    status_cb(f"⬇️ {label} {pct}% ({speed})")
+                                    status_cb(f"⬇️ {label} {pct}% ({speed}, {lim.describe()})")
                             else:
                                 if eta_txt:
-                                    status_cb(f"⬇️ {label} {pct}% (ETA {eta_txt})")
+                                    status_cb(f"⬇️ {label} {pct}% (ETA {eta_txt}, {lim.describe()})")
                                 else:
-                                    status_cb(f"⬇️ {label} {pct}%")
+                                    status_cb(f"⬇️ {label} {pct}% ({lim.describe()})")
                     except Exception:
                         pass
 
                 _raise_if_cancelled(cancel_event)
 
-    except DownloadCancelled:
-        shutdown_wait = False
-        for f in pending:
-            f.cancel()
-        ex.shutdown(wait=False, cancel_futures=True)
-        try:
-            if os.path.exists(tmp):
-                os.remove(tmp)
+            if done_cnt < total:
+                raise RuntimeError(f"{label}: скачано {done_cnt}/{total} сегментов")
+
+        # .part + журнал НЕ удаляем: следующая попытка докачает только недостающие сегменты
+        except DownloadCancelled:
+            shutdown_wait = False
+            for f in pending:
+                f.cancel()
+            _stop_workers(wait=False)
+            return False
+
+        except _SegmentSizeMismatch:
+            # разметка файла неверна — дождёмся воркеров, чтобы никто не писал в файл после отката
+            shutdown_wait = False
+            _stop_workers(wait=True)
+            if hedge_ex is not None:
+                hedge_ex.shutdown(wait=True, cancel_futures=True)
+            raise
+
         except Exception:
-            pass
-        return False
+            shutdown_wait = False
+            for f in pending:
+                f.cancel()
+            _stop_workers(wait=False)
+            raise
+
+        finally:
+            writer.close()
+            journal.close()
+            if group is not None:
+                group.unregister(token)
+            if shutdown_wait and group is None:
+                # проигравшие дубли могут ещё висеть на чтении — их результат уже не нужен
+                ex.shutdown(wait=not hedge_stats["sent"])
+            if hedge_ex is not None:
+                hedge_ex.shutdown(wait=False, cancel_futures=True)
+
+        if hedge_stats["sent"]:
+            wasted = hedge_stats["wasted"]
+            print(
+                f"🪞 {label}: дублей {hedge_stats['sent']} (быстрее основного {hedge_stats['won']}), "
+                f"лишний трафик {wasted / (1024 * 1024):.1f} MB ({wasted * 100 / max(1, bytes_done):.1f}%)"
+            )
 
-    except Exception:
-        shutdown_wait = False
-        for f in pending:
-            f.cancel()
-        ex.shutdown(wait=False, cancel_futures=True)
         try:
-            if os.path.exists(tmp):
-                os.remove(tmp)
+            if status_cb and total > 0 and last_pct < 100:
+                now = time.time()
+                speed = ""
+                try:
+                    elapsed = max(0.25, now - start_ts)
+                    speed = _fmt_speed(bytes_done / elapsed) if bytes_done > 0 else ""
+                except Exception:
+                    speed = ""
+                if speed:
+                    status_cb(f"⬇️ {label} 100% ({speed})")
+                else:
+                    status_cb(f"⬇️ {label} 100%")
         except Exception:
             pass
-        raise
 
-    finally:
-        if shutdown_wait:
-            ex.shutdown(wait=True)
+        # атомарно публикуем результат
+        if _is_cancelled(cancel_event):
+            return False
+        writer.finalize(out_path)
+        journal.remove()
+        return True
+
+    # журнал докачки: какие сегменты уже лежат на диске (переживает отмену/краш/перезапуск)
+    journal = _SegmentJournal(tmp + ".journal", _stream_signature(m3u8_url, segments, ranges), total)
+    done_map = journal.load()
+    if sink is not None:
+        writer = _PipeWriter(sink)
+        done_map = {}
+    else:
+        known = [r[1] for r in ranges] if all(r is not None for r in ranges) else None
+        writer = _choose_stream_writer(tmp, journal, segments, known_sizes=known)
 
     try:
-        if status_cb and total > 0 and last_pct < 100:
-            now = time.time()
-            speed = ""
-            try:
-                elapsed = max(0.25, now - start_ts)
-                speed = _fmt_speed(bytes_done / elapsed) if bytes_done > 0 else ""
-            except Exception:
-                speed = ""
-            if speed:
-                status_cb(f"⬇️ {label} 100% ({speed})")
-            else:
-                status_cb(f"⬇️ {label} 100%")
+        ok = _transfer(writer, done_map)
+    except _SegmentSizeMismatch as e:
+        print(f"⚠️ {label}: размер сегмента не совпал с разметкой ({e}) — перехожу на spill-файлы")
+        writer.discard()
+        journal.meta = {}
+        ok = _transfer(_SpillWriter(tmp, journal, total), {})
+
+    if ok:
+        print(f"{label} скачано")
+    return ok
+
+def _build_mux_cmd(
+    video_in: str,
+    audio_ins: list[str],
+    audio_meta: list[tuple[str, str]],
+    out_file: str,
+    clip=None,
+    leads: list[float | None] | None = None,
+    encoder: str | None = None,
+) -> list[str]:
+    """
+    Команда ffmpeg для MUX: видео + аудиодорожки (файлы .parts или каналы потокового режима).
+    leads — сдвиги клипа по входам (0 — видео, дальше аудио по порядку).
+    encoder — кодировщик видео при ENABLE_REENCODE (None — _pick_encoder(), "copy" — без перекодирования).
+    """
+    if ENABLE_REENCODE and encoder is None:
+        encoder = _pick_encoder()
+    reencode = ENABLE_REENCODE and encoder != "copy"
+    leads = list(leads or [])
+    leads += [None] * (1 + len(audio_ins) - len(leads))
+
+    # считаем битрейт
+    total_kbps = TARGET_TOTAL_KBPS
+    audio_kbps = AUDIO_BITRATE_KBPS if audio_ins else 0
+    video_kbps = max(MIN_VIDEO_BITRATE_KBPS, total_kbps - audio_kbps)
+    v_bitrate = f"{video_kbps}k"
+    a_bitrate = f"{audio_kbps}k" if audio_kbps else None
+    v_bufsize = f"{video_kbps * 2}k"
+
+    cmd = [FFMPEG_BIN, "-y", "-hide_banner", "-loglevel", "error"]
+    cmd += _clip_input_args(leads[0]) + ["-i", video_in]
+    for i, ap in enumerate(audio_ins, start=1):
+        cmd += _clip_input_args(leads[i]) + ["-i", ap]
+
+    # Маппинг дорожек
+    cmd += ["-map", "0:v:0"]
+    for i in range(len(audio_ins)):
+        cmd += ["-map", f"{i+1}:a:0"]
+
+    if reencode:
+        # ВИДЕО — перекод выбранным кодировщиком с таргет-битрейтами
+        cmd += _encoder_video_args(encoder, v_bitrate, v_bufsize)
+        # АУДИО — AAC в фиксированный битрейт (чтобы общий bitrate был предсказуем)
+        if audio_ins:
+            cmd += ["-c:a", "aac", "-b:a", a_bitrate]
+        else:
+            cmd += ["-an"]
+    else:
+        # Без перекодирования: быстрый ремультиплекс
+        cmd += ["-c:v", "copy"]
+        if audio_ins:
+            cmd += ["-c:a", "copy"]
+        else:
+            cmd += ["-an"]
+
+    # метаданные по аудио
+    try:
+        for i, (title, lang) in enumerate(audio_meta[: len(audio_ins)]):
+            if title:
+                cmd += ["-metadata:s:a:{0}".format(i), f"title={title}"]
+            if lang:
+                cmd += ["-metadata:s:a:{0}".format(i), f"language={lang}"]
     except Exception:
         pass
 
-    # атомарно публикуем результат
+    if audio_ins:
+        cmd += ["-disposition:a:0", "default"]
+
+    cmd += _clip_output_args(clip)
+    cmd += [
+        "-map_metadata", "-1",
+        "-sn",
+        "-movflags", _MP4_MOVFLAGS.get(MP4_OUTPUT_MODE, "+faststart"),
+        "-f", "mp4",
+        out_file,
+    ]
+    return cmd
+
+
+def _stream_mux_title(jobs, headers: dict, tmp_dir: str, out_path: str, audio_meta, clip, leads,
+                      status_cb=None, cancel_event=None) -> bool | None:
+    """
+    Потоковый MUX: все дорожки качаются одновременно и по порядку сегментов уходят в каналы,
+    которые читает уже запущенный ffmpeg. Промежуточных video.ts/audio_N.aac нет.
+    jobs — [(url, label, refresh_cb)], первым — видео.
+    True — файл готов, False — отмена, None — не вышло (вызывающий качает в .parts как обычно).
+    """
+    base, _ = os.path.splitext(out_path)
+    tmp_out = base + ".mp4.part"
+    sinks: list[_PipeSink] = []
     try:
-        if _is_cancelled(cancel_event):
+        for i in range(len(jobs)):
+            sinks.append(_PipeSink(tmp_dir, "video" if i == 0 else f"audio_{i}"))
+    except Exception as e:
+        print(f"⚠️ Потоковый MUX недоступен: {e}")
+        for s in sinks:
+            s.abort()
+        return None
+
+    cmd = _build_mux_cmd(sinks[0].path, [s.path for s in sinks[1:]], audio_meta, tmp_out, clip, leads)
+    print("🧩 Потоковый MUX (сегменты сразу в ffmpeg)…")
+    print("MUX CMD:", " ".join(f'"{c}"' if " " in str(c) else str(c) for c in cmd))
+
+    stop_ev = threading.Event()
+    ff_cancel = _EitherEvent(cancel_event, stop_ev)
+    rc_box: list[int] = []
+
+    def _ffmpeg():
+        try:
+            rc_box.append(_run_ffmpeg(cmd, cancel_event=ff_cancel))
+        finally:
+            for s in sinks:
+                s._dead.set()
+
+    ff_th = threading.Thread(target=_ffmpeg, name="hls-stream-mux", daemon=True)
+    ff_th.start()
+
+    group = _StreamGroup()
+    ctl = concurrent.futures.ThreadPoolExecutor(max_workers=len(jobs), thread_name_prefix="hls-stream")
+    ok_all = True
+    try:
+        futs = []
+        for i, ((url, label, refresh), sink) in enumerate(zip(jobs, sinks)):
+            futs.append(ctl.submit(
+                _download_hls_stream, url, headers, os.path.join(tmp_dir, f"stream_{i}"),
+                status_cb, label, None, ff_cancel, group, refresh, clip, sink,
+            ))
+        for fut in concurrent.futures.as_completed(futs):
             try:
-                if os.path.exists(tmp):
-                    os.remove(tmp)
-            except Exception:
-                pass
-            return False
-        os.replace(tmp, out_path)
+                ok = fut.result()
+            except Exception as e:
+                print(f"⚠️ Потоковый MUX: {e}")
+                ok = False
+            if not ok:
+                # любая дорожка оборвалась — ffmpeg нельзя дать закончить файл с обрезанным потоком
+                ok_all = False
+                stop_ev.set()
+                for s in sinks:
+                    s.abort()
+        if ok_all and status_cb:
+            status_cb("🟣 MUX…")
+        ff_th.join()
     finally:
-        if os.path.exists(tmp):
-            try:
-                os.remove(tmp)
-            except Exception:
-                pass
+        ctl.shutdown(wait=False, cancel_futures=True)
+        group.close()
+        for s in sinks:
+            s.abort()
+
+    rc = rc_box[0] if rc_box else -1
+    if ok_all and rc == 0 and os.path.exists(tmp_out) and not _is_cancelled(cancel_event):
+        os.replace(tmp_out, out_path)
+        print("✅ Готово!", out_path)
+        if status_cb:
+            status_cb(f"✅ {os.path.basename(out_path)}")
+        return True
+    if os.path.exists(tmp_out):
+        try:
+            os.remove(tmp_out)
+        except Exception:
+            pass
+    if _is_cancelled(cancel_event):
+        return False
+    print(f"⚠️ Потоковый MUX не удался (rc={rc}) — качаю в .parts как обычно")
+    return None
 
-    print(f"{label} скачано")
-    return True
 
 def start_hls_download(
     video_m3u8,
@@ -2289,13 +5285,46 @@ def start_hls_download(
     audio_select_cb=None,
     defer_mux: bool = False,
     audio_parallel_tracks: int | None = None,
+    refresh_cb=None,
+    clip=None,
 ):
     """
     Стойкий режим:
-    1) Python скачивает VIDEO HLS (без ffmpeg)
-    2) Python скачивает все AUDIO HLS
-    3) ffmpeg делает только быстрый MUX
+    1) Python скачивает VIDEO HLS и все AUDIO HLS (без ffmpeg; одновременно, если HLS_CONCURRENT_STREAMS)
+    2) ffmpeg делает только быстрый MUX
+    refresh_cb() -> (video_m3u8, headers, audios) | None — заново разобранный HLS тайтла, когда ссылки протухают.
+    clip=(start, end) — только отрезок тайтла (сек): качаем покрывающие сегменты и обрезаем при MUX.
     """
+    try:
+        clip = _normalize_clip(clip)
+    except Exception as e:
+        print(f"❌ {e}")
+        if status_cb:
+            status_cb("❌ Неверный интервал клипа")
+        return False
+
+    title_refresh = _SharedRefresh(refresh_cb) if callable(refresh_cb) else None
+
+    def _stream_refresh(want: dict | None):
+        """refresh_cb потока: видео (want=None) или аудиодорожка want (ищем по имени и языку)."""
+        if title_refresh is None:
+            return None
+
+        def _cb():
+            info = title_refresh()
+            if not info:
+                return None
+            video, hdrs, auds = info
+            if want is None:
+                return video, hdrs
+            key = (want.get("name"), want.get("lang"))
+            for a in auds or []:
+                if (a.get("name"), a.get("lang")) == key and (a.get("uri") or a.get("url")):
+                    return a.get("uri") or a.get("url"), hdrs
+            return None
+
+        return _cb
+
 
     def worker() -> bool:
         tmp_dir = out_path + ".parts"
@@ -2358,9 +5387,22 @@ def start_hls_download(
                     if isinstance(old_v, str) and isinstance(old_a, list):
                         if old_v != str(video_m3u8) or [str(x) for x in old_a] != audio_uris:
                             force_redownload = True
+                    # клип и полный тайтл (или другой клип) в одной .parts не смешиваем
+                    if old.get("clip") != (list(clip) if clip else None):
+                        force_redownload = True
             except Exception:
                 pass
 
+            # --- CLIP: сколько отрезать в начале каждого файла (имя файла → сек) ---
+            clip_leads: dict[str, float] = {}
+            if clip is not None:
+                print(f"✂️ Клип: {clip[0]:.1f}–{clip[1]:.1f} сек")
+                clip_leads[os.path.basename(video_file)] = _clip_lead(video_m3u8, headers, clip, cancel_event)
+                for idx, a in enumerate(audios_valid, start=1):
+                    url = a.get("uri") or a.get("url")
+                    if url:
+                        clip_leads[f"audio_{idx}.aac"] = _clip_lead(str(url), headers, clip, cancel_event)
+
             # --- VIDEO ---
             video_cached = (not force_redownload) and _file_ok(video_file)
             if video_cached:
@@ -2370,43 +5412,27 @@ def start_hls_download(
                         status_cb("♻️ Видео уже скачано")
                 except Exception:
                     pass
-            else:
-                print("🎞 Скачиваю видео...")
-                ok = _download_hls_stream(
-                    video_m3u8,
-                    headers,
-                    video_file,
-                    status_cb,
-                    "Видео",
-                    cancel_event=cancel_event,
-                )
-                if not ok:
-                    if _is_cancelled(cancel_event):
-                        return False
-                    if status_cb:
-                        status_cb("❌ Ошибка видео")
-                    return False
-
-            _raise_if_cancelled(cancel_event)
 
-            # --- AUDIO ---
-            print("🎧 Скачиваю аудио...")
             try:
                 ap = int(audio_parallel_tracks or 1)
             except Exception:
                 ap = 1
             ap = max(1, min(4, ap))
 
-            # При параллели уменьшаем число воркеров на поток, чтобы не взрывать количество тредов.
-            try:
-                audio_seg_workers = 8 if ap <= 1 else 4
-            except Exception:
-                audio_seg_workers = 8
+            # Параллельность сегментов делит лимитер CDN-хоста; при нескольких дорожках сразу
+            # только уменьшаем потолок тредов на поток, чтобы не взрывать их количество.
+            audio_seg_workers = max(HLS_HOST_MIN_PARALLEL, HLS_HOST_MAX_PARALLEL // ap)
 
             # Собираем задания и заранее учитываем уже скачанные файлы.
             audio_slots: list[str | None] = [None] * max(0, int(total_audio))
             audio_meta_slots: list[tuple[str, str] | None] = [None] * max(0, int(total_audio))
             tasks: list[tuple[int, str, str, str, str, str]] = []  # (idx, url, apath, label, title, lang)
+            stream_refresh = {0: _stream_refresh(None)}  # idx → refresh_cb потока (0 — видео)
+
+            def _audio_done(idx: int, apath: str, title: str, lang: str) -> None:
+                if 0 <= idx - 1 < len(audio_slots):
+                    audio_slots[idx - 1] = apath
+                    audio_meta_slots[idx - 1] = (title, lang)
 
             for idx, a in enumerate(audios_valid, start=1):
                 _raise_if_cancelled(cancel_event)
@@ -2429,77 +5455,198 @@ def start_hls_download(
                             status_cb(f"♻️ {label} уже скачано")
                     except Exception:
                         pass
-                    if 0 <= idx - 1 < len(audio_slots):
-                        audio_slots[idx - 1] = apath
-                        audio_meta_slots[idx - 1] = (title, lang)
+                    _audio_done(idx, apath, str(title), str(lang))
                     continue
 
                 tasks.append((idx, str(url), apath, label, str(title), str(lang),))
+                stream_refresh[idx] = _stream_refresh(a)
+
+            # --- Потоковый MUX: только с нуля и когда выбирать дорожки после скачивания не нужно ---
+            if (
+                HLS_STREAM_MUX
+                and not defer_mux
+                and not video_cached
+                and len(tasks) == total_audio
+                and not (callable(audio_select_cb) and total_audio > 1)
+                and not any(fn.endswith(".journal") for fn in os.listdir(tmp_dir))
+                and _pipes_supported()
+            ):
+                jobs = [(str(video_m3u8), "Видео", stream_refresh.get(0))]
+                jobs += [(url, label, stream_refresh.get(idx)) for idx, url, _ap, label, _t, _l in tasks]
+                leads = [clip_leads.get(os.path.basename(video_file))]
+                leads += [clip_leads.get(os.path.basename(apath)) for _i, _u, apath, _lb, _t, _l in tasks]
+                res = _stream_mux_title(
+                    jobs,
+                    headers,
+                    tmp_dir,
+                    out_path,
+                    [(title, lang) for _i, _u, _ap, _lb, title, lang in tasks],
+                    clip,
+                    leads,
+                    status_cb=status_cb,
+                    cancel_event=cancel_event,
+                )
+                if res is not None:
+                    mux_ok = bool(res)
+                    return res
+
+            def _download_all_at_once() -> bool:
+                """Видео и все аудиодорожки одновременно, с общим пулом и бюджетом (_StreamGroup)."""
+                print("🎞 Скачиваю видео и аудио одновременно...")
+                jobs: list[tuple[int, str, str, str, str, str]] = []  # idx 0 — видео
+                if not video_cached:
+                    jobs.append((0, str(video_m3u8), video_file, "Видео", "", ""))
+                jobs.extend(tasks)
+
+                group = _StreamGroup()
+                # без видео аудио не нужно: при ошибке видео гасим остальные дорожки (их .part докачаются потом)
+                stop_ev = threading.Event()
+                stream_cancel = _EitherEvent(cancel_event, stop_ev)
+                error = None
+                video_failed = False
+
+                ctl = concurrent.futures.ThreadPoolExecutor(max_workers=len(jobs), thread_name_prefix="hls-stream")
+                try:
+                    fut_map = {}
+                    for job in jobs:
+                        idx, url, path, label, _title, _lang = job
+                        fut = ctl.submit(
+                            _download_hls_stream,
+                            url,
+                            headers,
+                            path,
+                            status_cb,
+                            label,
+                            None,
+                            stream_cancel,
+                            group,
+                            stream_refresh.get(idx),
+                            clip,
+                        )
+                        fut_map[fut] = job
 
-            # Если параллель отключена — скачиваем как раньше (последовательно).
-            if ap <= 1 or len(tasks) <= 1:
-                for idx, url, apath, label, title, lang in tasks:
-                    _raise_if_cancelled(cancel_event)
+                    # ждём всех: каждый поток сам корректно выходит по отмене
+                    for fut in concurrent.futures.as_completed(fut_map):
+                        idx, _url, path, _label, title, lang = fut_map[fut]
+                        try:
+                            ok = fut.result()
+                        except Exception as e:
+                            if error is None:
+                                error = e
+                            stop_ev.set()
+                            continue
+                        if idx == 0:
+                            if not ok and not _is_cancelled(cancel_event):
+                                video_failed = True
+                                stop_ev.set()
+                        elif ok:
+                            _audio_done(idx, path, title, lang)
+                finally:
+                    ctl.shutdown(wait=False, cancel_futures=True)
+                    group.close()
+
+                if error is not None:
+                    raise error
+                _raise_if_cancelled(cancel_event)
+                if video_failed:
+                    if status_cb:
+                        status_cb("❌ Ошибка видео")
+                    return False
+                return True
+
+            if HLS_CONCURRENT_STREAMS and len(tasks) + (0 if video_cached else 1) > 1:
+                if not _download_all_at_once():
+                    return False
+            else:
+                if not video_cached:
+                    print("🎞 Скачиваю видео...")
                     ok = _download_hls_stream(
-                        url,
+                        video_m3u8,
                         headers,
-                        apath,
+                        video_file,
                         status_cb,
-                        label,
-                        workers=audio_seg_workers,
+                        "Видео",
                         cancel_event=cancel_event,
+                        refresh_cb=stream_refresh.get(0),
+                        clip=clip,
                     )
-                    if ok:
-                        if 0 <= idx - 1 < len(audio_slots):
-                            audio_slots[idx - 1] = apath
-                            audio_meta_slots[idx - 1] = (title, lang)
-                    elif _is_cancelled(cancel_event):
+                    if not ok:
+                        if _is_cancelled(cancel_event):
+                            return False
+                        if status_cb:
+                            status_cb("❌ Ошибка видео")
                         return False
-            else:
-                # Параллельно по N аудиодорожек (ускоряет тайтлы с 10–20 дорожками).
-                ex = concurrent.futures.ThreadPoolExecutor(max_workers=ap)
-                fut_map: dict[concurrent.futures.Future, tuple[int, str, str, str, str]] = {}
-                try:
+
+                _raise_if_cancelled(cancel_event)
+
+                # --- AUDIO ---
+                print("🎧 Скачиваю аудио...")
+
+                # Если параллель отключена — скачиваем как раньше (последовательно).
+                if ap <= 1 or len(tasks) <= 1:
                     for idx, url, apath, label, title, lang in tasks:
                         _raise_if_cancelled(cancel_event)
-                        fut = ex.submit(
-                            _download_hls_stream,
+                        ok = _download_hls_stream(
                             url,
                             headers,
                             apath,
                             status_cb,
                             label,
-                            audio_seg_workers,
-                            cancel_event,
-                        )
-                        fut_map[fut] = (idx, apath, title, lang, label)
-
-                    pending = set(fut_map.keys())
-                    while pending:
-                        _raise_if_cancelled(cancel_event)
-                        done, pending = concurrent.futures.wait(
-                            pending,
-                            timeout=0.25,
-                            return_when=concurrent.futures.FIRST_COMPLETED,
+                            workers=audio_seg_workers,
+                            cancel_event=cancel_event,
+                            refresh_cb=stream_refresh.get(idx),
+                            clip=clip,
                         )
-                        for fut in done:
-                            idx, apath, title, lang, _label = fut_map.get(fut, (0, "", "", "und", ""))
-                            ok = fut.result()  # может выбросить исключение как и раньше
-                            if ok:
-                                if 0 <= idx - 1 < len(audio_slots):
-                                    audio_slots[idx - 1] = apath
-                                    audio_meta_slots[idx - 1] = (title, lang)
-                            elif _is_cancelled(cancel_event):
-                                # дадим остальным потокам корректно завершиться по cancel_event
-                                return False
-                finally:
+                        if ok:
+                            _audio_done(idx, apath, title, lang)
+                        elif _is_cancelled(cancel_event):
+                            return False
+                else:
+                    # Параллельно по N аудиодорожек (ускоряет тайтлы с 10–20 дорожками).
+                    ex = concurrent.futures.ThreadPoolExecutor(max_workers=ap)
+                    fut_map: dict[concurrent.futures.Future, tuple[int, str, str, str, str]] = {}
                     try:
-                        ex.shutdown(wait=False, cancel_futures=True)
-                    except Exception:
+                        for idx, url, apath, label, title, lang in tasks:
+                            _raise_if_cancelled(cancel_event)
+                            fut = ex.submit(
+                                _download_hls_stream,
+                                url,
+                                headers,
+                                apath,
+                                status_cb,
+                                label,
+                                audio_seg_workers,
+                                cancel_event,
+                                None,
+                                stream_refresh.get(idx),
+                                clip,
+                            )
+                            fut_map[fut] = (idx, apath, title, lang, label)
+
+                        pending = set(fut_map.keys())
+                        while pending:
+                            _raise_if_cancelled(cancel_event)
+                            done, pending = concurrent.futures.wait(
+                                pending,
+                                timeout=0.25,
+                                return_when=concurrent.futures.FIRST_COMPLETED,
+                            )
+                            for fut in done:
+                                idx, apath, title, lang, _label = fut_map.get(fut, (0, "", "", "und", ""))
+                                ok = fut.result()  # может выбросить исключение как и раньше
+                                if ok:
+                                    _audio_done(idx, apath, title, lang)
+                                elif _is_cancelled(cancel_event):
+                                    # дадим остальным потокам корректно завершиться по cancel_event
+                                    return False
+                    finally:
                         try:
-                            ex.shutdown(wait=False)
+                            ex.shutdown(wait=False, cancel_futures=True)
                         except Exception:
-                            pass
+                            try:
+                                ex.shutdown(wait=False)
+                            except Exception:
+                                pass
 
             # Собираем в исходном порядке (важно для map в ffmpeg).
             for i in range(min(len(audio_slots), len(audio_meta_slots))):
@@ -2522,6 +5669,8 @@ def start_hls_download(
                     "audio_meta": list(audio_meta),
                     "video_m3u8": str(video_m3u8),
                     "audio_uris": list(audio_uris),
+                    "clip": list(clip) if clip else None,
+                    "clip_leads": clip_leads,
                 }
                 try:
                     all_audio_ok = True
@@ -2599,96 +5748,44 @@ def start_hls_download(
             base, _ = os.path.splitext(out_path)
             tmp_out = base + ".mp4.part"
 
-            # считаем битрейт
-            total_kbps  = TARGET_TOTAL_KBPS
-            audio_kbps  = AUDIO_BITRATE_KBPS if audio_files else 0
-            video_kbps  = max(MIN_VIDEO_BITRATE_KBPS, total_kbps - audio_kbps)
-
-            v_bitrate = f"{video_kbps}k"
-            a_bitrate = f"{audio_kbps}k" if audio_kbps else None
-            v_bufsize = f"{video_kbps * 2}k"
-
-            cmd = [FFMPEG_BIN, "-y", "-hide_banner", "-loglevel", "error", "-i", video_file]
-
-            for ap in audio_files:
-                cmd += ["-i", ap]
             if not audio_files:
                 print("⚠️ Нет аудиодорожек, MUX только видео.")
-
-            # Маппинг дорожек
-            cmd += ["-map", "0:v:0"]
-            for i in range(len(audio_files)):
-                cmd += ["-map", f"{i+1}:a:0"]
-
-            if ENABLE_REENCODE:
-                # ВИДЕО — перекод через NVENC с таргет-битрейтами
-                cmd += [
-                    "-c:v", "h264_nvenc",
-                    "-pix_fmt", "yuv420p",
-                    "-preset", "p4",
-                    "-profile:v", "high",
-                    "-tune", "hq",
-                    "-spatial_aq", "1",
-                    "-temporal_aq", "1",
-                    "-rc", "vbr_hq",
-                    "-b:v", v_bitrate,
-                    "-maxrate", v_bitrate,
-                    "-bufsize", v_bufsize,
-                ]
-
-                # АУДИО — AAC в фиксированный битрейт (чтобы общий bitrate был предсказуем)
-                if audio_files:
-                    cmd += ["-c:a", "aac", "-b:a", a_bitrate]
-                else:
-                    cmd += ["-an"]
-            else:
-                # Без перекодирования: быстрый ремультиплекс
-                cmd += ["-c:v", "copy"]
-                if audio_files:
-                    cmd += ["-c:a", "copy"]
-                else:
-                    cmd += ["-an"]
-
-            # метаданные по аудио
-            for i, (title, lang) in enumerate(audio_meta):
-                cmd += ["-metadata:s:a:{0}".format(i), f"title={title}"]
-                cmd += ["-metadata:s:a:{0}".format(i), f"language={lang}"]
-
-            if audio_files:
-                cmd += ["-disposition:a:0", "default"]
-
-            cmd += [
-                "-map_metadata", "-1",
-                "-sn",
-                "-movflags", "+faststart",
-                "-f", "mp4",
-                tmp_out,
-            ]
+            leads = [clip_leads.get(os.path.basename(p)) for p in [video_file] + audio_files]
+            encoder = _pick_encoder() if ENABLE_REENCODE else "copy"
 
             if status_cb:
                 status_cb("🟣 MUX…")
 
-            # показываем точную команду ffmpeg
-            cmd_quoted = [f'"{str(c)}"' if " " in str(c) else str(c) for c in cmd]
-            if ENABLE_REENCODE:
-                print("🧩 Муксую (перекодирование NVENC)…")
-            else:
-                print("🧩 Муксую (без перекодирования, copy)…")
-            print("MUX CMD:", " ".join(cmd_quoted))
+            while True:
+                cmd = _build_mux_cmd(video_file, audio_files, audio_meta, tmp_out, clip, leads, encoder)
 
-            _raise_if_cancelled(cancel_event)
-            mux_started = True
-            rc = _run_ffmpeg(cmd, cancel_event=cancel_event, status_cb=status_cb)
-            if _is_cancelled(cancel_event):
-                return False
+                # показываем точную команду ffmpeg
+                cmd_quoted = [f'"{str(c)}"' if " " in str(c) else str(c) for c in cmd]
+                if encoder != "copy":
+                    print(f"🧩 Муксую (перекодирование {encoder})…")
+                else:
+                    print("🧩 Муксую (без перекодирования, copy)…")
+                print("MUX CMD:", " ".join(cmd_quoted))
 
-            if rc == 0 and os.path.exists(tmp_out):
-                os.replace(tmp_out, out_path)
-                mux_ok = True
-                print("✅ Готово!", out_path)
-                if status_cb:
-                    status_cb(f"✅ {os.path.basename(out_path)}")
-                return True
+                _raise_if_cancelled(cancel_event)
+                mux_started = True
+                rc = _run_ffmpeg(cmd, cancel_event=cancel_event, status_cb=status_cb)
+                if _is_cancelled(cancel_event):
+                    return False
+
+                if rc == 0 and os.path.exists(tmp_out):
+                    os.replace(tmp_out, out_path)
+                    mux_ok = True
+                    print("✅ Готово!", out_path)
+                    if status_cb:
+                        status_cb(f"✅ {os.path.basename(out_path)}")
+                    return True
+
+                # кодировщик перестал работать (например, сменилась видеокарта) — следующий по скорости
+                nxt = _encoder_failed(encoder) if encoder != "copy" else None
+                if not nxt:
+                    break
+                encoder = nxt
 
             print(f"❌ Ошибка MUX (rc={rc})")
             if status_cb:
@@ -2718,12 +5815,16 @@ def start_hls_download(
                     if mux_started:
                         keep_parts = True
                     else:
-                        # если что-то уже скачали (например, video.ts) — оставим, чтобы не качать повторно
+                        # если что-то уже скачали (например, video.ts или недокачанный .part с журналом) —
+                        # оставим, чтобы не качать повторно
                         try:
                             if os.path.isfile(video_file) and os.path.getsize(video_file) > 0:
                                 keep_parts = True
                             else:
                                 for fn in os.listdir(tmp_dir):
+                                    if fn.endswith(".part.journal"):
+                                        keep_parts = True
+                                        break
                                     if not (fn.startswith("audio_") and fn.endswith(".aac")):
                                         continue
                                     p = os.path.join(tmp_dir, fn)
@@ -2759,6 +5860,8 @@ def retry_mux(out_path: str, status_cb=None, cancel_event=None, audio_select_cb=
     video_file = os.path.join(tmp_dir, "video.ts")
     audio_files: list[str] = []
     audio_meta: list[tuple[str, str]] = []
+    clip = None
+    clip_leads: dict = {}
 
     try:
         if os.path.isfile(meta_path):
@@ -2785,6 +5888,11 @@ def retry_mux(out_path: str, status_cb=None, cancel_event=None, audio_select_cb=
                 audio_meta = [(str(t or ""), str(l or "und")) for t, l in raw_meta]
             except Exception:
                 audio_meta = []
+            try:
+                clip = _normalize_clip(meta.get("clip"))
+                clip_leads = dict(meta.get("clip_leads") or {})
+            except Exception:
+                clip, clip_leads = None, {}
     except Exception:
         pass
 
@@ -2857,83 +5965,29 @@ def retry_mux(out_path: str, status_cb=None, cancel_event=None, audio_select_cb=
     base, _ = os.path.splitext(out_path)
     tmp_out = base + ".mp4.part"
 
-    # считаем битрейт (как в основном MUX)
-    total_kbps = TARGET_TOTAL_KBPS
-    audio_kbps = AUDIO_BITRATE_KBPS if audio_files else 0
-    video_kbps = max(MIN_VIDEO_BITRATE_KBPS, total_kbps - audio_kbps)
-    v_bitrate = f"{video_kbps}k"
-    a_bitrate = f"{audio_kbps}k" if audio_kbps else None
-    v_bufsize = f"{video_kbps * 2}k"
-
-    cmd = [FFMPEG_BIN, "-y", "-hide_banner", "-loglevel", "error", "-i", video_file]
-    for ap in audio_files:
-        cmd += ["-i", ap]
-
-    # Маппинг дорожек
-    cmd += ["-map", "0:v:0"]
-    for i in range(len(audio_files)):
-        cmd += ["-map", f"{i+1}:a:0"]
-
-    if ENABLE_REENCODE:
-        cmd += [
-            "-c:v", "h264_nvenc",
-            "-pix_fmt", "yuv420p",
-            "-preset", "p4",
-            "-profile:v", "high",
-            "-tune", "hq",
-            "-spatial_aq", "1",
-            "-temporal_aq", "1",
-            "-rc", "vbr_hq",
-            "-b:v", v_bitrate,
-            "-maxrate", v_bitrate,
-            "-bufsize", v_bufsize,
-        ]
-        if audio_files:
-            cmd += ["-c:a", "aac", "-b:a", a_bitrate]
-        else:
-            cmd += ["-an"]
-    else:
-        cmd += ["-c:v", "copy"]
-        if audio_files:
-            cmd += ["-c:a", "copy"]
-        else:
-            cmd += ["-an"]
-
-    # метаданные по аудио (если есть)
-    try:
-        for i, (title, lang) in enumerate(audio_meta[: len(audio_files)]):
-            if title:
-                cmd += ["-metadata:s:a:{0}".format(i), f"title={title}"]
-            if lang:
-                cmd += ["-metadata:s:a:{0}".format(i), f"language={lang}"]
-    except Exception:
-        pass
-
-    if audio_files:
-        cmd += ["-disposition:a:0", "default"]
-
-    cmd += [
-        "-map_metadata", "-1",
-        "-sn",
-        "-movflags", "+faststart",
-        "-f", "mp4",
-        tmp_out,
-    ]
+    leads = [clip_leads.get(os.path.basename(p)) for p in [video_file] + audio_files]
+    encoder = _pick_encoder() if ENABLE_REENCODE else "copy"
 
     if status_cb:
         status_cb("🟣 MUX…")
 
     try:
-        _raise_if_cancelled(cancel_event)
-        rc = _run_ffmpeg(cmd, cancel_event=cancel_event, status_cb=status_cb)
-        if _is_cancelled(cancel_event):
-            return False
-        if rc == 0 and os.path.exists(tmp_out):
-            os.replace(tmp_out, out_path)
-            if status_cb:
-                status_cb(f"✅ {os.path.basename(out_path)}")
-            shutil.rmtree(tmp_dir, ignore_errors=True)
-            return True
+        while True:
+            cmd = _build_mux_cmd(video_file, audio_files, audio_meta, tmp_out, clip, leads, encoder)
+            _raise_if_cancelled(cancel_event)
+            rc = _run_ffmpeg(cmd, cancel_event=cancel_event, status_cb=status_cb)
+            if _is_cancelled(cancel_event):
+                return False
+            if rc == 0 and os.path.exists(tmp_out):
+                os.replace(tmp_out, out_path)
+                if status_cb:
+                    status_cb(f"✅ {os.path.basename(out_path)}")
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                return True
+            nxt = _encoder_failed(encoder) if encoder != "copy" else None
+            if not nxt:
+                break
+            encoder = nxt
         if status_cb:
             status_cb(f"❌ Ошибка MUX (код {rc})")
         return False
@@ -511,11 +511,13 @@ def make_visible_driver(portable_path=None, ver_main=None, for_login=False):
     if "--headless" in opts.arguments:
         opts.arguments.remove("--headless")
 
+    # события Network (Reactor uc) — для сниффа HLS; окну логина они не нужны
     driver = uc.Chrome(
         options=opts,
         version_main=ver_main or None,
         headless=False,
-        use_subprocess=True
+        use_subprocess=True,
+        enable_cdp_events=not for_login and not os.environ.get("KINO_DISABLE_PERF"),
     )
 
     try:
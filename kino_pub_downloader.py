@@ -17,7 +17,15 @@ from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 
 # Наши модули
-from kino_hls import download_by_item_url, get_hls_info, start_hls_download
+from kino_hls import (
+    _fetch_item_page_http,
+    _resolved_cache_get,
+    _resolved_cache_peek,
+    download_by_item_url,
+    get_hls_info,
+    prepare_hls_info,
+    start_hls_download,
+)
 from kino_parser import load_cookies
 from uc_driver import (
     _safe_get_driver,
@@ -602,55 +610,74 @@ def search_titles(query: str, limit=1, status_cb=None, driver=None, cancel_event
 # -------------------------------------------------------
 # Извлечение “красивого” имени файла
 # -------------------------------------------------------
+def _display_name_from_html(html: str, fallback_title: str = "") -> str:
+    """'Русское название (YYYY)' из HTML карточки (без сетевых запросов)."""
+    soup = BeautifulSoup(html, "html.parser")
+
+    title_h1 = soup.select_one("h1, .item-title")
+    title_ru = title_h1.get_text(strip=True) if title_h1 else (fallback_title or "").strip()
+
+    title_ru = re.split(r"[_/]", title_ru)[0].strip()
+    title_ru = re.sub(r'\s+\(\d{4}\)$', '', title_ru)
+
+    year = None
+    for tr in soup.select("table.table.table-striped tr"):
+        tds = tr.find_all(["td", "th"])
+        if len(tds) >= 2:
+            label = tds[0].get_text(" ", strip=True).lower()
+            if any(k in label for k in ("год выхода", "год выпуска", "год")):
+                text = tds[1].get_text(" ", strip=True)
+                m = re.search(r"\b(19|20)\d{2}\b", text)
+                if m:
+                    year = m.group(0)
+                    break
+
+    if not year:
+        m = re.search(r"\b(19|20)\d{2}\b", html)
+        year = m.group(0) if m else ""
+
+    name = f"{title_ru} ({year})" if year else title_ru
+
+    # Запрещённые символы Windows → пробел
+    name = re.sub(r'[\\/:*?"<>|]', " ", name)
+
+    # Схлопываем подряд идущие пробелы
+    name = re.sub(r"\s{2,}", " ", name)
+
+    # Убираем пробелы и точки по краям (Windows не любит такие имена)
+    name = name.strip(" .")
+
+    return name
+
+
 def _extract_display_name(driver, item_url, cancel_event=None) -> str:
-    """Возвращает 'Русское название (YYYY)' с чисткой служебных символов."""
+    """Возвращает 'Русское название (YYYY)' с чисткой служебных символов.
+
+    Сначала имя из кэша разобранных HLS (повтор/перезапуск), затем страница без браузера
+    (сохранённые cookies), driver — только если не вышло.
+    """
     try:
         if getattr(cancel_event, "is_set", lambda: False)():
             return "video"
+        cached = (_resolved_cache_peek(item_url) or {}).get("display_name")
+        if cached:
+            return cached
+        try:
+            html = _fetch_item_page_http(item_url, cancel_event=cancel_event)
+        except Exception:
+            html = None
+        if html:
+            name = _display_name_from_html(html)
+            if name:
+                return name
+
         driver.get(item_url)
         WebDriverWait(driver, 25).until(
             EC.presence_of_element_located((By.CSS_SELECTOR, "meta[property='og:title'], h1, .item-title"))
         )
         if getattr(cancel_event, "is_set", lambda: False)():
             return "video"
-        html = driver.page_source
-        soup = BeautifulSoup(html, "html.parser")
-
-        title_h1 = soup.select_one("h1, .item-title")
-        title_ru = title_h1.get_text(strip=True) if title_h1 else (driver.title or "").strip()
-
-        title_ru = re.split(r"[_/]", title_ru)[0].strip()
-        title_ru = re.sub(r'\s+\(\d{4}\)$', '', title_ru)
-
-        year = None
-        for tr in soup.select("table.table.table-striped tr"):
-            tds = tr.find_all(["td", "th"])
-            if len(tds) >= 2:
-                label = tds[0].get_text(" ", strip=True).lower()
-                if any(k in label for k in ("год выхода", "год выпуска", "год")):
-                    text = tds[1].get_text(" ", strip=True)
-                    m = re.search(r"\b(19|20)\d{2}\b", text)
-                    if m:
-                        year = m.group(0)
-                        break
-
-        if not year:
-            m = re.search(r"\b(19|20)\d{2}\b", html)
-            year = m.group(0) if m else ""
-
-        name = f"{title_ru} ({year})" if year else title_ru
-
-        # Запрещённые символы Windows → пробел
-        name = re.sub(r'[\\/:*?"<>|]', " ", name)
-
-        # Схлопываем подряд идущие пробелы
-        name = re.sub(r"\s{2,}", " ", name)
-
-        # Убираем пробелы и точки по краям (Windows не любит такие имена)
-        name = name.strip(" .")
-
-        return name or "video"
-
+        return _display_name_from_html(driver.page_source, driver.title or "") or "video"
 
     except Exception:
         slug = re.sub(r"[#?].*$", "", item_url).rstrip("/").split("/")[-1]
@@ -684,6 +711,65 @@ def _normalize_display_name(name: str) -> str:
     return name or "video"
 
 
+_CLIP_SUFFIX_RE = re.compile(r"\s*#t=([0-9:.]+)\s*[,-]\s*([0-9:.]+)\s*$")
+
+
+def _clip_seconds(s: str) -> float:
+    """'90' / '1:30' / '1:02:03.5' -> секунды."""
+    total = 0.0
+    for part in s.split(":"):
+        total = total * 60 + float(part or 0)
+    return total
+
+
+def split_clip(query_or_url: str) -> Tuple[str, Optional[Tuple[float, float]]]:
+    """
+    Отрезок в строке очереди: «<URL или запрос>#t=<начало>,<конец>» (как Media Fragments),
+    время — секунды или [ЧЧ:]ММ:СС. Возвращает (строка без суффикса, (start, end) | None).
+    Суффикс хранится в самом URL задачи — переживает сохранение очереди и «Повтор» из истории.
+    """
+    s = str(query_or_url or "")
+    m = _CLIP_SUFFIX_RE.search(s)
+    if not m:
+        return s, None
+    try:
+        start, end = _clip_seconds(m.group(1)), _clip_seconds(m.group(2))
+    except ValueError:
+        return s, None
+    if end <= start:
+        return s, None
+    return s[: m.start()], (start, end)
+
+
+# -------------------------------------------------------
+# Разбор HLS заранее (look-ahead очереди DownloadManager)
+# -------------------------------------------------------
+def prepare(item_url: str, driver=None, cancel_event=None, status_cb=None, display_name_override: str | None = None) -> bool:
+    """
+    Заранее разбирает HLS карточки и сохраняет готовый манифест (kino_hls, кэш разобранных ссылок),
+    чтобы download() потом начал качать сразу и без браузера.
+    driver=None — только без браузера (сохранённые cookies); с driver — как обычный разбор.
+    display_name_override — имя задал пользователь: в кэш не пишем, страницу ради названия не разбираем.
+    """
+    if not str(item_url or "").startswith("http"):
+        return False
+    name = None if display_name_override else (_resolved_cache_peek(item_url) or {}).get("display_name")
+    if not name and not display_name_override:
+        if driver is not None:
+            name = _extract_display_name(driver, item_url, cancel_event=cancel_event)
+        else:
+            try:
+                html = _fetch_item_page_http(item_url, cancel_event=cancel_event)
+            except Exception:
+                html = None
+            name = _display_name_from_html(html) if html else None
+    if name:
+        name = _normalize_display_name(name)
+    return prepare_hls_info(
+        item_url, driver=driver, cancel_event=cancel_event, status_cb=status_cb, display_name=name
+    )
+
+
 # -------------------------------------------------------
 # ОДНО скачивание (с возможностью передать внешний driver из пула)
 # -------------------------------------------------------
@@ -697,15 +783,24 @@ def download(
     defer_mux: bool = False,
     display_name_override: str | None = None,
     audio_parallel_tracks: int | None = None,
+    audio_preselect_cb=None,
+    clip=None,
+    resolved=None,
 ) -> bool:
     """
     Скачивание одного фильма.
     Если driver передан (из DriverPool) — используем его, иначе сами поднимем скрытый UC.
+    clip=(start, end) — только отрезок тайтла (сек), в отдельный файл «<название> [start-end].mp4».
+    resolved — результат _resolved_cache_get, уже полученный вызывающим (повторно кэш не проверяем).
     """
     os.makedirs(out_dir, exist_ok=True)
 
     internal_driver = None
     try:
+        # HLS уже разобран (look-ahead/повтор): ссылки проверяем один раз и передаём дальше
+        if resolved is None and driver is None and query_or_url.startswith("http"):
+            resolved = _resolved_cache_get(query_or_url, cancel_event=cancel_event)
+
         # ======= ЕСЛИ ПЕРЕДАН driver (пул UC) =======
         if driver is not None:
             try:
@@ -783,6 +878,10 @@ def download(
 
             use_driver = driver
 
+        elif resolved and query_or_url.startswith("http"):
+            # HLS уже разобран (look-ahead/повтор) и ссылки живы — браузер не нужен
+            use_driver = None
+
         else:
             raise RuntimeError("Download() must be called with driver — internal UC driver forbidden.")
 
@@ -816,6 +915,10 @@ def download(
         else:
             display_name = _extract_display_name(use_driver, item_url, cancel_event=cancel_event)
         display_name = _normalize_display_name(display_name)
+        # в кэш разобранных ссылок — только настоящее название тайтла (без override и суффикса отрезка)
+        title_name = None if display_name_override else display_name
+        if clip:
+            display_name += f" [{int(clip[0])}-{int(clip[1])}]"
 
         # формируем output
         out_path = os.path.join(out_dir, display_name + ".mp4")
@@ -843,6 +946,10 @@ def download(
             audio_select_cb=audio_select_cb,
             defer_mux=defer_mux,
             audio_parallel_tracks=audio_parallel_tracks,
+            audio_preselect_cb=audio_preselect_cb,
+            clip=clip,
+            resolved=resolved,
+            display_name=title_name,
         )
 
         if getattr(cancel_event, "is_set", lambda: False)():
@@ -15,7 +15,7 @@ from datetime import datetime
 from bs4 import BeautifulSoup
 from auto_update import check_for_updates_async
 from download_manager import DownloadManager
-from uc_driver import DriverPool, _safe_get_driver, KINOPUB_BASE
+from uc_driver import DriverPool, _safe_get_driver, KINOPUB_BASE, SETTINGS_LOCK
 from tkinter import messagebox, filedialog, simpledialog, ttk
 from pathlib import Path
 from file_actions import export_and_load_index, normalize_name, VIDEO_EXTENSIONS, RELATED_EXTENSIONS
@@ -33,6 +33,8 @@ from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
 import threading
 from kino_hls import set_reencode as set_hls_reencode, retry_mux as hls_retry_mux
+from kino_hls import set_hls_concurrent_streams, set_audio_policy, set_hls_variant_policy, set_mp4_output_mode
+from kino_hls import warm_encoder_probe
 def ui_card(parent, *, title=None, subtitle=None, width=None):
     outer = tk.Frame(parent, bg=BG_SURFACE, highlightbackground=BORDER, highlightthickness=1)
     tk.Frame(outer, bg=ACCENT, height=3).pack(fill="x", side="top")
@@ -128,9 +130,7 @@ def open_settings():
     row_theme.pack(anchor="w", pady=(6, 10))
 
     def set_theme(name: str):
-        ss = load_settings()
-        ss["theme"] = name
-        save_settings(ss)
+        update_settings(lambda ss: ss.update({"theme": name}))
         apply_theme(root, name)   # <-- живое применение
         try:
             if hasattr(root, "_update_sidebar_status"):
@@ -165,17 +165,16 @@ def open_settings():
 
     def on_hls_toggle():
         v = bool(hls_var.get())
-        ss = load_settings()
-        ss["hls_reencode"] = v
-        save_settings(ss)
+        update_settings(lambda ss: ss.update({"hls_reencode": v}))
         try:
             set_hls_reencode(v)
+            warm_encoder_probe()
         except Exception:
             pass
 
     chk = tk.Checkbutton(
         body,
-        text="Перекодировать HLS в фиксированный битрейт (NVENC)",
+        text="Перекодировать HLS в фиксированный битрейт (NVENC/QSV/AMF/x264 — самый быстрый доступный)",
         variable=hls_var,
         command=on_hls_toggle,
         bg=BG_SURFACE,
@@ -189,6 +188,96 @@ def open_settings():
     )
     chk.pack(anchor="w")
 
+    variant = dict(s.get("hls_variant") or {})
+    variant_bw_var = tk.BooleanVar(value=bool(variant.get("bandwidth_aware", True)))
+    variant_h_var = tk.StringVar(value=str(int(variant.get("max_height") or 0)))
+
+    def _save_variant(*_):
+        try:
+            h = max(0, int(variant_h_var.get() or 0))
+        except Exception:
+            return
+        pol = {"bandwidth_aware": bool(variant_bw_var.get()), "max_height": h}
+        update_settings(lambda ss: ss.update({"hls_variant": pol}))
+        try:
+            set_hls_variant_policy(**pol)
+        except Exception:
+            pass
+
+    tk.Checkbutton(
+        body,
+        text="При перекодировании качать вариант под целевой битрейт, а не максимальный",
+        variable=variant_bw_var,
+        command=_save_variant,
+        bg=BG_SURFACE,
+        fg=TEXT,
+        activebackground=BG_SURFACE,
+        activeforeground=TEXT,
+        selectcolor=BG_CARD,
+        highlightthickness=0,
+        bd=0,
+        font=("Segoe UI", 10),
+    ).pack(anchor="w", pady=(4, 0))
+
+    row_vh = tk.Frame(body, bg=BG_SURFACE)
+    row_vh.pack(anchor="w", pady=(6, 0))
+    tk.Label(row_vh, text="Потолок качества (высота кадра, 0 — без ограничения):", bg=BG_SURFACE, fg=TEXT,
+             font=("Segoe UI", 10)).pack(side="left")
+
+    sp_vh = tk.Spinbox(
+        row_vh,
+        values=("0", "480", "720", "1080", "1440", "2160"),
+        width=6,
+        textvariable=variant_h_var,
+        bg=FIELD_BG,
+        fg=TEXT,
+        insertbackground=TEXT,
+        relief="flat",
+        font=("Segoe UI", 10),
+        justify="center",
+    )
+    sp_vh.pack(side="left", padx=(8, 0))
+    try:
+        style_entry(sp_vh)
+    except Exception:
+        pass
+    # values= сбрасывает текст на первый элемент — возвращаем сохранённое значение
+    variant_h_var.set(str(int(variant.get("max_height") or 0)))
+    variant_h_var.trace_add("write", _save_variant)
+
+    frag_var = tk.BooleanVar(value=str(s.get("mp4_output_mode") or "faststart") == "fragmented")
+
+    def on_frag_toggle():
+        mode = "fragmented" if frag_var.get() else "faststart"
+        update_settings(lambda ss: ss.update({"mp4_output_mode": mode}))
+        try:
+            set_mp4_output_mode(mode)
+        except Exception:
+            pass
+
+    tk.Checkbutton(
+        body,
+        text="Фрагментированный MP4 (MUX без второго прохода faststart)",
+        variable=frag_var,
+        command=on_frag_toggle,
+        bg=BG_SURFACE,
+        fg=TEXT,
+        activebackground=BG_SURFACE,
+        activeforeground=TEXT,
+        selectcolor=BG_CARD,
+        highlightthickness=0,
+        bd=0,
+        font=("Segoe UI", 10),
+    ).pack(anchor="w", pady=(6, 0))
+
+    tk.Label(
+        body,
+        text="Старые ТВ и плееры могут не открыть такой файл — тогда оставьте выключенным.",
+        bg=BG_SURFACE,
+        fg=SUBTEXT,
+        font=("Segoe UI", 9),
+    ).pack(anchor="w", pady=(2, 0))
+
     # --- KINO.PUB DOWNLOADER ---
     tk.Frame(body, bg=BORDER, height=1).pack(fill="x", pady=10)
 
@@ -246,9 +335,7 @@ def open_settings():
                 max_parallel_var.set(v)
         except Exception:
             pass
-        ss = load_settings()
-        ss["kino_max_parallel"] = v
-        save_settings(ss)
+        update_settings(lambda ss: ss.update({"kino_max_parallel": v}))
 
     max_parallel_var.trace_add("write", _save_max_parallel)
 
@@ -303,9 +390,7 @@ def open_settings():
                 audio_parallel_var.set(v)
         except Exception:
             pass
-        ss = load_settings()
-        ss["kino_audio_parallel_tracks"] = v
-        save_settings(ss)
+        update_settings(lambda ss: ss.update({"kino_audio_parallel_tracks": v}))
         try:
             root._kino_audio_parallel_tracks = int(v)
         except Exception:
@@ -319,16 +404,150 @@ def open_settings():
 
     audio_parallel_var.trace_add("write", _save_audio_parallel)
 
+    concurrent_var = tk.BooleanVar(value=bool(s.get("hls_concurrent_streams", True)))
+
+    def on_concurrent_toggle():
+        v = bool(concurrent_var.get())
+        update_settings(lambda ss: ss.update({"hls_concurrent_streams": v}))
+        try:
+            set_hls_concurrent_streams(v)
+        except Exception:
+            pass
+
+    tk.Checkbutton(
+        body,
+        text="Качать видео и аудио одновременно (общий лимит)",
+        variable=concurrent_var,
+        command=on_concurrent_toggle,
+        bg=BG_SURFACE,
+        fg=TEXT,
+        activebackground=BG_SURFACE,
+        activeforeground=TEXT,
+        selectcolor=BG_CARD,
+        highlightthickness=0,
+        bd=0,
+        font=("Segoe UI", 10),
+    ).pack(anchor="w", pady=(8, 0))
+
+    # --- АУДИО: отбор дорожек до скачивания ---
+    pol = dict(s.get("audio_policy") or {})
+    pol_langs_var = tk.StringVar(value=", ".join(pol.get("langs") or []))
+    pol_regex_var = tk.StringVar(value=str(pol.get("name_regex") or ""))
+    pol_max_var = tk.IntVar(value=max(0, min(20, int(pol.get("max_tracks") or 0))))
+    pol_default_var = tk.BooleanVar(value=bool(pol.get("keep_default", True)))
+    pol_ask_var = tk.BooleanVar(value=bool(pol.get("ask", False)))
+
+    tk.Label(body, text="Какие аудиодорожки качать:", bg=BG_SURFACE, fg=TEXT, font=("Segoe UI", 10))\
+        .pack(anchor="w", pady=(10, 0))
+
+    row_pl = tk.Frame(body, bg=BG_SURFACE)
+    row_pl.pack(anchor="w", pady=(6, 0))
+    tk.Label(row_pl, text="Языки:", bg=BG_SURFACE, fg=TEXT, font=("Segoe UI", 10)).pack(side="left")
+    e_langs = tk.Entry(row_pl, textvariable=pol_langs_var, width=14, bg=FIELD_BG, fg=TEXT,
+                       insertbackground=TEXT, relief="flat", font=("Segoe UI", 10))
+    e_langs.pack(side="left", padx=(8, 12))
+    tk.Label(row_pl, text="Название (regex):", bg=BG_SURFACE, fg=TEXT, font=("Segoe UI", 10)).pack(side="left")
+    e_regex = tk.Entry(row_pl, textvariable=pol_regex_var, width=16, bg=FIELD_BG, fg=TEXT,
+                       insertbackground=TEXT, relief="flat", font=("Segoe UI", 10))
+    e_regex.pack(side="left", padx=(8, 0))
+
+    row_pm = tk.Frame(body, bg=BG_SURFACE)
+    row_pm.pack(anchor="w", pady=(6, 0))
+    tk.Label(row_pm, text="Не больше дорожек (0 — все):", bg=BG_SURFACE, fg=TEXT, font=("Segoe UI", 10))\
+        .pack(side="left")
+    sp_pm = tk.Spinbox(row_pm, from_=0, to=20, width=4, textvariable=pol_max_var, bg=FIELD_BG, fg=TEXT,
+                       insertbackground=TEXT, relief="flat", font=("Segoe UI", 10), justify="center")
+    sp_pm.pack(side="left", padx=(8, 0))
+    for w in (e_langs, e_regex, sp_pm):
+        try:
+            style_entry(w)
+        except Exception:
+            pass
+
+    def _save_audio_policy(*_):
+        try:
+            mx = max(0, min(20, int(pol_max_var.get())))
+        except Exception:
+            mx = 0
+        langs = [x.strip() for x in re.split(r"[,;\s]+", pol_langs_var.get() or "") if x.strip()]
+        v = {
+            "langs": langs,
+            "name_regex": (pol_regex_var.get() or "").strip(),
+            "max_tracks": mx,
+            "keep_default": bool(pol_default_var.get()),
+            "ask": bool(pol_ask_var.get()),
+        }
+        update_settings(lambda ss: ss.update({"audio_policy": v}))
+        try:
+            set_audio_policy(v)
+        except Exception:
+            pass
+
+    # поля ввода сохраняем не на каждую букву, а после паузы в наборе (и сразу при уходе фокуса)
+    pol_save_job = {"id": None}
+
+    def _flush_audio_policy(*_):
+        # есть несохранённая правка — сохраняем сейчас (таймер, уход фокуса, закрытие окна)
+        job, pol_save_job["id"] = pol_save_job["id"], None
+        if job is not None:
+            try:
+                root.after_cancel(job)
+            except Exception:
+                pass
+            _save_audio_policy()
+
+    def _schedule_audio_policy_save(*_):
+        if pol_save_job["id"] is not None:
+            try:
+                root.after_cancel(pol_save_job["id"])
+            except Exception:
+                pass
+        pol_save_job["id"] = root.after(700, _flush_audio_policy)
+
+    for var in (pol_langs_var, pol_regex_var, pol_max_var):
+        var.trace_add("write", _schedule_audio_policy_save)
+    for w in (e_langs, e_regex, sp_pm):
+        w.bind("<FocusOut>", _flush_audio_policy, add="+")
+    dlg.bind("<Destroy>", lambda e: _flush_audio_policy() if e.widget is dlg else None, add="+")
+
+    for text, var in (
+        ("Всегда оставлять дорожку по умолчанию", pol_default_var),
+        ("Спрашивать перед загрузкой", pol_ask_var),
+    ):
+        tk.Checkbutton(
+            body,
+            text=text,
+            variable=var,
+            command=_save_audio_policy,
+            bg=BG_SURFACE,
+            fg=TEXT,
+            activebackground=BG_SURFACE,
+            activeforeground=TEXT,
+            selectcolor=BG_CARD,
+            highlightthickness=0,
+            bd=0,
+            font=("Segoe UI", 10),
+        ).pack(anchor="w", pady=(4, 0))
+
+    tk.Label(
+        body,
+        text="Пусто — качаются все дорожки. Пример языков: ru, en.",
+        bg=BG_SURFACE,
+        fg=SUBTEXT,
+        font=("Segoe UI", 9),
+    ).pack(anchor="w", pady=(4, 0))
+
     queue_persist_var = tk.BooleanVar(value=bool(s.get("kino_queue_persist", True)))
     queue_autostart_var = tk.BooleanVar(value=bool(s.get("kino_queue_autostart_after_login", True)))
 
     def on_queue_persist_toggle():
         v = bool(queue_persist_var.get())
-        ss = load_settings()
-        ss["kino_queue_persist"] = v
-        if not v:
-            ss.pop("kino_queue", None)
-        save_settings(ss)
+        def _apply(ss):
+            ss["kino_queue_persist"] = v
+            if not v:
+                ss.pop("kino_queue", None)
+
+        update_settings(_apply)
         try:
             auto_chk.config(state=("normal" if v else "disabled"))
         except Exception:
@@ -336,9 +555,7 @@ def open_settings():
 
     def on_queue_autostart_toggle():
         v = bool(queue_autostart_var.get())
-        ss = load_settings()
-        ss["kino_queue_autostart_after_login"] = v
-        save_settings(ss)
+        update_settings(lambda ss: ss.update({"kino_queue_autostart_after_login": v}))
 
     queue_chk = tk.Checkbutton(
         body,
@@ -378,9 +595,7 @@ def open_settings():
 
     def on_auto_convert_toggle():
         v = bool(auto_convert_var.get())
-        ss = load_settings()
-        ss["kino_auto_convert_all_audio"] = v
-        save_settings(ss)
+        update_settings(lambda ss: ss.update({"kino_auto_convert_all_audio": v}))
         try:
             setattr(root, "_kino_auto_convert_all_audio", v)
         except Exception:
@@ -418,9 +633,7 @@ def open_settings():
 
     def on_purge_toggle():
         v = bool(purge_var.get())
-        ss = load_settings()
-        ss["purge_kino_profile_on_startup"] = v
-        save_settings(ss)
+        update_settings(lambda ss: ss.update({"purge_kino_profile_on_startup": v}))
 
     purge_chk = tk.Checkbutton(
         body,
@@ -454,9 +667,7 @@ def open_settings():
 
     def on_builtin_acc_toggle():
         v = bool(builtin_acc_var.get())
-        ss = load_settings()
-        ss["kino_use_builtin_account"] = v
-        save_settings(ss)
+        update_settings(lambda ss: ss.update({"kino_use_builtin_account": v}))
 
     tk.Checkbutton(
         body,
@@ -632,9 +843,7 @@ def open_settings():
 
     def on_popups_toggle():
         v = bool(popups_var.get())
-        ss = load_settings()
-        ss["popup_notifications"] = v
-        save_settings(ss)
+        update_settings(lambda ss: ss.update({"popup_notifications": v}))
 
     pop_chk = tk.Checkbutton(
         body,
@@ -657,9 +866,7 @@ def open_settings():
 
     def on_win_toasts_toggle():
         v = bool(win_toasts_var.get())
-        ss = load_settings()
-        ss["win_toast_notifications"] = v
-        save_settings(ss)
+        update_settings(lambda ss: ss.update({"win_toast_notifications": v}))
 
     win_chk = tk.Checkbutton(
         body,
@@ -705,11 +912,8 @@ def open_settings():
 
     def on_tray_toggle():
         v = bool(tray_var.get())
-        ss = load_settings()
-        ss["minimize_to_tray"] = v
         # Старт в трее отключили: приложение всегда запускается развернутым в панели задач.
-        ss["start_minimized_to_tray"] = False
-        save_settings(ss)
+        update_settings(lambda ss: ss.update({"minimize_to_tray": v, "start_minimized_to_tray": False}))
         try:
             start_tray_var.set(False)
             start_chk.config(state="disabled")
@@ -724,9 +928,7 @@ def open_settings():
             start_tray_var.set(False)
         except Exception:
             pass
-        ss = load_settings()
-        ss["start_minimized_to_tray"] = v
-        save_settings(ss)
+        update_settings(lambda ss: ss.update({"start_minimized_to_tray": v}))
 
     def on_autostart_toggle():
         v = bool(autostart_var.get())
@@ -738,9 +940,7 @@ def open_settings():
                 pass
             messagebox.showerror("Автозапуск", f"Не удалось изменить автозапуск:\n{err}")
             return
-        ss = load_settings()
-        ss["autostart_windows"] = v
-        save_settings(ss)
+        update_settings(lambda ss: ss.update({"autostart_windows": v}))
 
     tray_chk = tk.Checkbutton(
         body,
@@ -1068,7 +1268,7 @@ def cleanup_title(s: str) -> str:
 
 def load_settings():
     try:
-        with open(SETTINGS_FILE, encoding="utf-8") as f:
+        with SETTINGS_LOCK, open(SETTINGS_FILE, encoding="utf-8") as f:
             return json.load(f)
     except Exception:
         return {}
@@ -1076,29 +1276,36 @@ def load_settings():
 
 def save_settings(data: dict):
     try:
-        with open(SETTINGS_FILE, "w", encoding="utf-8") as f:
+        with SETTINGS_LOCK, open(SETTINGS_FILE, "w", encoding="utf-8") as f:
             json.dump(data, f, ensure_ascii=False, indent=2)
     except Exception as e:
         logging.error("Ошибка сохранения настроек: %s", e)
 
 
+def update_settings(mutator) -> dict:
+    """
+    Чтение-изменение-запись settings.json целиком под SETTINGS_LOCK: фоновые потоки (kino_hls)
+    дописывают туда свои ключи, и отдельные load_settings()/save_settings() их бы затёрли.
+    """
+    with SETTINGS_LOCK:
+        data = load_settings()
+        mutator(data)
+        save_settings(data)
+        return data
+
+
 DOWNLOAD_HISTORY_KEY = "download_history"
 DOWNLOAD_HISTORY_MAX = 300
 
 def ensure_bridge_token() -> str:
+    def _apply(s):
+        if not s.get("browser_bridge_token"):
+            s["browser_bridge_token"] = secrets.token_hex(16)
+
     try:
-        s = load_settings()
+        return update_settings(_apply)["browser_bridge_token"]
     except Exception:
-        s = {}
-    tok = s.get("browser_bridge_token")
-    if not tok:
-        tok = secrets.token_hex(16)
-        s["browser_bridge_token"] = tok
-        try:
-            save_settings(s)
-        except Exception:
-            pass
-    return tok
+        return secrets.token_hex(16)
 
 
 def get_download_history() -> list[dict]:
@@ -1114,9 +1321,7 @@ def get_download_history() -> list[dict]:
 
 def set_download_history(items: list[dict]):
     try:
-        s = load_settings()
-        s[DOWNLOAD_HISTORY_KEY] = items
-        save_settings(s)
+        update_settings(lambda s: s.update({DOWNLOAD_HISTORY_KEY: items}))
     except Exception:
         pass
 
@@ -1125,11 +1330,12 @@ def append_download_history(event: dict):
     try:
         if not isinstance(event, dict):
             return
-        hist = get_download_history()
-        hist.insert(0, event)
-        if len(hist) > DOWNLOAD_HISTORY_MAX:
-            del hist[DOWNLOAD_HISTORY_MAX:]
-        set_download_history(hist)
+        with SETTINGS_LOCK:
+            hist = get_download_history()
+            hist.insert(0, event)
+            if len(hist) > DOWNLOAD_HISTORY_MAX:
+                del hist[DOWNLOAD_HISTORY_MAX:]
+            set_download_history(hist)
     except Exception:
         pass
 
@@ -3069,8 +3275,7 @@ def main():
     try:
         if bool(s.get("start_minimized_to_tray", False)):
             # Старт в трее отключили: приложение всегда запускается развернутым в панели задач.
-            s["start_minimized_to_tray"] = False
-            save_settings(s)
+            s = update_settings(lambda ss: ss.update({"start_minimized_to_tray": False}))
     except Exception:
         pass
 
@@ -3082,6 +3287,27 @@ def main():
     theme_name = s.get("theme", "dark")
     try:
         set_hls_reencode(bool(s.get("hls_reencode", True)))
+        warm_encoder_probe()
+    except Exception:
+        pass
+    try:
+        set_hls_concurrent_streams(bool(s.get("hls_concurrent_streams", True)))
+    except Exception:
+        pass
+    try:
+        set_audio_policy(s.get("audio_policy") or {})
+    except Exception:
+        pass
+    try:
+        variant = dict(s.get("hls_variant") or {})
+        set_hls_variant_policy(
+            bandwidth_aware=bool(variant.get("bandwidth_aware", True)),
+            max_height=int(variant.get("max_height") or 0),
+        )
+    except Exception:
+        pass
+    try:
+        set_mp4_output_mode(s.get("mp4_output_mode") or "faststart")
     except Exception:
         pass
 
@@ -5200,9 +5426,7 @@ def main():
             except Exception:
                 pass
         try:
-            s = load_settings()
-            s["last_download_dir"] = out_dir
-            save_settings(s)
+            update_settings(lambda s: s.update({"last_download_dir": out_dir}))
         except Exception:
             pass
         return out_dir
@@ -5217,9 +5441,7 @@ def main():
         if d:
             d = _normalize_out_dir(d)
             out_dir_var.set(d)
-            s = load_settings()
-            s["last_download_dir"] = d
-            save_settings(s)
+            update_settings(lambda s: s.update({"last_download_dir": d}))
     choose_btn = tk.Button(path_frame, text="Выбрать", command=choose_folder); style_secondary(choose_btn)
     choose_btn.pack(side="left", padx=(8, 0))
     kino_status = tk.Label(top_part, text="", bg=BG_SURFACE, fg=ACCENT_SECOND, font=("Segoe UI", 10))
@@ -6211,13 +6433,15 @@ def main():
 
     def _save_kino_queue_now():
         try:
-            s = load_settings()
-            if not bool(s.get("kino_queue_persist", True)):
-                s.pop("kino_queue", None)
-                save_settings(s)
-                return
-            s["kino_queue"] = _kqueue_snapshot()
-            save_settings(s)
+            snapshot = _kqueue_snapshot()
+
+            def _apply(s):
+                if not bool(s.get("kino_queue_persist", True)):
+                    s.pop("kino_queue", None)
+                else:
+                    s["kino_queue"] = snapshot
+
+            update_settings(_apply)
         except Exception:
             pass
 
@@ -7721,6 +7945,16 @@ def main():
         if not q:
             messagebox.showerror("Ошибка", "Введите запрос или URL карточки.")
             return
+        # «URL#t=1:20:00,1:25:30» — скачать только отрезок (DownloadManager разбирает суффикс сам)
+        if "#t=" in q:
+            from kino_pub_downloader import split_clip
+
+            if split_clip(q)[1] is None:
+                messagebox.showerror(
+                    "Ошибка",
+                    "Неверный отрезок. Формат: <URL>#t=<начало>,<конец>, время — секунды или ЧЧ:ММ:СС.",
+                )
+                return
 
         item_id = add_row(q, status="🟡 Подготовка...")
         kino_input.delete(0, "end")
@@ -9096,9 +9330,7 @@ def main():
             res["end"] = e
             res["resolve_years"] = bool(resolve_var.get())
             try:
-                sset = load_settings()
-                sset["kino_news_resolve_years"] = bool(resolve_var.get())
-                save_settings(sset)
+                update_settings(lambda sset: sset.update({"kino_news_resolve_years": bool(resolve_var.get())}))
             except Exception:
                 pass
             dlg.destroy()
@@ -270,7 +270,8 @@ def _safe_get_driver(status_cb=None, headless: bool = False, suppress: bool = Tr
     options=options,
     headless=False,
     use_subprocess=True,
-    browser_executable_path=_CHROMIUM_EXE
+    browser_executable_path=_CHROMIUM_EXE,
+    enable_cdp_events=not os.environ.get("KINO_DISABLE_PERF"),  # Network-события для сниффа HLS
 )
 
             # ЛЕНИВО узнаём версию ОДИН РАЗ и только сейчас — без запуска chrome.exe
@@ -681,6 +682,7 @@ from selenium.webdriver.common.by import By
 
 KINOPUB_BASE = "https://kino.pub"
 SETTINGS_FILE = os.path.join(os.getenv("APPDATA") or os.path.expanduser("~"), "MediaSearch", "settings.json")
+SETTINGS_LOCK = threading.RLock()  # settings.json пишут и UI, и фоновые потоки (kino_hls) — только под ним
 
 
 def _use_builtin_account() -> bool:
@@ -854,6 +856,51 @@ def login_to_kino(status_cb=None):
         except Exception:
             pass
 
+# ===================== SNIFF RESOURCE BLOCKING =====================
+# Для поиска master.m3u8 странице не нужны картинки, шрифты, сегменты видео и счётчики.
+# Заблокированный запрос всё равно виден в перф-логе (requestWillBeSent), так что сниффер его поймает.
+# .gif не трогаем: через ping.gif?mu=<m3u8> плеер сообщает ссылку на master.
+SNIFF_BLOCK_RESOURCES = True
+SNIFF_BLOCKED_URLS = [
+    # картинки/постеры
+    "*.jpg", "*.jpg?*", "*.jpeg", "*.jpeg?*", "*.png", "*.png?*", "*.webp", "*.webp?*",
+    "*.avif", "*.avif?*", "*.svg", "*.svg?*", "*.ico", "*.ico?*",
+    # шрифты
+    "*.woff", "*.woff?*", "*.woff2", "*.woff2?*", "*.ttf", "*.ttf?*", "*.otf", "*.otf?*", "*.eot", "*.eot?*",
+    # сегменты, которые плеер префетчит (сами плейлисты .m3u8 пропускаем)
+    "*.ts", "*.ts?*", "*.m4s", "*.m4s?*", "*.aac", "*.aac?*",
+    # реклама/аналитика
+    "*google-analytics.com*", "*googletagmanager.com*", "*doubleclick.net*", "*googlesyndication.com*",
+    "*mc.yandex.ru*", "*yandex.ru/metrika*", "*top-fwz1.mail.ru*", "*connect.facebook.net*",
+    "*vk.com/rtrg*", "*an.yandex.ru*",
+]
+
+
+def set_sniff_blocking(enabled: bool):
+    global SNIFF_BLOCK_RESOURCES
+    SNIFF_BLOCK_RESOURCES = bool(enabled)
+
+
+def apply_sniff_blocking(driver) -> bool:
+    """Включает блокировку тяжёлых ресурсов на драйвере. True — если блокировка реально поставлена."""
+    if not SNIFF_BLOCK_RESOURCES:
+        return False
+    try:
+        driver.execute_cdp_cmd("Network.enable", {})
+        driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": list(SNIFF_BLOCKED_URLS)})
+        return True
+    except Exception:
+        return False
+
+
+def clear_sniff_blocking(driver):
+    """Снимает блокировку (драйвер из пула дальше используется как обычно, например для CF)."""
+    try:
+        driver.execute_cdp_cmd("Network.setBlockedURLs", {"urls": []})
+    except Exception:
+        pass
+
+
 # ========================= DRIVER POOL =========================
 class DriverPool:
     def __init__(self, max_drivers=2, status_cb=None):
@@ -920,6 +967,13 @@ class DriverPool:
             # если уже исчерпали лимит — ждём освобождения
             return self.q.get(timeout=timeout)
 
+    def try_acquire(self):
+        """Свободный драйвер без ожидания и без создания нового (для фоновых задач), иначе None."""
+        try:
+            return self.q.get_nowait()
+        except Exception:
+            return None
+
     def release(self, drv):
         self.q.put(drv)
 